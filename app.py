@@ -1,14 +1,19 @@
 import streamlit as st
 import json
 from dotenv import load_dotenv
-from utils.db import get_connection, retrieve_user_data, release_connection
+from utils.db import connection, get_pool, retrieve_user_data
 from utils.user_data import store_user_data
 from utils.vector_utils import retrieve_similar_data as retrieve_similar_data_vector
 from utils.memory_manager import get_relevant_memories, format_memory_context
+from utils.intent import analyze_message
+from utils.intent_router import route_intent
+from utils.profile import get_profile, invalidate_profile
+from utils.stages import TurnStages
+from utils.conversation import ConversationBuffer
+from utils.embedding import generate_embedding
+from utils.response_cache import response_cache, is_cacheable_query, RESPONSE_CACHE_ENABLED
 import nest_asyncio
-import requests
-from utils.auth import get_access_token
-from pgvector.psycopg import register_vector
+from utils.gemini_client import generate_content, stream_generate_content, GeminiError, GeminiAuthError, GeminiUnavailableError
 from utils.ms_auth import authenticate_with_microsoft
 from components.calendar import render_calendar_events, create_calendar_event, get_event_details, list_all_events
 import datetime
@@ -29,13 +34,9 @@ SCOPES = ["Calendars.Read", "Calendars.ReadWrite", "User.Read"]
 
 # --- Initialize Database ---
 try:
-    conn = get_connection()
-    if conn:
-        register_vector(conn)
-        conn.close()
-        print("Database initialized successfully.")
-    else:
-        print("Failed to get database connection.")
+    # Opens the shared pool; vector types are registered per pooled connection.
+    get_pool()
+    print("Database initialized successfully.")
 except Exception as e:
     print(f"Error initializing database: {e}")
 
@@ -43,7 +44,7 @@ except Exception as e:
 def init_session_state():
     defaults = {
         "messages": [],
-        "context": "",
+        "conversation": None,  # ConversationBuffer, created below
         "user_id": "default-user",
         "ms_access_token": None,
         "rendered": False,
@@ -57,6 +58,8 @@ def init_session_state():
         if key not in st.session_state:
             st.session_state[key] = value
             print(f"Initialized {key} in session state.")
+    if st.session_state.conversation is None:
+        st.session_state.conversation = ConversationBuffer()
 init_session_state()
 
 # --- Authentication ---
@@ -71,27 +74,47 @@ if not st.session_state.ms_access_token:
         print(f"Authentication failed: {e}")
 
 # --- Gemini Response ---
+# Static part of the answer prompt; the per-turn memory context goes in the message itself
+ANSWER_INSTRUCTIONS = (
+    "You are a helpful assistant connected to Microsoft Calendar. "
+    "Use what you are told about the user and your previous conversations to answer the user's question."
+)
+
 def get_gemini_response(user_message: str, context: str = "") -> str:
     print(f"Generating Gemini response for message: {user_message}")
-    access_token = get_access_token()
-    if not access_token:
+    try:
+        response_text = generate_content(f"{context}\nUser: {user_message}", system_instruction=ANSWER_INSTRUCTIONS).strip()
+        print(f"Gemini response: {response_text}")
+        return response_text
+    except GeminiAuthError:
         print("No Gemini access token available.")
         return "🔒 Authentication failed. Please log in again."
+    except GeminiUnavailableError as e:
+        print(f"Gemini call rejected: {e}")
+        return "⚠️ The assistant is temporarily unavailable. Please try again in a moment."
+    except GeminiError as e:
+        print(f"Gemini API Error: {e}")
+        return f"⚠️ Gemini API Error: {e}"
 
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
-    payload = {"contents": [{"parts": [{"text": f"{context}\nUser: {user_message}"}]}]}
-
+def stream_gemini_response(user_message: str, context: str = "", on_token=None) -> str:
+    """Like get_gemini_response, but calls on_token(text_so_far) as streamed chunks arrive."""
+    print(f"Streaming Gemini response for message: {user_message}")
+    response_text = ""
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        response_text = response.json()['candidates'][0]['content']['parts'][0].get('text', '').strip()
+        for chunk in stream_generate_content(f"{context}\nUser: {user_message}", system_instruction=ANSWER_INSTRUCTIONS):
+            response_text += chunk
+            if on_token:
+                on_token(response_text)
+        response_text = response_text.strip()
         print(f"Gemini response: {response_text}")
         return response_text
-    except requests.exceptions.HTTPError as e:
-        print(f"HTTP Error in Gemini API: {e}")
-        return f"⚠️ Gemini API Error: {e.response.status_code} - {e.response.text}"
-    except Exception as e:
+    except GeminiAuthError:
+        print("No Gemini access token available.")
+        return "🔒 Authentication failed. Please log in again."
+    except GeminiUnavailableError as e:
+        print(f"Gemini call rejected: {e}")
+        return "⚠️ The assistant is temporarily unavailable. Please try again in a moment."
+    except GeminiError as e:
         print(f"Gemini API Error: {e}")
         return f"⚠️ Gemini API Error: {e}"
 
@@ -113,21 +136,19 @@ def should_save_info(info_type: str, info_value: str, user_message: str) -> bool
 def store_user_data_persistent(user_id: str, data_key: str, data_value: str):
     """Store user data in the database."""
     print(f"Storing user data: {user_id}, {data_key}, {data_value}")
-    conn = get_connection()
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO user_data (user_id, data_key, data_value) VALUES (%s, %s, %s) "
-                "ON CONFLICT (user_id, data_key) DO UPDATE SET data_value = EXCLUDED.data_value",
-                (user_id, data_key, data_value)
-            )
-        conn.commit()
+        with connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO user_data (user_id, data_key, data_value) VALUES (%s, %s, %s) "
+                    "ON CONFLICT (user_id, data_key) DO UPDATE SET data_value = EXCLUDED.data_value",
+                    (user_id, data_key, data_value)
+                )
+        invalidate_profile(user_id)
+        response_cache.invalidate(user_id, {data_key})
         print(f"💾 Stored in user_data: {data_key} = {data_value} for user {user_id}")
     except Exception as e:
         print(f"⚠️ Error storing in user_data: {e}")
-    finally:
-        if conn:
-            release_connection(conn)
 
 def normalize_name(query):
     """Apply spelling corrections and normalize query."""
@@ -139,8 +160,12 @@ def normalize_name(query):
     return query
 
 # --- Handle Send Message ---
-def handle_send_message(user_message: str) -> str:
-    """Process user message and generate bot response."""
+def handle_send_message(user_message: str, on_token=None) -> str:
+    """
+    Process user message and generate bot response.
+    If on_token is given, the final answer is streamed and on_token(text_so_far)
+    is called for each chunk; the returned text is the cleaned, complete answer.
+    """
     print(f"Handling user message: {user_message}")
     st.session_state.last_user_message = user_message
     user_id = st.session_state.user_id
@@ -185,40 +210,28 @@ def handle_send_message(user_message: str) -> str:
         if query in st.session_state.recent_events:
             return st.session_state.recent_events[query]
 
-    # Detect intent using Gemini
-    intent_prompt = f"""You are connected to the user's Microsoft Calendar (Outlook) via the Microsoft Graph API. Do NOT reference Google Calendar or other calendar apps. Analyze the user message: "{user_message}"
-    Identify the intent and extract relevant details. Respond in JSON format:
-    - Create event: {{"intent": "create_event", "subject": "...", "start_time": "YYYY-MM-DDTHH:MM:SS", "end_time": "YYYY-MM-DDTHH:MM:SS", "attendees": ["..."], "location": "...", "description": "..."}}
-    - Get event details: {{"intent": "get_event_details", "query": "..."}}
-    - List all events: {{"intent": "list_all_events"}}
-    - General query: {{"intent": "general"}}
-    Rules:
-    - Use ISO 8601 format for times (e.g., "2025-05-12T14:19:00").
-    - If end_time is not specified, assume 1-hour duration.
-    - If no specific date, assume tomorrow.
-    - For dates like "5/12/2025", convert to "2025-05-12".
-    - Location defaults to "Kitea" if not specified.
-    - Attendees are optional; treat as names (not emails).
-    - Subject should include the person’s name (e.g., "Meeting with The Weeknd").
-    - For event details, extract name or date (e.g., "Taha", "2025-05-15").
-    Examples:
-    - "list all events" → {{"intent": "list_all_events"}}
-    - "event of meeting with Mr. Taha" → {{"intent": "get_event_details", "query": "Taha"}}
-    - "create meeting with The Weeknd location Kitea start time 2:19pm 5/12/2025 finish date 3:18pm 5/13/2025" → {{"intent": "create_event", "subject": "Meeting with The Weeknd", "start_time": "2025-05-12T14:19:00", "end_time": "2025-05-13T15:18:00", "attendees": [], "location": "Kitea", "description": ""}}
-    - "details of my meeting on 2025-05-15" → {{"intent": "get_event_details", "query": "2025-05-15"}}
-    - "yes all of the information is correct" → {{"intent": "confirm_event"}}
-    """
-    intent_response = get_gemini_response(intent_prompt)
-    print(f"Intent response: {intent_response}")
-
-    try:
-        intent_data = json.loads(intent_response)
-    except json.JSONDecodeError:
-        intent_data = {"intent": "general"}
-        print("Failed to parse intent response as JSON. Defaulting to general intent.")
+    # Common commands are classified locally; the rest go to one structured Gemini call.
+    # Unless the message is already known to be a calendar command, memory and
+    # profile retrieval start speculatively while that call is in flight.
+    stages = TurnStages()
+    intent_data = stages.run("route", route_intent, user_message)
+    if intent_data is None or intent_data["intent"] == "general":
+        stages.start("memories", get_relevant_memories, user_id, user_message, 3)
+        stages.start("profile", get_profile, user_id)
+    if intent_data is None:
+        intent_data = stages.run("analysis", analyze_message, user_message)
+    print(f"Intent data: {intent_data}")
+
+    is_general = intent_data["intent"] == "general" or (
+        intent_data["intent"] == "confirm_event" and not st.session_state.pending_event
+    )
+    if not is_general:
+        stages.discard()
+        print(f"⏱ Stage timings: {stages.report()}")
 
     # Handle calendar-related intents
     if not st.session_state.ms_access_token:
+        stages.discard()
         return "⚠️ Please authenticate with Microsoft first. Try refreshing the page."
 
     if intent_data["intent"] == "create_event":
@@ -280,45 +293,55 @@ def handle_send_message(user_message: str) -> str:
     elif intent_data["intent"] == "list_all_events":
         return list_all_events(st.session_state.ms_access_token)
 
-    # Handle general queries and info saving
-    prompt_analysis = f"""You are a helpful AI connected to Microsoft Calendar. For the user message: "{user_message}"
-    Respond with:
-    - "NAME: [name]" for first-time name
-    - "UPDATE NAME: [name]" for name update
-    - "FAVORITE COLOR: [color]" for favorite color
-    - "HOBBY: [hobby]" for hobby
-    - "FAVORITE MOVIE: [movie]" for favorite movie
-    - "REMEMBER: [info]" for other info to remember
-    - "NONE" if no info to remember"""
-    
-    analysis_response = get_gemini_response(prompt_analysis)
-    print(f"🤖 Analysis Response: {analysis_response}")
-
-    info_to_save = None
-    info_type = None
-    if ":" in analysis_response and "NONE" not in analysis_response:
-        parts = analysis_response.split(":", 1)
-        info_type = parts[0].strip().lower().replace(" ", "_")
-        info_value = parts[1].strip()
-        info_to_save = (info_type, info_value)
-        if info_type == "update_name":
-            info_type = "name"
-
-    if info_to_save and should_save_info(info_to_save[0], info_to_save[1], user_message):
-        store_user_data_persistent(user_id, info_to_save[0], info_to_save[1])
-        print(f"💾 AI saved {info_to_save[0]}: {info_to_save[1]}")
-    elif "NONE" in analysis_response:
+    # Handle general queries and info saving.
+    # Wait for the speculative profile load first, so it cannot re-cache the
+    # profile after a fact below invalidates it.
+    stages.result("profile")
+    facts = intent_data.get("facts", [])
+    for fact in facts:
+        if should_save_info(fact["type"], fact["value"], user_message):
+            store_user_data_persistent(user_id, fact["type"], fact["value"])
+            print(f"💾 AI saved {fact['type']}: {fact['value']}")
+    if not facts:
         print("🤖 No specific information to remember.")
 
-    relevant_memories = get_relevant_memories(user_id, user_message, top_n=3)
-    memory_context = format_memory_context(user_id, relevant_memories, user_message)
+    # Repeated general questions are answered from the semantic response cache.
+    # Calendar commands never get here; time-sensitive questions, follow-ups that
+    # depend on the recent conversation and turns that shared new facts are
+    # neither served from nor stored in the cache.
+    cacheable = (RESPONSE_CACHE_ENABLED and intent_data["intent"] == "general"
+                 and not facts and is_cacheable_query(user_message))
+    query_embedding = stages.run("cache_lookup", generate_embedding, user_message) if cacheable else None
+    cached_response = response_cache.lookup(user_id, query_embedding) if query_embedding else None
+    if cached_response:
+        stages.discard()
+        print(f"♻️ Response cache hit: {response_cache.stats()}")
+        store_user_data(int(user_id) if user_id.isdigit() else user_id, user_message, cached_response)
+        st.session_state.conversation.add_exchange(user_message, cached_response)
+        print(f"⏱ Stage timings: {stages.report()}")
+        return cached_response
+
+    relevant_memories = stages.result("memories", default=[])
+    used_keys = set()
+    memory_context = stages.run("context", format_memory_context, user_id, relevant_memories, user_message, used_keys)
     print(f"Memory context: {memory_context}")
+    # Recent turns (token-bounded, older ones summarized) for follow-up questions
+    recent_conversation = st.session_state.conversation.render()
+    if recent_conversation:
+        memory_context = f"{memory_context}\nRecent conversation:\n{recent_conversation}"
 
-    response = get_gemini_response(user_message, f"You are a helpful assistant connected to Microsoft Calendar. {memory_context} Based on this, answer the user's question.")
+    if on_token:
+        response = stages.run("answer", stream_gemini_response, user_message, memory_context, on_token)
+    else:
+        response = stages.run("answer", get_gemini_response, user_message, memory_context)
+    # Post-processing runs on the assembled text, after streaming has finished
     cleaned_response = response.strip().replace("bot:", "").replace("Gemini:", "")
-    store_user_data(int(user_id) if user_id.isdigit() else user_id, user_message, cleaned_response)
-    st.session_state.context += f"\nUser: {user_message}\nBot: {cleaned_response}"
+    stages.run("store", store_user_data, int(user_id) if user_id.isdigit() else user_id, user_message, cleaned_response)
+    if query_embedding and not cleaned_response.startswith(("⚠️", "🔒")):
+        response_cache.store(user_id, user_message, query_embedding, cleaned_response, used_keys)
+    st.session_state.conversation.add_exchange(user_message, cleaned_response)
     print(f"Bot response: {cleaned_response}")
+    print(f"⏱ Stage timings: {stages.report()}")
     return cleaned_response
 
 # --- Message Send Handler ---
@@ -328,7 +351,14 @@ def send():
     if user_message and user_message.strip():
         print(f"Sending message: {user_message}")
         st.session_state.messages.append({"role": "user", "text": user_message})
-        response = handle_send_message(user_message)
+        with st.sidebar:
+            placeholder = st.empty()
+
+        def render_partial(text):
+            placeholder.markdown(f"<div class='bot-msg'>{text}▌</div>", unsafe_allow_html=True)
+
+        response = handle_send_message(user_message, on_token=render_partial)
+        placeholder.empty()
         st.session_state.messages.append({"role": "bot", "text": response})
         st.session_state.chat_input = ""
     else:
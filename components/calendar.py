@@ -2,6 +2,7 @@ import requests
 import datetime
 import streamlit as st
 import pandas as pd
+from utils.calendar_mirror import calendar_mirror, CALENDAR_MIRROR_ENABLED
 
 def get_calendar_events(access_token, query=None, date_range_days=30):
     """Fetch calendar events from Microsoft Graph API, optionally filtered by query."""
@@ -33,6 +34,17 @@ def get_calendar_events(access_token, query=None, date_range_days=30):
         print(f"Error fetching calendar events: {e}")
         return f"⚠️ Error fetching calendar events: {e}"
 
+def load_events(access_token, query=None, date_range_days=30):
+    """Upcoming events from the local mirror; falls back to Graph if the mirror can't answer."""
+    if query:
+        query = query.lower().replace("mr.", "").strip()
+    if CALENDAR_MIRROR_ENABLED:
+        try:
+            return calendar_mirror.events(access_token, query=query, days=date_range_days)
+        except Exception as e:
+            print(f"Calendar mirror unavailable, querying Graph directly: {e}")
+    return get_calendar_events(access_token, query=query, date_range_days=date_range_days)
+
 def create_calendar_event(access_token, subject, start_time, end_time, attendees=None, location=None, description=None):
     """Create a new event in the Microsoft Calendar."""
     print(f"Creating calendar event: {subject}")
@@ -63,6 +75,12 @@ def create_calendar_event(access_token, subject, start_time, end_time, attendees
         response = requests.post(url, headers=headers, json=body)
         response.raise_for_status()
         event = response.json()
+        if CALENDAR_MIRROR_ENABLED:
+            # Write through so the new event is listed before the next delta sync
+            try:
+                calendar_mirror.upsert_event(access_token, event)
+            except Exception as e:
+                print(f"Could not write event through to the calendar mirror: {e}")
         start = datetime.datetime.fromisoformat(event["start"]["dateTime"].replace("Z", "+00:00")).strftime("%Y-%m-%d %H:%M")
         return f"Event created successfully: **{subject}** on {start} at {location or 'Kitea'}."
     except requests.exceptions.HTTPError as e:
@@ -75,7 +93,7 @@ def create_calendar_event(access_token, subject, start_time, end_time, attendees
 def render_calendar_events(access_token, query=None):
     """Render calendar events as a table and expandable details."""
     print(f"Rendering calendar events with query: {query}")
-    events = get_calendar_events(access_token, query=query)
+    events = load_events(access_token, query=query)
     if isinstance(events, str):
         st.error(events)
         print(f"Displayed error: {events}")
@@ -131,7 +149,7 @@ def render_calendar_events(access_token, query=None):
 def get_event_details(access_token, query):
     """Get details of specific events matching the query."""
     print(f"Fetching details for events matching: {query}")
-    events = get_calendar_events(access_token, query=query)
+    events = load_events(access_token, query=query)
     if isinstance(events, str):
         return events
     if not events:
@@ -168,7 +186,7 @@ def get_event_details(access_token, query):
 def list_all_events(access_token):
     """List all events in the next 30 days as text."""
     print("Listing all calendar events...")
-    events = get_calendar_events(access_token)
+    events = load_events(access_token)
     if isinstance(events, str):
         return events
     if not events:
@@ -1,20 +1,22 @@
 import os
-import asyncio
-import requests
+import uuid
+from urllib.parse import urlencode
 import streamlit as st
-import websockets
 import nest_asyncio
 from dotenv import load_dotenv
 
 from utils.auth import get_access_token, authenticate_with_google, logout
+from utils.gemini_client import generate_content, GeminiError, GeminiUnavailableError
 from utils.db import get_connection , retrieve_similar_data
 from utils.user_data import store_user_data, retrieve_user_data
+from utils.ws_client import get_client
 nest_asyncio.apply()
 load_dotenv()
 
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 WS_SERVER_URL = os.getenv('WS_SERVER_URL', 'ws://localhost:8765')
 USER_ID = "default-user"  
+KITEA_INSTRUCTIONS = "You are Kitea AI, a helpful assistant. Use the following context to answer the user question."
 
 
 def ensure_authenticated():
@@ -31,46 +33,29 @@ def get_gemini_response(user_message, context=""):
     if not access_token:
         return "Authentication failed. Please log in again."
 
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-pro:generateContent"
+    prompt = f"""Context:\n{context}\n\nUser: {user_message}\nKitea:"""
 
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-
-    prompt = f"""You are Kitea AI, a helpful assistant. Use the following context to answer the user question.\n\nContext:\n{context}\n\nUser: {user_message}\nKitea:"""
-
-    payload = {
-        "contents": [
-            {
-                "parts": [{"text": prompt}]
-            }
-        ]
-    }
-
-    response = requests.post(url, headers=headers, json=payload)
-
-    if response.status_code == 200:
-        data = response.json()
-        return data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "No response")
-    else:
-        return f"Error: {response.status_code} - {response.text}"
-
-
-async def send_message_to_ws(message):
     try:
-        async with websockets.connect(WS_SERVER_URL) as ws:
-            print(f"Connected to WebSocket server at {WS_SERVER_URL}")
-            await ws.send(message)
-            response = await ws.recv()
-            return response
-    except Exception as e:
-        print(f"WebSocket error: {e}")
-        return f"WebSocket error: {e}"
-
-
-def handle_send_message(user_message):
-    return asyncio.run(send_message_to_ws(user_message))
+        return generate_content(prompt, model="gemini-2.0-pro", system_instruction=KITEA_INSTRUCTIONS) or "No response"
+    except GeminiUnavailableError:
+        return "Kitea is temporarily unavailable. Please try again in a moment."
+    except GeminiError as e:
+        return f"Error: {e}"
+
+
+def ws_session_url():
+    """
+    Server URL carrying this browser session's id, so the server keeps one conversation per session.
+    The id alone grants access to that conversation, so it is random and never shown or logged.
+    """
+    if "ws_session_id" not in st.session_state:
+        st.session_state.ws_session_id = uuid.uuid4().hex
+    return f"{WS_SERVER_URL}?{urlencode({'session': st.session_state.ws_session_id})}"
+
+
+def handle_send_message(user_message, on_token=None):
+    # Reuses this session's persistent connection; no per-message event loop or handshake
+    return get_client(ws_session_url()).send(user_message, on_token)
 
 
 def display_chat():
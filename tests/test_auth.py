@@ -0,0 +1,63 @@
+# tests/test_auth.py
+import datetime
+import json
+import pytest
+from utils import auth
+
+
+class FakeCredentials:
+    """Just enough of google.oauth2.credentials.Credentials for TokenProvider."""
+
+    refreshed = 0
+
+    def __init__(self, info):
+        self.token = info["token"]
+        self.refresh_token = info.get("refresh_token")
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    @property
+    def valid(self):
+        return bool(self.token) and self.expiry > datetime.datetime.utcnow()
+
+    def refresh(self, request):
+        FakeCredentials.refreshed += 1
+        self.token = f"token-{FakeCredentials.refreshed + 1}"
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    def to_json(self):
+        return json.dumps({"token": self.token, "refresh_token": self.refresh_token})
+
+
+@pytest.fixture
+def provider(tmp_path, monkeypatch):
+    FakeCredentials.refreshed = 0
+    monkeypatch.setattr(auth.Credentials, "from_authorized_user_info", staticmethod(FakeCredentials))
+    monkeypatch.setattr(auth, "Request", lambda: None)
+    token_file = tmp_path / "token.json"
+    token_file.write_text(json.dumps({"token": "token-1", "refresh_token": "r"}))
+    return auth.TokenProvider(str(token_file)), token_file
+
+
+def test_fresh_token_is_served_from_memory(provider):
+    tokens, _ = provider
+    assert tokens.get_token() == "token-1"
+    assert tokens.get_token() == "token-1"
+    assert FakeCredentials.refreshed == 0
+
+
+def test_rejected_token_is_refreshed_not_reloaded(provider):
+    tokens, token_file = provider
+    assert tokens.get_token() == "token-1"
+    tokens.invalidate()  # what gemini_client does on a 401
+    assert tokens.get_token() == "token-2"
+    assert FakeCredentials.refreshed == 1
+    assert json.loads(token_file.read_text())["token"] == "token-2"
+
+
+def test_rejected_token_without_refresh_token_is_not_reused(provider, monkeypatch):
+    tokens, token_file = provider
+    token_file.write_text(json.dumps({"token": "token-1"}))
+    tokens.get_token()
+    tokens.invalidate()
+    monkeypatch.setattr(auth, "authenticate_with_google", lambda: None)
+    assert tokens.get_token() is None
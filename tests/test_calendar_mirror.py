@@ -0,0 +1,62 @@
+# tests/test_calendar_mirror.py
+import datetime
+from contextlib import contextmanager, nullcontext
+import pytest
+from utils import calendar_mirror
+from utils.calendar_mirror import CalendarMirror
+
+SYNC_START = datetime.datetime(2026, 1, 5, 9, 0, tzinfo=datetime.timezone.utc)
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def execute(self, sql, params=None):
+        self.statements.append((" ".join(sql.split()), params))
+        return FakeResult([(SYNC_START,)] if sql.strip() == "SELECT now()" else [])
+
+    def transaction(self):
+        return nullcontext()
+
+
+@pytest.fixture
+def statements(monkeypatch):
+    statements = []
+
+    @contextmanager
+    def connection():
+        yield FakeConnection(statements)
+
+    monkeypatch.setattr(calendar_mirror, "connection", connection)
+    return statements
+
+
+def test_full_sync_keeps_rows_written_after_it_started(statements, monkeypatch):
+    mirror = CalendarMirror()
+    monkeypatch.setattr(mirror, "_run_pages", lambda *args: ({"e1"}, "delta-link"))
+    mirror._full_sync("token", "acct", 30)
+    delete = next((sql, params) for sql, params in statements if sql.startswith("DELETE"))
+    assert "updated_at < %s" in delete[0]
+    assert delete[1] == ("acct", ["e1"], SYNC_START)
+
+
+def test_events_include_ones_in_progress(statements, monkeypatch):
+    mirror = CalendarMirror()
+    monkeypatch.setattr(mirror, "ensure_fresh", lambda token, days: "acct")
+    mirror.events("token", query="50%_off")
+    sql, params = statements[-1]
+    assert "coalesce(end_utc, start_utc) >= now()" in sql
+    assert "start_utc >= now()" not in sql
+    assert params["pattern"] == "%50\\%\\_off%"
@@ -0,0 +1,128 @@
+# tests/test_call_policy.py
+import asyncio
+import time
+import httpx
+import pytest
+from utils.call_policy import CallPolicy, CallRejected, TokenBucket, retry_after_seconds
+
+REQUEST = httpx.Request("POST", "https://example.test/v1")
+
+
+def responses(*items):
+    """A send() that returns (or raises) each item in turn and counts its calls."""
+    items = list(items)
+
+    def send():
+        send.calls += 1
+        item = items.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        return httpx.Response(item, request=REQUEST)
+
+    send.calls = 0
+    return send
+
+
+def policy(**kwargs):
+    options = dict(rate_per_minute=60000, backoff_base=0.0, breaker_threshold=2, breaker_cooldown=0.05)
+    options.update(kwargs)
+    return CallPolicy("test", **options)
+
+
+def test_retries_upstream_errors_until_success():
+    p = policy(breaker_threshold=3)
+    send = responses(503, httpx.ConnectError("down"), 200)
+    assert p.execute(send).status_code == 200
+    assert send.calls == 3
+    assert p.stats()["retries"] == 2 and p.stats()["circuit"] == "closed"
+
+
+def test_final_retryable_response_is_returned_and_transport_error_raised():
+    assert policy(max_retries=1, breaker_threshold=10).execute(responses(500, 502)).status_code == 502
+    with pytest.raises(httpx.ConnectError):
+        policy(max_retries=1, breaker_threshold=10).execute(responses(httpx.ConnectError("a"), httpx.ConnectError("b")))
+
+
+def test_client_errors_are_not_retried():
+    send = responses(400)
+    assert policy().execute(send).status_code == 400
+    assert send.calls == 1
+
+
+def test_retry_after_beyond_max_wait_returns_at_once():
+    p = policy(max_wait=1.0)
+
+    def send():
+        return httpx.Response(429, headers={"Retry-After": "120"}, request=REQUEST)
+
+    assert p.execute(send).status_code == 429
+    assert p.stats()["retries"] == 0
+
+
+def test_breaker_opens_then_half_opens_and_closes():
+    p = policy(max_retries=0)
+    for _ in range(2):
+        p.execute(responses(503))
+    assert p.breaker.state == "open"
+    send = responses(200)
+    with pytest.raises(CallRejected):
+        p.execute(send)
+    assert send.calls == 0
+
+    time.sleep(0.06)
+    assert p.execute(send).status_code == 200
+    assert p.breaker.state == "closed"
+
+
+def test_failed_trial_reopens_and_throttling_does_not_trip():
+    p = policy(max_retries=0)
+    for _ in range(2):
+        p.execute(responses(503))
+    time.sleep(0.06)
+    p.execute(responses(500))
+    assert p.breaker.state == "open"
+
+    q = policy(max_retries=0)
+    for _ in range(5):
+        q.execute(responses(429))
+    assert q.breaker.state == "closed"
+
+
+def test_cancelled_async_trial_frees_the_half_open_slot():
+    p = policy(max_retries=0)
+    for _ in range(2):
+        p.execute(responses(503))
+    p.breaker.cooldown = 0.0
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    async def ok():
+        return httpx.Response(200, request=REQUEST)
+
+    async def main():
+        trial = asyncio.create_task(p.aexecute(hang))
+        await asyncio.sleep(0.01)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        return await p.aexecute(ok)
+
+    assert asyncio.run(main()).status_code == 200
+    assert p.breaker.state == "closed"
+
+
+def test_token_bucket_spaces_and_rejects():
+    bucket = TokenBucket(rate=1.0, burst=2)
+    assert bucket.reserve(0) == 0.0 and bucket.reserve(0) == 0.0
+    assert bucket.reserve(5) == pytest.approx(1.0, abs=0.05)
+    with pytest.raises(CallRejected):
+        bucket.reserve(0.5)
+    assert not bucket.is_full()
+
+
+def test_retry_after_sources():
+    assert retry_after_seconds(httpx.Response(429, headers={"Retry-After": "7"}, request=REQUEST)) == 7.0
+    body = b'{"error": {"details": [{"retryDelay": "2.5s"}]}}'
+    assert retry_after_seconds(httpx.Response(429, content=body, request=REQUEST)) == 2.5
+    assert retry_after_seconds(httpx.Response(503, request=REQUEST)) is None
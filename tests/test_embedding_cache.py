@@ -0,0 +1,74 @@
+# tests/test_embedding_cache.py
+from contextlib import contextmanager
+import pytest
+import utils.db
+from utils.embedding_cache import EmbeddingCache
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """Stands in for utils.db.connection(); set .down to make every checkout fail."""
+    class Database:
+        down = False
+        checkouts = 0
+        rows = {}
+
+    class Connection:
+        def execute(self, sql, params):
+            if sql.startswith("INSERT"):
+                Database.rows[params[:2]] = params[2]
+                return None
+            row = Database.rows.get(tuple(params))
+            return type("Result", (), {"fetchone": lambda self: (row,) if row else None})()
+
+    @contextmanager
+    def connection(timeout=None):
+        Database.checkouts += 1
+        if Database.down:
+            raise OSError("connection refused")
+        yield Connection()
+
+    monkeypatch.setattr(utils.db, "connection", connection)
+    return Database
+
+
+def test_memory_tier_evicts_least_recently_used(database):
+    cache = EmbeddingCache(max_bytes=1500, persist=False)
+    cache.put("m", "a", [0.0] * 100)
+    cache.put("m", "b", [0.0] * 100)
+    assert cache.get("m", "a") is not None
+    cache.put("m", "c", [0.0] * 100)
+    assert cache.get("m", "b") is None
+    assert cache.get("m", "  a ") is not None  # normalized text shares the entry
+    assert cache.stats()["evictions"] == 1
+    assert database.checkouts == 0
+
+
+def test_persistent_tier_serves_other_processes(database):
+    EmbeddingCache().put("m", "hello", [0.5, 0.25])
+    fresh = EmbeddingCache()
+    assert fresh.get("m", "hello") == [0.5, 0.25]
+    assert fresh.stats()["db_hits"] == 1
+
+
+def test_unpersisted_vectors_never_touch_the_database(database):
+    cache = EmbeddingCache()
+    cache.put("local/x", "hello", [1.0], persist=False)
+    assert cache.get("local/x", "hello", persist=False) == [1.0]
+    assert cache.get("local/x", "other", persist=False) is None
+    assert database.checkouts == 0 and database.rows == {}
+
+
+def test_database_outage_is_skipped_until_retry(database, monkeypatch):
+    database.down = True
+    cache = EmbeddingCache()
+    for text in ("a", "b", "c"):
+        assert cache.get("m", text) is None
+    stats = cache.stats()
+    assert database.checkouts == 1
+    assert stats["db_errors"] == 1 and stats["db_skipped"] == 2 and stats["misses"] == 3
+
+    database.down = False
+    monkeypatch.setattr(cache._db_circuit, "cooldown", 0.0)
+    cache.put("m", "a", [1.0])
+    assert database.rows and cache._db_circuit.state == "closed"
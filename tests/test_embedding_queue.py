@@ -0,0 +1,78 @@
+# tests/test_embedding_queue.py
+from contextlib import contextmanager
+import pytest
+from utils import embedding_queue
+from utils.gemini_client import GeminiUnavailableError
+
+
+class FakeConnection:
+    """Records statements; the lease query returns the queued rows."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append((" ".join(query.split()), params))
+        rows = self.rows if "RETURNING id, message_text" in query else []
+        return type("Cursor", (), {"fetchall": lambda self: rows, "rowcount": len(rows)})()
+
+    def executemany(self, query, params):
+        self.statements.append((" ".join(query.split()), list(params)))
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    fake = FakeConnection([(1, "first"), (2, "second")])
+
+    @contextmanager
+    def connection():
+        yield fake
+
+    monkeypatch.setattr(embedding_queue, "connection", connection)
+    return fake
+
+
+def _statements(conn, fragment):
+    return [params for query, params in conn.statements if fragment in query]
+
+
+def test_outage_releases_leases_without_spending_attempts(conn, monkeypatch):
+    def unavailable(texts, raise_errors=False):
+        assert raise_errors
+        raise GeminiUnavailableError("circuit open: upstream unavailable")
+
+    monkeypatch.setattr(embedding_queue, "generate_embeddings", unavailable)
+    with pytest.raises(GeminiUnavailableError):
+        embedding_queue.process_batch(2)
+    assert _statements(conn, "embedding_attempts = embedding_attempts + 1") == []
+    assert _statements(conn, "SET embedding_claimed_until = NULL WHERE id = ANY") == [([1, 2],)]
+
+
+def test_only_rows_without_a_vector_spend_an_attempt(conn, monkeypatch):
+    monkeypatch.setattr(embedding_queue, "generate_embeddings",
+                        lambda texts, raise_errors=False: [[0.1] * 768, None])
+    assert embedding_queue.process_batch(2) == (1, 1)
+    written = _statements(conn, "SET embedding = %(embedding)s")
+    assert [row["id"] for row in written[0]] == [1]
+    assert _statements(conn, "embedding_attempts = embedding_attempts + 1") == [([2],)]
+
+
+def test_nothing_pending(monkeypatch):
+    fake = FakeConnection([])
+
+    @contextmanager
+    def connection():
+        yield fake
+
+    monkeypatch.setattr(embedding_queue, "connection", connection)
+    monkeypatch.setattr(embedding_queue, "generate_embeddings", pytest.fail)
+    assert embedding_queue.process_batch(10) == (0, 0)
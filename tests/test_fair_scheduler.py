@@ -0,0 +1,102 @@
+# tests/test_fair_scheduler.py
+import asyncio
+import pytest
+from utils.fair_scheduler import FairScheduler, ServerBusy, parse_weights
+
+
+def scheduler(capacity=1, max_queued=10, max_wait=5.0, weights=None):
+    return FairScheduler(capacity, max_queued, max_wait, rate_per_minute=6000, burst=100, weights=weights)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_cancelled_waiter_frees_its_place_in_the_queue():
+    async def main():
+        s = scheduler()
+        async with s.slot("a"):
+            task = asyncio.create_task(s._acquire("b", 1))
+            await settle()
+            assert s.waiting == 1
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert s.waiting == 0 and s.stats()["users_waiting"] == 0
+        assert s.in_flight == 0
+        async with s.slot("c"):
+            assert s.in_flight == 1
+    asyncio.run(main())
+
+
+def test_dispatch_skips_waiter_cancelled_before_withdrawing():
+    async def main():
+        s = scheduler()
+        async with s.slot("a"):
+            b = asyncio.create_task(s._acquire("b", 1))
+            await settle()
+            c = asyncio.create_task(s._acquire("c", 1))
+            await settle()
+            # What wait_for does on timeout, before b's except clause gets to run
+            s._heap[0][2].future.cancel()
+        await c
+        assert s.in_flight == 1 and s.waiting == 0
+        with pytest.raises(asyncio.CancelledError):
+            await b
+        s._release()
+        assert s.in_flight == 0
+    asyncio.run(main())
+
+
+def test_queue_timeout_and_full_queue_are_busy():
+    async def main():
+        s = scheduler(max_queued=1, max_wait=0.05)
+        async with s.slot("a"):
+            waiter = asyncio.create_task(s._acquire("b", 1))
+            await settle()
+            with pytest.raises(ServerBusy) as full:
+                await s._acquire("c", 1)
+            assert full.value.reason == "busy"
+            with pytest.raises(ServerBusy):
+                await waiter
+        stats = s.stats()
+        assert stats["queue_full"] == 1 and stats["timed_out"] == 1
+        assert stats["waiting"] == 0 and stats["in_flight"] == 0
+    asyncio.run(main())
+
+
+def test_backlogged_user_does_not_starve_others():
+    async def main():
+        s = scheduler()
+        order = []
+
+        async def run(user):
+            async with s.slot(user):
+                order.append(user)
+
+        async with s.slot("hog"):
+            tasks = [asyncio.create_task(run("hog")) for _ in range(3)]
+            await settle()
+            tasks.append(asyncio.create_task(run("other")))
+            await settle()
+        await asyncio.gather(*tasks)
+        assert order.index("other") <= 1
+    asyncio.run(main())
+
+
+def test_over_quota_user_is_rate_limited():
+    async def main():
+        s = FairScheduler(4, 10, 0.1, rate_per_minute=1, burst=1)
+        async with s.slot("a"):
+            pass
+        with pytest.raises(ServerBusy) as limited:
+            await s._acquire("a", 1)
+        assert limited.value.reason == "rate_limited"
+        async with s.slot("b"):
+            pass
+    asyncio.run(main())
+
+
+def test_parse_weights():
+    assert parse_weights("alice=2, batch-bot=0.25,,") == {"alice": 2.0, "batch-bot": 0.25}
@@ -0,0 +1,94 @@
+# tests/test_intent_router.py
+import datetime
+import os
+import pytest
+from utils import intent_router
+from utils.intent_router import classify, evaluate, extract_slots
+
+TODAY = datetime.date(2025, 5, 11)
+EVAL_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "data", "intent_eval.jsonl")
+
+
+def route(text):
+    analysis, _ = classify(text, today=TODAY)
+    return analysis
+
+
+@pytest.mark.parametrize("text", [
+    "yes", "confirm", "looks good", "ok go ahead", "yes that's correct", "yep that's correct",
+    "sure, everything looks fine",
+])
+def test_explicit_confirmations_route(text):
+    assert route(text) == {"intent": "confirm_event", "facts": []}
+
+
+@pytest.mark.parametrize("text", [
+    "that's not correct", "not correct", "that's incorrect", "no don't create it",
+    "the information is not correct", "is that correct?", "yes that's incorrect",
+    "correct the time please", "yes, but change the location", "ok wait", "yes?", "no",
+])
+def test_negated_or_questioned_confirmations_fall_through(text):
+    # confirm_event creates the pending Outlook event, so anything but a plain "yes" goes to Gemini
+    assert route(text) is None
+
+
+def test_confirm_is_never_taken_from_the_centroid(monkeypatch):
+    classifier = intent_router.get_classifier()
+    monkeypatch.setattr(classifier, "scores", lambda text: {"confirm_event": 0.99, "general": 0.1})
+    analysis, details = classify("the details are fine i guess", today=TODAY)
+    assert analysis is None
+    assert details["source"] == "unconfirmed"
+
+
+def test_create_anywhere_in_the_sentence():
+    analysis = route("can you schedule a meeting with Bob at 2pm tomorrow")
+    assert analysis["intent"] == "create_event"
+    assert analysis["subject"] == "Meeting with Bob"
+    assert analysis["start_time"] == "2025-05-12T14:00:00"
+    assert analysis["end_time"] == "2025-05-12T15:00:00"
+
+
+@pytest.mark.parametrize("text, end", [
+    ("create a meeting with Bob tomorrow at 2pm for 30 minutes", "2025-05-12T14:30:00"),
+    ("book a call with Sara on 2025-05-14 at 10am for 2 hours", "2025-05-14T12:00:00"),
+    ("schedule a meeting with Ann tomorrow at 9am for an hour", "2025-05-12T10:00:00"),
+])
+def test_duration_sets_the_end(text, end):
+    assert route(text)["end_time"] == end
+
+
+@pytest.mark.parametrize("text", [
+    "create a meeting with Bob tomorrow at 2pm for an hour and a half",
+    "create meeting with Ali at 3pm on 13/05/2025",
+    "schedule a meeting with Bob next friday at 10am",
+    "book a call with Omar at 3 tomorrow",
+    "cancel my meeting with Sara",
+    "move my meeting with John to 4pm",
+    "I'm Tom, schedule a meeting with Jane at 4pm tomorrow",
+])
+def test_unparsed_or_unsupported_requests_fall_through(text):
+    assert route(text) is None
+
+
+def test_listing_keeps_the_attendee_filter():
+    assert route("show all events with Ali") == {"intent": "get_event_details", "query": "Ali", "facts": []}
+    assert route("list all events") == {"intent": "list_all_events", "facts": []}
+    assert route("show my meetings tomorrow")["query"] == "2025-05-12"
+
+
+def test_fact_cue_matches_whole_words():
+    analysis, details = classify("I am Sarah", today=TODAY)
+    assert analysis is None and details["source"] == "fact_cue"
+
+
+def test_extract_slots_flags_unparsed_dates():
+    assert extract_slots("at 3pm on 13/05/2025", TODAY)["unresolved"]
+    slots = extract_slots("at 3pm on 5/13/2025", TODAY)
+    assert "unresolved" not in slots
+    assert slots["datetimes"] == ["2025-05-13T15:00:00"]
+
+
+def test_eval_set_never_routes_a_negative():
+    report = evaluate(EVAL_PATH)
+    assert report["errors"] == []
+    assert report["routed"] > 0
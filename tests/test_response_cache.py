@@ -0,0 +1,59 @@
+# tests/test_response_cache.py
+import pytest
+from utils.response_cache import ResponseCache, is_cacheable_query
+
+X, Y, Z = [1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]
+
+
+def test_hits_are_per_user_and_by_similarity():
+    cache = ResponseCache(threshold=0.95)
+    cache.store("alice", "capital of France?", X, "Paris")
+    assert cache.lookup("alice", [0.99, 0.05, 0.0]) == "Paris"
+    assert cache.lookup("alice", Y) is None
+    assert cache.lookup("bob", X) is None
+
+
+def test_per_user_eviction_is_lru():
+    cache = ResponseCache(max_per_user=2)
+    cache.store("alice", "x", X, "x")
+    cache.store("alice", "y", Y, "y")
+    assert cache.lookup("alice", X) == "x"
+    cache.store("alice", "z", Z, "z")
+    assert cache.lookup("alice", Y) is None
+    assert cache.lookup("alice", X) == "x" and cache.lookup("alice", Z) == "z"
+
+
+def test_global_eviction_spans_users():
+    cache = ResponseCache(max_entries=2)
+    cache.store("alice", "x", X, "x")
+    cache.store("bob", "y", Y, "y")
+    cache.store("carol", "z", Z, "z")
+    assert cache.lookup("alice", X) is None
+    assert cache.stats()["users"] == 2 and cache.stats()["evictions"] == 1
+
+
+def test_expired_entries_are_dropped():
+    cache = ResponseCache(ttl=0.0)
+    cache.store("alice", "x", X, "x")
+    assert cache.lookup("alice", X) is None
+    assert cache.stats()["expirations"] == 1 and cache.stats()["entries"] == 0
+
+
+def test_invalidate_by_profile_key():
+    cache = ResponseCache()
+    cache.store("alice", "my hobby?", X, "chess", depends_on=["hobby"])
+    cache.store("alice", "capital?", Y, "Paris")
+    cache.invalidate("alice", ["hobby"])
+    assert cache.lookup("alice", X) is None and cache.lookup("alice", Y) == "Paris"
+    cache.invalidate("alice")
+    assert cache.stats()["entries"] == 0
+
+
+@pytest.mark.parametrize("text, cacheable", [
+    ("What is the capital of France?", True),
+    ("What's the weather today?", False),
+    ("why is that?", False),
+    ("Do I have meetings tomorrow?", False),
+])
+def test_is_cacheable_query(text, cacheable):
+    assert is_cacheable_query(text) is cacheable
@@ -0,0 +1,98 @@
+# tests/test_schema.py
+from contextlib import contextmanager
+import sys
+import numpy as np
+import pytest
+from utils import schema
+
+
+class FakeCursor:
+    """Answers the queries quantization_report makes; index sizes come from `indexes`."""
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+        self.sized = []
+        self._result = None
+
+    def execute(self, query, params=None):
+        text = query if isinstance(query, str) else repr(query)
+        if "information_schema.columns" in text:
+            self._result = [("embedding_half",)]
+        elif "ORDER BY random()" in text:
+            self._result = [("u1", np.zeros(3))]
+        elif "avg(pg_column_size" in text:
+            self._result = [(3076.0, 1540.0)]
+        elif "pg_relation_size" in text:
+            self.sized.append(params[0])
+            self._result = [(self.indexes.get(params[0]),)]
+        else:
+            self._result = []
+
+    def fetchall(self):
+        return self._result
+
+    def fetchone(self):
+        return self._result[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, cur):
+        self.cur = cur
+
+    def cursor(self):
+        return self.cur
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+
+@pytest.fixture
+def report_db(monkeypatch):
+    def install(indexes):
+        cur = FakeCursor(indexes)
+
+        @contextmanager
+        def connection():
+            yield FakeConnection(cur)
+
+        monkeypatch.setattr(schema, "connection", connection)
+        monkeypatch.setattr(schema, "apply_search_settings", lambda cur: None)
+        monkeypatch.setattr(schema, "search_user_messages", lambda cur, user, query, k, storage: [(1,), (2,)])
+        return cur
+    return install
+
+
+def test_missing_indexes_are_reported_as_absent(report_db, monkeypatch):
+    monkeypatch.setattr(schema, "VECTOR_INDEX_TYPE", "hnsw")
+    report_db({schema.HALFVEC_INDEX: 4096})
+    report = schema.quantization_report(sample=1)
+    assert set(report) == {"full", "halfvec"}
+    assert report["full"]["index_bytes"] is None
+    assert report["halfvec"]["index_bytes"] == 4096
+    assert report["halfvec"]["recall"] == 1.0
+
+
+def test_full_index_name_follows_the_index_type(report_db, monkeypatch):
+    monkeypatch.setattr(schema, "VECTOR_INDEX_TYPE", "ivfflat")
+    cur = report_db({schema.IVFFLAT_INDEX: 8192})
+    report = schema.quantization_report(sample=1)
+    assert schema.IVFFLAT_INDEX in cur.sized and schema.HNSW_INDEX not in cur.sized
+    assert report["full"]["index_bytes"] == 8192
+
+
+def test_quant_report_prints_absent_indexes(monkeypatch, capsys):
+    monkeypatch.setattr(schema, "quantization_report", lambda sample, top_k: {
+        "full": {"recall": 1.0, "avg_column_bytes": 3076.0, "index_bytes": None},
+        "binary": {"recall": None, "avg_column_bytes": 100.0, "index_bytes": 2_000_000},
+    })
+    monkeypatch.setattr(sys, "argv", ["schema", "quant-report"])
+    schema.main()
+    out = capsys.readouterr().out
+    assert "absent" in out and "2.0" in out and "n/a" in out
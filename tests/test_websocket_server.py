@@ -0,0 +1,91 @@
+# tests/test_websocket_server.py
+import asyncio
+import json
+import types
+import pytest
+import websockets
+import websocket_server
+from utils.sessions import session_table
+
+
+class FakeWebSocket:
+    """Feeds queued client frames to handle_client and records what the server sends."""
+
+    def __init__(self, frames, remote_address=("127.0.0.1", 50000), path="/"):
+        self.remote_address = remote_address
+        self.request = types.SimpleNamespace(path=path)
+        self.frames = list(frames)
+        self.sent = []
+
+    async def recv(self):
+        await asyncio.sleep(0.05)  # let earlier requests finish before the next frame
+        if not self.frames:
+            raise websockets.exceptions.ConnectionClosedOK(None, None)
+        return self.frames.pop(0)
+
+    async def send(self, frame):
+        self.sent.append(frame)
+
+    async def wait_closed(self):
+        await asyncio.Event().wait()
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    async def generate(prompt, **kwargs):
+        return "Bot: hello there"
+
+    async def stream(prompt, **kwargs):
+        for word in ("hello ", "there"):
+            yield word
+
+    monkeypatch.setattr(websocket_server, "agenerate_content", generate)
+    monkeypatch.setattr(websocket_server, "astream_generate_content", stream)
+
+
+def serve(frames, **kwargs):
+    websocket = FakeWebSocket(frames, **kwargs)
+    asyncio.run(websocket_server.handle_client(websocket))
+    return websocket.sent
+
+
+def test_legacy_client_gets_one_frame_per_reply(gemini):
+    # The baseline client contract: one recv() per message
+    assert not websocket_server.WS_STREAMING
+    assert serve(["hi", "again"]) == ["hello there", "hello there"]
+
+
+def test_protocol_streams_only_on_request(gemini):
+    sent = [json.loads(frame) for frame in serve([
+        json.dumps({"type": "request", "id": "a", "message": "hi"}),
+        json.dumps({"type": "request", "id": "b", "message": "hi", "stream": True}),
+    ])]
+    assert sent[0] == {"type": "reply", "id": "a", "text": "hello there"}
+    assert [frame["type"] for frame in sent[1:]] == ["chunk", "chunk", "reply"]
+
+
+@pytest.mark.parametrize("bad_id", [["x"], {"a": 1}, True, 1.5])
+def test_frames_with_unusable_ids_are_rejected(gemini, bad_id):
+    sent = [json.loads(frame) for frame in serve([
+        json.dumps({"type": "request", "id": bad_id, "message": "hi"}),
+        json.dumps({"type": "ping", "id": 7}),
+    ])]
+    assert sent[0]["error"] == "bad_request" and sent[0]["id"] is None
+    assert sent[1] == {"type": "pong", "id": 7}
+
+
+def test_untrusted_clients_are_scheduled_by_address():
+    session = types.SimpleNamespace(ephemeral=False, session_id="s1")
+    remote = FakeWebSocket([], remote_address=("203.0.113.9", 1), path="/?user=alice&session=s1")
+    local = FakeWebSocket([], remote_address=("127.0.0.1", 1), path="/?user=alice&session=s1")
+    assert websocket_server._user_key(remote, session) == "203.0.113.9"
+    assert websocket_server._user_key(local, session) == "alice"
+
+
+def test_sessions_are_released(gemini):
+    before = session_table.stats()["connected"]
+    serve(["hi"], path="/?session=test-release")
+    assert session_table.stats()["connected"] == before
@@ -0,0 +1,73 @@
+# tests/test_ws_client.py
+import asyncio
+import pytest
+from utils import ws_client
+from utils.ws_client import WSClient
+
+URL = "ws://localhost:1/?session=s1"
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    clients = {}
+    monkeypatch.setattr(ws_client, "_clients", clients)
+    return clients
+
+
+async def reap_once(monkeypatch):
+    monkeypatch.setattr(ws_client, "WS_CLIENT_REAP_SECONDS", 0.01)
+    monkeypatch.setattr(ws_client, "WS_CLIENT_IDLE_TIMEOUT", 0.0)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(ws_client._reap_idle(), 0.05)
+
+
+def test_reaper_drops_idle_clients_but_not_busy_ones(clients, monkeypatch):
+    idle, busy = WSClient(URL, None), WSClient(URL + "2", None)
+    busy._pending["r1"] = None
+    clients.update({idle.url: idle, busy.url: busy})
+    asyncio.run(reap_once(monkeypatch))
+    assert list(clients) == [busy.url]
+    assert idle._reaped and idle._closed and not busy._reaped
+
+
+def test_reaped_client_never_reconnects(monkeypatch):
+    async def connect(*args, **kwargs):
+        raise AssertionError("reaped client opened a connection")
+
+    monkeypatch.setattr(ws_client.websockets, "connect", connect)
+    client = WSClient(URL, None)
+    client._reaped = True
+    with pytest.raises(ConnectionError):
+        asyncio.run(client._connection())
+
+
+def test_handshake_finishing_after_reap_is_closed(monkeypatch):
+    class FakeWebSocket:
+        closed = False
+
+        async def close(self):
+            self.closed = True
+
+    ws = FakeWebSocket()
+
+    async def connect(*args, **kwargs):
+        client._reaped = True  # the reaper ran while the handshake was in flight
+        return ws
+
+    monkeypatch.setattr(ws_client.websockets, "connect", connect)
+    client = WSClient(URL, None)
+    with pytest.raises(ConnectionError):
+        asyncio.run(client._connection())
+    assert ws.closed and client._ws is None
+
+
+def test_send_on_reaped_client_goes_through_current_client(monkeypatch):
+    class Current:
+        def send(self, message, on_token=None, timeout=None):
+            return f"sent {message}"
+
+    monkeypatch.setattr(ws_client, "get_client", lambda url: Current())
+    stale = WSClient(URL, None)
+    stale._reaped = True
+    assert stale.send("hi") == "sent hi"
+    assert stale.stats()["requests"] == 0
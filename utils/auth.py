@@ -1,4 +1,7 @@
 import os
+import asyncio
+import datetime
+import threading
 import requests
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
@@ -13,53 +16,157 @@ load_dotenv()
 
 CLIENT_SECRET_FILE = os.getenv("CLIENT_SECRET_FILE", "client_secret.json")
 SCOPES = ['https://www.googleapis.com/auth/generative-language.retriever']
+# Refresh this many seconds before the access token expires
+GEMINI_TOKEN_REFRESH_MARGIN = float(os.getenv("GEMINI_TOKEN_REFRESH_MARGIN", "300"))
 
 def authenticate_with_google():
-    credentials = None
-    # Temporarily force re-authentication
-    credentials = None
-    if not credentials or not credentials.valid:
-        if credentials and credentials.expired and credentials.refresh_token:
-            credentials.refresh(Request())
-        else:
-            print(f"Using client secret file: {CLIENT_SECRET_FILE}")
-            flow = InstalledAppFlow.from_client_secrets_file(
-                CLIENT_SECRET_FILE,
-                scopes=SCOPES
-            )
-            credentials = flow.run_local_server(port=8888)
-
-        with open(TOKEN_FILE, 'w') as token:
-            token.write(credentials.to_json())
-
+    """Run the interactive OAuth flow and cache the resulting credentials."""
+    print(f"Using client secret file: {CLIENT_SECRET_FILE}")
+    flow = InstalledAppFlow.from_client_secrets_file(
+        CLIENT_SECRET_FILE,
+        scopes=SCOPES
+    )
+    credentials = flow.run_local_server(port=8888)
+    token_provider.set_credentials(credentials)
     return credentials
 
-def get_access_token():
-    """Fetch or refresh the current access token, and re-authenticate if needed."""
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'r') as token_file:
-            credentials = Credentials.from_authorized_user_info(json.load(token_file))
 
-            if credentials and credentials.valid:
-                return credentials.token
-            elif credentials and credentials.expired and credentials.refresh_token:
-                credentials.refresh(Request())
-                save_credentials(credentials)
-                return credentials.token
+class TokenProvider:
+    """
+    In-memory holder for the Gemini OAuth credentials.
+
+    token.json is read once; afterwards get_credentials() returns the cached
+    credentials until they are within refresh_margin seconds of expiring. The
+    refresh runs under a lock, so concurrent callers wait for one refresh
+    instead of each hitting the token endpoint, and the token file is only
+    rewritten when the serialized credentials actually change.
+
+    invalidate() remembers the rejected access token: it never counts as fresh
+    again, even when reloaded from token.json, so the next call refreshes it
+    (and rewrites token.json) instead of resending it.
+    """
+
+    def __init__(self, token_file: str = TOKEN_FILE, refresh_margin: float = GEMINI_TOKEN_REFRESH_MARGIN):
+        self.token_file = token_file
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)
+        self._credentials = None
+        self._saved_json = None
+        self._rejected_token = None
+        self._lock = threading.Lock()
+        self._auth_lock = threading.Lock()
+        self.refreshes = 0
+
+    def _fresh(self, credentials) -> bool:
+        if not credentials or not credentials.token or credentials.token == self._rejected_token:
+            return False
+        if credentials.expiry is None:
+            return credentials.valid
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return credentials.expiry - now > self.refresh_margin
+
+    def _load(self):
+        if not os.path.exists(self.token_file):
+            return None
+        try:
+            with open(self.token_file, 'r') as token_file:
+                credentials = Credentials.from_authorized_user_info(json.load(token_file))
+            self._saved_json = credentials.to_json()
+            return credentials
+        except Exception as e:
+            print(f"Error loading credentials from token file: {e}")
+            return None
+
+    def _save(self, credentials):
+        data = credentials.to_json()
+        if data == self._saved_json:
+            return
+        try:
+            with open(self.token_file, 'w') as token_file:
+                token_file.write(data)
+            self._saved_json = data
+        except Exception as e:
+            print(f"Error saving credentials to token file: {e}")
+
+    def set_credentials(self, credentials):
+        with self._lock:
+            self._credentials = credentials
+            self._save(credentials)
 
-    # If we reach here, no valid token → perform authentication flow
-    credentials = authenticate_with_google()
-    if credentials and credentials.valid:
-        return credentials.token
-    return None
+    def get_credentials(self, interactive: bool = True):
+        """Return valid credentials, refreshing (single-flight) or re-authenticating if needed."""
+        credentials = self._credentials
+        if self._fresh(credentials):
+            return credentials
+
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            credentials = self._credentials
+            if self._fresh(credentials):
+                return credentials
+            if credentials is None:
+                credentials = self._load()
+            if credentials and not self._fresh(credentials) and credentials.refresh_token:
+                try:
+                    credentials.refresh(Request())
+                    self.refreshes += 1
+                except Exception as e:
+                    print(f"Error refreshing credentials: {e}")
+            if credentials and credentials.valid and credentials.token != self._rejected_token:
+                self._credentials = credentials
+                self._save(credentials)
+                return credentials
+            self._credentials = None
+
+        # No usable token: fall back to the interactive flow (outside the lock,
+        # since it blocks on the browser and stores its result via set_credentials)
+        if not interactive:
+            return None
+        with self._auth_lock:
+            # Only one browser flow at a time; later callers reuse its result
+            if self._fresh(self._credentials):
+                return self._credentials
+            try:
+                return authenticate_with_google()
+            except Exception as e:
+                print(f"OAuth2 authentication failed: {e}")
+                return None
+
+    def get_token(self):
+        credentials = self.get_credentials()
+        return credentials.token if credentials and credentials.valid and credentials.token != self._rejected_token else None
+
+    async def aget_token(self):
+        """get_token() for event loops: a fresh cached token is returned inline; refreshes run in a thread."""
+        credentials = self._credentials
+        if self._fresh(credentials):
+            return credentials.token
+        return await asyncio.to_thread(self.get_token)
+
+    def invalidate(self):
+        """The API rejected the current access token: forget it and force a refresh on the next call."""
+        with self._lock:
+            credentials = self._credentials or self._load()
+            if credentials and credentials.token:
+                self._rejected_token = credentials.token
+            self._credentials = None
+            self._saved_json = None
+
+
+token_provider = TokenProvider()
+
+
+def get_access_token():
+    """Fetch or refresh the current access token, and re-authenticate if needed."""
+    return token_provider.get_token()
 
 
 def save_credentials(credentials):
     """Save the credentials to token.json"""
-    with open(TOKEN_FILE, 'w') as token_file:
-        token_file.write(credentials.to_json())  
+    token_provider.set_credentials(credentials)
 
 def logout():
     """Logout by deleting the token.json file"""
+    token_provider.invalidate()
     if os.path.exists(TOKEN_FILE):
-        os.remove(TOKEN_FILE)
\ No newline at end of file
+        os.remove(TOKEN_FILE)
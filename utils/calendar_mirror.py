@@ -0,0 +1,333 @@
+# utils/calendar_mirror.py
+"""
+Local Postgres mirror of each mailbox's calendar, kept current with Microsoft
+Graph's calendarView/delta.
+
+The first read for an account runs a full sync over a window from
+CALENDAR_WINDOW_PAST_DAYS ago to CALENDAR_WINDOW_DAYS ahead and stores the
+returned delta link in calendar_sync_state (see utils/schema.py). After that,
+reads are served from calendar_events. A read that finds the mirror older
+than CALENDAR_SYNC_INTERVAL starts an incremental sync from the stored delta
+link in the background and answers from the current rows. Events created
+through the app are written through with upsert_event(), so they show up
+before the next delta.
+
+Two things start a full resync:
+- the window no longer covers the read range;
+- Graph rejects the delta link (410 Gone).
+A full resync upserts page by page and only deletes rows it did not see once
+the final page is in, so readers never see an empty calendar. Rows written
+since the resync started (say, an event created through the app meanwhile)
+are kept even if Graph's pages predate them.
+Recurring series are expanded into occurrences, as calendarView does.
+
+    python -m utils.calendar_mirror --stats
+"""
+import argparse
+import base64
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from psycopg.types.json import Jsonb
+from dotenv import load_dotenv
+from utils.db import connection
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+CALENDAR_MIRROR_ENABLED = os.getenv("CALENDAR_MIRROR_ENABLED", "true").lower() == "true"
+CALENDAR_SYNC_INTERVAL = float(os.getenv("CALENDAR_SYNC_INTERVAL", "60"))
+CALENDAR_WINDOW_PAST_DAYS = int(os.getenv("CALENDAR_WINDOW_PAST_DAYS", "1"))
+CALENDAR_WINDOW_DAYS = int(os.getenv("CALENDAR_WINDOW_DAYS", "90"))
+CALENDAR_PAGE_SIZE = int(os.getenv("CALENDAR_PAGE_SIZE", "100"))
+
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+_HTTP_TIMEOUT = 30
+
+
+class DeltaExpired(Exception):
+    """Graph no longer accepts the stored delta link; a full resync is needed."""
+
+
+def _utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _graph_time(value: datetime.datetime) -> str:
+    return value.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_event_time(value: dict):
+    """A Graph dateTimeTimeZone (requested in UTC) as an aware datetime, or None."""
+    text = (value or {}).get("dateTime")
+    if not text:
+        return None
+    parsed = datetime.datetime.fromisoformat(text.replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+class CalendarMirror:
+    def __init__(self, sync_interval: float = CALENDAR_SYNC_INTERVAL, window_past_days: int = CALENDAR_WINDOW_PAST_DAYS,
+                 window_days: int = CALENDAR_WINDOW_DAYS, page_size: int = CALENDAR_PAGE_SIZE):
+        self.sync_interval = sync_interval
+        self.window_past_days = window_past_days
+        self.window_days = window_days
+        self.page_size = page_size
+        self._http = requests.Session()
+        self._accounts = {}
+        self._sync_locks = {}
+        self._syncing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="calendar-sync")
+        self._stats = {"full_syncs": 0, "delta_syncs": 0, "changes": 0, "removals": 0,
+                       "written_through": 0, "sync_errors": 0, "reads": 0}
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _headers(self, access_token: str) -> dict:
+        return {
+            "Authorization": f"Bearer {access_token}",
+            "Prefer": f'outlook.timezone="UTC", odata.maxpagesize={self.page_size}',
+        }
+
+    def account_id(self, access_token: str) -> str:
+        """The mailbox a token belongs to: its oid claim, else /me's id (cached per token)."""
+        key = hashlib.sha256(access_token.encode()).hexdigest()
+        account = self._accounts.get(key)
+        if account:
+            return account
+        try:
+            payload = access_token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            account = claims.get("oid") or claims.get("preferred_username")
+        except (IndexError, ValueError):
+            account = None
+        if not account:
+            # Tokens are opaque to clients in general; ask Graph who this is
+            response = self._http.get(f"{GRAPH_URL}/me", params={"$select": "id"},
+                                      headers=self._headers(access_token), timeout=_HTTP_TIMEOUT)
+            response.raise_for_status()
+            account = response.json()["id"]
+        with self._lock:
+            if len(self._accounts) > 1000:
+                self._accounts.clear()
+            self._accounts[key] = account
+        return account
+
+    def _state(self, account: str):
+        with connection() as conn:
+            return conn.execute("""
+                SELECT delta_link, window_start, window_end, extract(epoch FROM now() - synced_at)
+                FROM calendar_sync_state WHERE account_id = %s
+            """, (account,)).fetchone()
+
+    def _needs_full_sync(self, state, read_days: int) -> bool:
+        if state is None or not state[0]:
+            return True
+        now = _utcnow()
+        _, window_start, window_end, _ = state
+        return window_end < now + datetime.timedelta(days=read_days + 1) or window_start > now
+
+    def _apply(self, account: str, items: list) -> set:
+        """Upsert changed events and delete removed ones; returns the ids still present."""
+        seen, changed, removed = set(), [], []
+        for item in items:
+            if "@removed" in item:
+                removed.append(item["id"])
+                continue
+            seen.add(item["id"])
+            changed.append((account, item["id"], item.get("subject"), parse_event_time(item.get("start")),
+                            parse_event_time(item.get("end")), Jsonb(item)))
+        with connection() as conn:
+            with conn.transaction(), conn.cursor() as cur:
+                if changed:
+                    cur.executemany("""
+                        INSERT INTO calendar_events (account_id, event_id, subject, start_utc, end_utc, data, updated_at)
+                        VALUES (%s, %s, %s, %s, %s, %s, now())
+                        ON CONFLICT (account_id, event_id) DO UPDATE
+                        SET subject = EXCLUDED.subject, start_utc = EXCLUDED.start_utc,
+                            end_utc = EXCLUDED.end_utc, data = EXCLUDED.data, updated_at = now()
+                    """, changed)
+                if removed:
+                    cur.execute("DELETE FROM calendar_events WHERE account_id = %s AND event_id = ANY(%s)",
+                                (account, removed))
+        self._count("changes", len(changed))
+        self._count("removals", len(removed))
+        return seen
+
+    def _pages(self, access_token: str, url: str, params: dict = None):
+        """Yield each page's items; returns the final delta link."""
+        delta_link = None
+        while url:
+            response = self._http.get(url, params=params, headers=self._headers(access_token), timeout=_HTTP_TIMEOUT)
+            if response.status_code == 410:
+                raise DeltaExpired(response.text)
+            response.raise_for_status()
+            data = response.json()
+            yield data.get("value", [])
+            params = None  # next and delta links carry their own query
+            url = data.get("@odata.nextLink")
+            delta_link = data.get("@odata.deltaLink")
+        return delta_link
+
+    def _run_pages(self, access_token: str, account: str, url: str, params: dict = None):
+        pages = self._pages(access_token, url, params)
+        seen = set()
+        while True:
+            try:
+                items = next(pages)
+            except StopIteration as done:
+                return seen, done.value
+            seen |= self._apply(account, items)
+
+    def sync(self, access_token: str, read_days: int = 30, full: bool = False):
+        """Bring the mirror for this token's mailbox up to date (delta if possible, else full)."""
+        account = self.account_id(access_token)
+        with self._lock:
+            lock = self._sync_locks.setdefault(account, threading.Lock())
+        with lock:
+            state = self._state(account)
+            if not full and not self._needs_full_sync(state, read_days):
+                try:
+                    _, delta_link = self._run_pages(access_token, account, state[0])
+                    self._save_state(account, delta_link, state[1], state[2])
+                    self._count("delta_syncs")
+                    return
+                except DeltaExpired:
+                    logger.info("Calendar delta link for %s expired; running a full sync.", account)
+            self._full_sync(access_token, account, read_days)
+
+    def _full_sync(self, access_token: str, account: str, read_days: int):
+        with connection() as conn:
+            # Database clock, as updated_at is set from now() there
+            sync_started = conn.execute("SELECT now()").fetchone()[0]
+        now = _utcnow()
+        window_start = now - datetime.timedelta(days=self.window_past_days)
+        window_end = now + datetime.timedelta(days=max(self.window_days, read_days + 1))
+        seen, delta_link = self._run_pages(access_token, account, f"{GRAPH_URL}/me/calendarView/delta", {
+            "startDateTime": _graph_time(window_start),
+            "endDateTime": _graph_time(window_end),
+        })
+        with connection() as conn:
+            with conn.transaction():
+                # Rows from before this sync that Graph no longer returns
+                conn.execute("""
+                    DELETE FROM calendar_events
+                    WHERE account_id = %s AND NOT (event_id = ANY(%s)) AND updated_at < %s
+                """, (account, list(seen), sync_started))
+                self._save_state(account, delta_link, window_start, window_end, conn)
+        self._count("full_syncs")
+
+    def _save_state(self, account, delta_link, window_start, window_end, conn=None):
+        statement = """
+            INSERT INTO calendar_sync_state (account_id, delta_link, window_start, window_end, synced_at)
+            VALUES (%s, %s, %s, %s, now())
+            ON CONFLICT (account_id) DO UPDATE
+            SET delta_link = EXCLUDED.delta_link, window_start = EXCLUDED.window_start,
+                window_end = EXCLUDED.window_end, synced_at = now()
+        """
+        params = (account, delta_link, window_start, window_end)
+        if conn is not None:
+            conn.execute(statement, params)
+            return
+        with connection() as conn:
+            conn.execute(statement, params)
+
+    def _background_sync(self, access_token: str, account: str, read_days: int):
+        try:
+            self.sync(access_token, read_days)
+        except Exception as e:
+            self._count("sync_errors")
+            logger.warning("Background calendar sync for %s failed: %s", account, e)
+        finally:
+            with self._lock:
+                self._syncing.discard(account)
+
+    def ensure_fresh(self, access_token: str, read_days: int = 30) -> str:
+        """
+        Make the mirror readable for this mailbox and return its account id: sync
+        inline if it has never synced (or the window no longer fits), otherwise
+        start a background delta sync when it is older than sync_interval.
+        """
+        account = self.account_id(access_token)
+        state = self._state(account)
+        if self._needs_full_sync(state, read_days):
+            self.sync(access_token, read_days)
+            return account
+        if state[3] is not None and state[3] >= self.sync_interval:
+            with self._lock:
+                start = account not in self._syncing
+                self._syncing.add(account)
+            if start:
+                self._executor.submit(self._background_sync, access_token, account, read_days)
+        return account
+
+    def events(self, access_token: str, query: str = None, days: int = 30, limit: int = 100) -> list:
+        """
+        Events (Graph event dicts) in progress or starting in the next `days`,
+        optionally matching subject or attendee name.
+        """
+        account = self.ensure_fresh(access_token, days)
+        self._count("reads")
+        sql = """
+            SELECT data FROM calendar_events
+            WHERE account_id = %(account)s AND coalesce(end_utc, start_utc) >= now()
+              AND start_utc <= now() + make_interval(days => %(days)s)
+        """
+        params = {"account": account, "days": days, "limit": limit}
+        if query:
+            sql += """
+              AND (lower(subject) LIKE %(pattern)s OR EXISTS (
+                  SELECT 1 FROM jsonb_array_elements(coalesce(data->'attendees', '[]'::jsonb)) attendee
+                  WHERE lower(attendee->'emailAddress'->>'name') LIKE %(pattern)s))
+            """
+            escaped = query.lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params["pattern"] = f"%{escaped}%"
+        sql += " ORDER BY start_utc LIMIT %(limit)s"
+        with connection() as conn:
+            return [row[0] for row in conn.execute(sql, params).fetchall()]
+
+    def upsert_event(self, access_token: str, event: dict):
+        """Write through an event Graph just returned (e.g. from a create), ahead of the next delta."""
+        self._apply(self.account_id(access_token), [event])
+        self._count("written_through")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["syncing"] = len(self._syncing)
+        return stats
+
+
+def mirror_stats() -> dict:
+    """Mirrored events and sync age per account."""
+    with connection() as conn:
+        rows = conn.execute("""
+            SELECT s.account_id, count(e.event_id), extract(epoch FROM now() - s.synced_at)
+            FROM calendar_sync_state s LEFT JOIN calendar_events e USING (account_id)
+            GROUP BY s.account_id, s.synced_at
+        """).fetchall()
+    return {account: {"events": events, "sync_age_seconds": float(age or 0.0)} for account, events, age in rows}
+
+
+calendar_mirror = CalendarMirror()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect the local calendar mirror.")
+    parser.add_argument("--stats", action="store_true", help="events and sync age per account")
+    args = parser.parse_args()
+    if args.stats:
+        for account, row in mirror_stats().items():
+            print(f"{account:<40} {row['events']:>6} events  synced {row['sync_age_seconds']:.0f}s ago")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+# utils/call_policy.py
+"""
+Call policy for upstream HTTP APIs: client-side rate limiting, bounded
+retries with jittered backoff, a circuit breaker and optional hedging.
+
+A CallPolicy wraps a zero-argument `send` callable returning an
+httpx.Response:
+
+- TokenBucket: each attempt reserves a token; callers wait for their slot
+  instead of tripping the upstream quota, and give up with CallRejected if
+  the wait would exceed max_wait.
+- Retries: 429 / 5xx responses and transport errors are retried up to
+  max_retries times with full-jitter exponential backoff. A Retry-After
+  header (or Gemini's RetryInfo retryDelay) sets the minimum wait.
+- CircuitBreaker: after `threshold` consecutive upstream failures the
+  policy fails fast with CallRejected for `cooldown` seconds, then lets a
+  single trial call through (half-open) before closing again. 4xx client
+  errors and 429s do not count as upstream failures.
+- Hedging (sync, idempotent calls only): if the first attempt hasn't
+  returned after the observed p95 latency, a second identical request is
+  sent and whichever finishes first wins.
+
+A final retryable response is returned rather than raised, so the caller's
+normal error decoding applies.
+"""
+import asyncio
+import email.utils
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+_RETRY_DELAY_RE = re.compile(rb'"retryDelay"\s*:\s*"(\d+(?:\.\d+)?)s"')
+
+
+class CallRejected(Exception):
+    """The policy refused to send the call (circuit open or rate-limit wait too long)."""
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens/second up to burst; reserve() may go into debt."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait: float) -> float:
+        """Take one token and return how long to wait before using it; raises CallRejected past max_wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            delay = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if delay > max_wait:
+                raise CallRejected(f"rate limit: next slot in {delay:.1f}s")
+            self._tokens -= 1
+            return delay
+
+    def is_full(self) -> bool:
+        """True once the bucket has refilled to burst, i.e. it holds no state worth keeping."""
+        with self._lock:
+            return self._tokens + (time.monotonic() - self._updated) * self.rate >= self.burst
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            raise CallRejected("circuit open: upstream unavailable")
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def release(self):
+        """The trial call ended without an upstream verdict (e.g. cancelled); allow another."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.threshold:
+                if self.state != "open":
+                    logger.warning("Circuit opened after %d consecutive failures", self._failures)
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+
+class LatencyTracker:
+    """Recent call latencies, for the hedging delay."""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p: float):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+def retry_after_seconds(response: httpx.Response):
+    """Server-requested delay from Retry-After (seconds or HTTP date) or a RetryInfo body, if any."""
+    header = response.headers.get("Retry-After")
+    if header:
+        if header.strip().isdigit():
+            return float(header)
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(header).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    try:
+        match = _RETRY_DELAY_RE.search(response.content)
+    except httpx.ResponseNotRead:
+        return None
+    return float(match.group(1)) if match else None
+
+
+class CallPolicy:
+    def __init__(self, name: str, rate_per_minute: float, burst: float = None, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0, max_wait: float = 30.0,
+                 breaker_threshold: int = 5, breaker_cooldown: float = 30.0,
+                 hedge: bool = False, hedge_min_delay: float = 0.2, hedge_min_samples: int = 20):
+        self.name = name
+        # Default burst: a tenth of a minute's quota, so concurrent callers aren't spaced one per token
+        self.bucket = TokenBucket(rate_per_minute / 60.0, burst or max(1.0, rate_per_minute / 10.0))
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.latency = LatencyTracker()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_wait = max_wait
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self._hedge_pool = None
+        self._stats_lock = threading.Lock()
+        self._stats = {"calls": 0, "retries": 0, "rejected": 0, "failures": 0, "hedged": 0, "hedge_wins": 0}
+
+    def _count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def _backoff(self, attempt: int, response: httpx.Response = None) -> float:
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        server_delay = retry_after_seconds(response) if response is not None else None
+        if server_delay is not None:
+            delay = max(delay, server_delay)
+        return delay
+
+    def _admit(self) -> float:
+        try:
+            # Reserve quota first so a rate-limit rejection can't hold the half-open trial slot
+            delay = self.bucket.reserve(self.max_wait)
+            self.breaker.before_call()
+            return delay
+        except CallRejected:
+            self._count("rejected")
+            raise
+
+    def _outcome(self, response: httpx.Response = None, error: Exception = None):
+        """Classify one attempt: 'ok', 'retry' (upstream failure) or 'throttled' (429)."""
+        if error is not None:
+            return "retry"
+        if response.status_code == 429:
+            return "throttled"
+        return "retry" if response.status_code in RETRYABLE_STATUS else "ok"
+
+    def _finish(self, outcome: str):
+        if outcome in ("ok", "throttled"):
+            # A 429 means the upstream is up and answering; only the quota is exhausted
+            self.breaker.record_success()
+        elif outcome == "retry":
+            self._count("failures")
+            self.breaker.record_failure()
+
+    def _hedged_send(self, send) -> httpx.Response:
+        delay = self.latency.percentile(0.95) if len(self.latency) >= self.hedge_min_samples else None
+        if delay is None:
+            return send()
+        if self._hedge_pool is None:
+            self._hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix=f"{self.name}-hedge")
+        first = self._hedge_pool.submit(send)
+        done, _ = wait([first], timeout=max(delay, self.hedge_min_delay))
+        if done:
+            return first.result()
+        try:
+            time.sleep(self.bucket.reserve(0))
+        except CallRejected:
+            return first.result()  # no spare quota for a hedge
+        self._count("hedged")
+        second = self._hedge_pool.submit(send)
+        done, _ = wait([first, second], return_when=FIRST_COMPLETED)
+        winner = next(iter(done))
+        if winner is second:
+            self._count("hedge_wins")
+        loser = first if winner is second else second
+        loser.add_done_callback(lambda f: f.exception() is None and f.result().close())
+        return winner.result()
+
+    def execute(self, send):
+        """Run send() under the policy; returns the final httpx.Response or raises the last transport error."""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self._admit())
+            start = time.monotonic()
+            response = error = None
+            try:
+                response = self._hedged_send(send) if self.hedge else send()
+            except httpx.TransportError as e:
+                error = e
+            except Exception:
+                self.breaker.release()
+                raise
+            outcome = self._outcome(response, error)
+            if outcome == "ok":
+                self.latency.record(time.monotonic() - start)
+            self._finish(outcome)
+            if outcome == "ok" or attempt == self.max_retries:
+                if error is not None:
+                    raise error
+                return response
+            delay = self._backoff(attempt, response)
+            if delay > self.max_wait:
+                if error is not None:
+                    raise error
+                return response
+            if response is not None:
+                response.close()
+            self._count("retries")
+            logger.info("%s call failed (%s); retry %d in %.2fs", self.name,
+                        error or response.status_code, attempt + 1, delay)
+            time.sleep(delay)
+
+    async def aexecute(self, send):
+        """Async execute() for coroutine senders (no hedging)."""
+        self._count("calls")
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self._admit())
+            start = time.monotonic()
+            response = error = None
+            try:
+                response = await send()
+            except httpx.TransportError as e:
+                error = e
+            except BaseException:
+                # Includes cancellation: don't leave a half-open trial slot taken
+                self.breaker.release()
+                raise
+            outcome = self._outcome(response, error)
+            if outcome == "ok":
+                self.latency.record(time.monotonic() - start)
+            self._finish(outcome)
+            if outcome == "ok" or attempt == self.max_retries:
+                if error is not None:
+                    raise error
+                return response
+            delay = self._backoff(attempt, response)
+            if delay > self.max_wait:
+                if error is not None:
+                    raise error
+                return response
+            if response is not None:
+                await response.aclose()
+            self._count("retries")
+            logger.info("%s call failed (%s); retry %d in %.2fs", self.name,
+                        error or response.status_code, attempt + 1, delay)
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["circuit"] = self.breaker.state
+        p95 = self.latency.percentile(0.95)
+        stats["p95_ms"] = round(p95 * 1000, 1) if p95 is not None else None
+        return stats
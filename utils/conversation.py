@@ -0,0 +1,157 @@
+# utils/conversation.py
+"""
+Token-bounded conversation history with a rolling summary.
+
+ConversationBuffer keeps the most recent turns within CONVERSATION_MAX_TOKENS
+(and optionally at most max_turns of them).
+Turns pushed out of the budget are folded into a running summary by a
+background Gemini call on a small pool of its own (CONVERSATION_SUMMARY_WORKERS
+threads, separate from the per-turn stage executor so a slow summary never
+holds up a live turn), so memory stays flat over long sessions and the
+rendered context never exceeds the turn budget plus the summary budget.
+While a summarization is in flight the evicted turns are simply absent from
+render(); they reappear inside the summary when it lands.
+"""
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from utils.gemini_client import generate_content
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+CONVERSATION_MAX_TOKENS = int(os.getenv("CONVERSATION_MAX_TOKENS", "1500"))
+CONVERSATION_SUMMARY_MAX_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_MAX_TOKENS", "300"))
+CONVERSATION_SUMMARIZE = os.getenv("CONVERSATION_SUMMARIZE", "true").lower() == "true"
+CONVERSATION_SUMMARY_WORKERS = int(os.getenv("CONVERSATION_SUMMARY_WORKERS", "2"))
+
+SUMMARY_INSTRUCTIONS = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Merge the new turns into the existing summary. Keep names, preferences, decisions and open questions; "
+    "drop small talk. Reply with the updated summary only, in plain prose."
+)
+
+
+_fold_executor = None
+_fold_executor_lock = threading.Lock()
+
+
+def _get_fold_executor() -> ThreadPoolExecutor:
+    # Each buffer has at most one fold queued, so the backlog is bounded by the number of sessions
+    global _fold_executor
+    if _fold_executor is None:
+        with _fold_executor_lock:
+            if _fold_executor is None:
+                _fold_executor = ThreadPoolExecutor(max_workers=CONVERSATION_SUMMARY_WORKERS,
+                                                    thread_name_prefix="summary")
+    return _fold_executor
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English prose; budgets only need to be roughly right
+    return len(text) // 4
+
+
+def summarize_turns(summary: str, turns: list, max_tokens: int = CONVERSATION_SUMMARY_MAX_TOKENS) -> str:
+    """Fold turns (lists of "Role: text" lines) into summary with one Gemini call."""
+    prompt = (
+        f"Existing summary:\n{summary or '(none)'}\n\n"
+        f"New turns:\n" + "\n".join(turns) + "\n\n"
+        f"Updated summary in at most {max_tokens * 3 // 4} words:"
+    )
+    return generate_content(prompt, system_instruction=SUMMARY_INSTRUCTIONS).strip()
+
+
+class ConversationBuffer:
+    """Recent turns within max_tokens plus a summary of everything older."""
+
+    def __init__(self, max_tokens: int = CONVERSATION_MAX_TOKENS,
+                 summary_max_tokens: int = CONVERSATION_SUMMARY_MAX_TOKENS,
+                 summarize: bool = CONVERSATION_SUMMARIZE, summarizer=summarize_turns, max_turns: int = None):
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        self.summary_max_tokens = summary_max_tokens
+        self.summarize = summarize
+        self._summarizer = summarizer
+        self._turns = deque()  # (line, tokens)
+        self._tokens = 0
+        self._evicted = []
+        self._summarizing = False
+        self.summary = ""
+        self._lock = threading.Lock()
+
+    def add(self, role: str, text: str):
+        line = f"{role}: {text}"
+        with self._lock:
+            self._turns.append((line, estimate_tokens(line)))
+            self._tokens += self._turns[-1][1]
+            # Always keep the newest turn, even if it alone exceeds the budget
+            while len(self._turns) > 1 and (self._tokens > self.max_tokens
+                                            or (self.max_turns and len(self._turns) > self.max_turns)):
+                old, tokens = self._turns.popleft()
+                self._tokens -= tokens
+                if self.summarize:
+                    self._evicted.append(old)
+            start = bool(self._evicted) and not self._summarizing
+            if start:
+                self._summarizing = True
+        if start:
+            _get_fold_executor().submit(self._fold)
+
+    def add_exchange(self, user_message: str, bot_response: str):
+        self.add("User", user_message)
+        self.add("Bot", bot_response)
+
+    def _fold(self):
+        """Summarize evicted turns until none are left (runs on the fold executor)."""
+        while True:
+            with self._lock:
+                turns, self._evicted = self._evicted, []
+                summary = self.summary
+                if not turns:
+                    self._summarizing = False
+                    return
+            try:
+                summary = self._clamp(self._summarizer(summary, turns, self.summary_max_tokens))
+            except Exception as e:
+                # Never leave _summarizing set, or no later turns would be folded
+                logger.warning("Conversation summarization failed; dropping %d turns: %s", len(turns), e)
+            with self._lock:
+                self.summary = summary
+
+    def _clamp(self, summary: str) -> str:
+        # The model usually respects the word limit; enforce it so the summary stays bounded
+        max_chars = self.summary_max_tokens * 4
+        if len(summary) > max_chars:
+            summary = summary[:max_chars].rsplit(" ", 1)[0] + " …"
+        return summary
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [line for line, _ in self._turns]
+            summary = self.summary
+        if summary:
+            lines.insert(0, f"Summary of the earlier conversation: {summary}")
+        return "\n".join(lines)
+
+    def snapshot(self) -> dict:
+        """JSON-serializable state, for persisting a session."""
+        with self._lock:
+            return {"summary": self.summary, "turns": [line for line, _ in self._turns]}
+
+    def restore(self, state: dict):
+        with self._lock:
+            self.summary = state.get("summary", "")
+            self._turns = deque((line, estimate_tokens(line)) for line in state.get("turns", []))
+            self._tokens = sum(tokens for _, tokens in self._turns)
+
+    def tokens(self) -> int:
+        with self._lock:
+            return self._tokens + estimate_tokens(self.summary)
+
+    def __len__(self):
+        return len(self._turns)
+
@@ -1,7 +1,10 @@
 # utils/db.py
 import os
-import psycopg
+import threading
+import time
+from contextlib import contextmanager
 from psycopg import sql  # For safe SQL composition
+from psycopg_pool import ConnectionPool
 from dotenv import load_dotenv
 from pgvector.psycopg import register_vector
 from utils.embedding import generate_embedding # Import generate_embedding here
@@ -9,50 +12,200 @@ load_dotenv()
 
 DB_URL = f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
 
-_conn = None
+# Pool sizing. Each Streamlit session / websocket worker holds a connection
+# only for the duration of a query, so a handful of connections is plenty.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))  # seconds before an idle connection is closed
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+
+# Default ANN search knobs; see utils/schema.py for the indexes they apply to.
+# All similarity queries use cosine distance (<=>) to match the *_cosine_ops indexes.
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH", "40"))  # HNSW candidate list size
+VECTOR_PROBES = int(os.getenv("VECTOR_PROBES", "10"))  # IVFFlat lists scanned
+# HNSW/IVFFlat iterative scans (pgvector >= 0.8) keep scanning the index until
+# enough rows survive the user_id filter: off | strict_order | relaxed_order
+VECTOR_ITERATIVE_SCAN = os.getenv("VECTOR_ITERATIVE_SCAN", "relaxed_order")
+
+# Which column candidate search runs on: full | halfvec | binary. The compact
+# modes over-fetch VECTOR_OVERFETCH x top_k candidates from embedding_half /
+# embedding_bin and re-rank them exactly on the full vector.
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "full")
+VECTOR_OVERFETCH = int(os.getenv("VECTOR_OVERFETCH", "10" if VECTOR_STORAGE == "binary" else "4"))
+# Compact modes store and index only their own column, derived from the full vector
+# by this expression ({v} is the full vector); re-ranking reads `embedding` by id,
+# so it needs no ANN index of its own.
+COMPACT_COLUMNS = {
+    "halfvec": ("embedding_half", "{v}::vector::halfvec(768)"),
+    "binary": ("embedding_bin", "binary_quantize({v}::vector)::bit(768)"),
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+_pgvector_version = None
+
+_stats_lock = threading.Lock()
+_checkout_stats = {
+    "checkouts": 0,
+    "waits": 0,
+    "checkout_ms_total": 0.0,
+    "checkout_ms_max": 0.0,
+    "errors": 0,
+}
+# A checkout slower than this had to wait for a free (or new) connection.
+_WAIT_THRESHOLD_MS = 1.0
+
+
+def _configure_connection(conn):
+    """Run once per physical connection when the pool opens it."""
+    global _pgvector_version
+    conn.autocommit = True
+    register_vector(conn)
+    if _pgvector_version is None:
+        row = conn.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'").fetchone()
+        _pgvector_version = tuple(int(part) for part in row[0].split(".")[:2]) if row else (0, 0)
+
+
+def apply_search_settings(cur, ef_search=None, probes=None):
+    """
+    Set per-query ANN knobs. Must run inside a transaction: set_config(..., true)
+    scopes each setting to it, so pooled connections are never left modified.
+    """
+    settings = [
+        ("hnsw.ef_search", ef_search or VECTOR_EF_SEARCH),
+        ("ivfflat.probes", probes or VECTOR_PROBES),
+        # Generic plans cannot match the per-user partial indexes; plan each query.
+        ("plan_cache_mode", "force_custom_plan"),
+    ]
+    if _pgvector_version and _pgvector_version >= (0, 8) and VECTOR_ITERATIVE_SCAN != "off":
+        settings.append(("hnsw.iterative_scan", VECTOR_ITERATIVE_SCAN))
+        settings.append(("ivfflat.iterative_scan", "relaxed_order"))
+    # One round trip for all of them
+    calls = sql.SQL(", ").join(sql.SQL("set_config(%s, %s, true)") for _ in settings)
+    cur.execute(sql.SQL("SELECT {}").format(calls), [part for name, value in settings for part in (name, str(value))])
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    DB_URL,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    timeout=DB_POOL_TIMEOUT,
+                    configure=_configure_connection,
+                    check=ConnectionPool.check_connection,
+                    name="kitea",
+                    open=True,
+                )
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+def _record_checkout(elapsed_ms: float, failed: bool = False):
+    with _stats_lock:
+        if failed:
+            _checkout_stats["errors"] += 1
+            return
+        _checkout_stats["checkouts"] += 1
+        _checkout_stats["checkout_ms_total"] += elapsed_ms
+        if elapsed_ms > _checkout_stats["checkout_ms_max"]:
+            _checkout_stats["checkout_ms_max"] = elapsed_ms
+        if elapsed_ms > _WAIT_THRESHOLD_MS:
+            _checkout_stats["waits"] += 1
+
+
+@contextmanager
+def connection(timeout: float = None):
+    """
+    Borrow a pooled connection for the duration of the ``with`` block.
+
+    Connections are in autocommit mode with pgvector types registered; use
+    ``conn.transaction()`` when several statements must commit together.
+    timeout overrides DB_POOL_TIMEOUT for callers that would rather fail fast.
+    """
+    pool = get_pool()
+    start = time.perf_counter()
+    try:
+        conn = pool.getconn(timeout=timeout)
+    except Exception:
+        _record_checkout(0.0, failed=True)
+        raise
+    _record_checkout((time.perf_counter() - start) * 1000)
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
 
 def get_connection():
-    global _conn
-    if _conn is None or _conn.closed:
-        try:
-            _conn = psycopg.connect(DB_URL)
-            _conn.autocommit = True
-            register_vector(_conn)
-        except Exception as e:
-            print(f"DB connection error: {e}")
-            _conn = None
-    return _conn
+    """Check a connection out of the pool. Pair with release_connection()."""
+    pool = get_pool()
+    start = time.perf_counter()
+    try:
+        conn = pool.getconn()
+    except Exception as e:
+        _record_checkout(0.0, failed=True)
+        print(f"DB connection error: {e}")
+        return None
+    _record_checkout((time.perf_counter() - start) * 1000)
+    return conn
 
 def release_connection(conn):
-    if conn and not conn.closed:
-        conn.close()
+    """Return a connection obtained from get_connection() to the pool."""
+    if conn is not None and _pool is not None:
+        _pool.putconn(conn)
+
+
+def pool_stats() -> dict:
+    """Checkout counters plus the pool's own size/queue figures."""
+    with _stats_lock:
+        stats = dict(_checkout_stats)
+    checkouts = stats["checkouts"]
+    stats["checkout_ms_avg"] = stats["checkout_ms_total"] / checkouts if checkouts else 0.0
+    if _pool is not None:
+        pool_info = _pool.get_stats()
+        stats["pool_size"] = pool_info.get("pool_size", 0)
+        stats["pool_available"] = pool_info.get("pool_available", 0)
+        stats["in_use"] = stats["pool_size"] - stats["pool_available"]
+        stats["requests_waiting"] = pool_info.get("requests_waiting", 0)
+        stats["connections_num"] = pool_info.get("connections_num", 0)
+    else:
+        stats.update(pool_size=0, pool_available=0, in_use=0, requests_waiting=0, connections_num=0)
+    return stats
 
-def retrieve_similar_data(user_id: str, query: str, top_k: int = 3):
-    query_embedding = generate_embedding(query)
+def retrieve_similar_data(user_id: str, query: str, top_k: int = 3, ef_search: int = None, probes: int = None,
+                          query_embedding: list = None):
+    """
+    Return the text of the top_k stored messages closest (cosine) to the query.
+    ef_search / probes override the HNSW / IVFFlat defaults for this query only.
+    Pass query_embedding when the caller has already embedded the query.
+    """
+    if query_embedding is None:
+        query_embedding = generate_embedding(query)
     print("📡 Query Embedding:", query_embedding[:5] if query_embedding else "None")
 
     if not query_embedding:
         print("❌ No embedding generated")
         return []
 
-    conn = get_connection()
-    if not conn:
-        print("❌ Failed to get DB connection")
-        return []
-
     try:
-        with conn.cursor() as cur:
-            cur.execute(
-                sql.SQL("""
-                    SELECT message_text, embedding <=> %s::vector AS distance
-                    FROM user_messages
-                    WHERE user_id = %s AND embedding IS NOT NULL
-                    ORDER BY embedding <=> %s::vector
-                    LIMIT %s;
-                """), (query_embedding, user_id, query_embedding, top_k)
-            )
-
-            results = cur.fetchall()
+        with connection() as conn:
+            with conn.transaction(), conn.cursor() as cur:
+                apply_search_settings(cur, ef_search, probes)
+                results = [(text, distance) for _, text, distance in
+                           search_user_messages(cur, user_id, query_embedding, top_k)]
 
         print("📊 Raw Results:", results)
         filtered = [row[0] for row in results]  # We only need the message text for context
@@ -61,16 +214,55 @@ def retrieve_similar_data(user_id: str, query: str, top_k: int = 3):
     except Exception as e:
         print(f"🔥 Error retrieving similar data: {e}")
         return []
-    finally:
-        if conn:
-            release_connection(conn)
+
+def search_user_messages(cur, user_id: str, query_embedding: list, top_k: int, storage: str = None):
+    """
+    Return (id, message_text, cosine distance) rows for the top_k nearest messages.
+
+    storage selects the candidate column (defaults to VECTOR_STORAGE); compact
+    modes over-fetch and re-rank on the full embedding. Relaxed iterative
+    scans may return candidates slightly out of order, so the outer query
+    always re-sorts the materialized candidates.
+    """
+    storage = storage or VECTOR_STORAGE
+    if storage == "full":
+        cur.execute("""
+            WITH candidates AS MATERIALIZED (
+                SELECT id, message_text, embedding <=> %(q)s::vector AS distance
+                FROM user_messages
+                WHERE user_id = %(user_id)s AND embedding IS NOT NULL
+                ORDER BY embedding <=> %(q)s::vector
+                LIMIT %(k)s
+            )
+            SELECT id, message_text, distance FROM candidates ORDER BY distance;
+        """, {"q": query_embedding, "user_id": user_id, "k": top_k})
+        return cur.fetchall()
+
+    if storage == "halfvec":
+        column, order = sql.Identifier("embedding_half"), sql.SQL("<=> %(q)s::vector::halfvec(768)")
+    elif storage == "binary":
+        column, order = sql.Identifier("embedding_bin"), sql.SQL("<~> binary_quantize(%(q)s::vector)::bit(768)")
+    else:
+        raise ValueError(f"Unknown VECTOR_STORAGE {storage!r}")
+    cur.execute(sql.SQL("""
+        WITH candidates AS MATERIALIZED (
+            SELECT id, message_text, embedding
+            FROM user_messages
+            WHERE user_id = %(user_id)s AND {column} IS NOT NULL AND embedding IS NOT NULL
+            ORDER BY {column} {order}
+            LIMIT %(candidates)s
+        )
+        SELECT id, message_text, embedding <=> %(q)s::vector AS distance
+        FROM candidates
+        ORDER BY distance
+        LIMIT %(k)s;
+    """).format(column=column, order=order),
+        {"q": query_embedding, "user_id": user_id, "k": top_k, "candidates": top_k * VECTOR_OVERFETCH})
+    return cur.fetchall()
 
 def retrieve_user_data(user_id: str, data_key: str):
-    conn = get_connection()
-    if conn is None:
-        return None
     try:
-        with conn:
+        with connection() as conn:
             with conn.cursor() as cur:
                 cur.execute(
                     "SELECT data_value FROM user_data WHERE user_id = %s AND data_key = %s",
@@ -81,6 +273,3 @@ def retrieve_user_data(user_id: str, data_key: str):
     except Exception as e:
         print(f"Error retrieving user data: {e}")
         return None
-    finally:
-        if conn:
-            release_connection(conn)
\ No newline at end of file
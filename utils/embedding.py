@@ -1,42 +1,141 @@
-import requests
-from utils.auth import get_access_token
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from utils.embedding_cache import cache as embedding_cache
+from utils.embedding_providers import get_provider
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Capped by the provider's own limit (100 for Gemini batchEmbedContents)
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "100"))
+# Route single-text calls through the micro-batcher so concurrent callers share requests
+EMBEDDING_MICROBATCH = os.getenv("EMBEDDING_MICROBATCH", "false").lower() == "true"
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+
 
 def generate_embedding(text: str) -> list:
-    """Generate an embedding from Gemini API."""
-    access_token = get_access_token()
-    if not access_token:
-        logging.error("Authentication failed for embedding API.")
-        return None
-
-    url = "https://generativelanguage.googleapis.com/v1beta/models/embedding-001:embedContent"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "model": "models/embedding-001",
-        "content": {"parts": [{"text": text}]}
-    }
-
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        data = response.json()
-
-        logging.debug(f"Embedding API response: {data}")  # 👈 Add this line
-
-        embedding = data.get("embedding", {}).get("values")
-
-        if not embedding or not isinstance(embedding, list) or len(embedding) != 768:
-            logging.error("Embedding is missing or invalid format.")
+    """Generate an embedding with the configured provider, served from the embedding cache when possible."""
+    provider = get_provider()
+    cached = embedding_cache.get(provider.model, text, persist=provider.persist_cache)
+    if cached is not None:
+        return cached
+
+    if EMBEDDING_MICROBATCH:
+        try:
+            return get_batcher().submit(text).result()
+        except Exception as e:
+            logging.error(f"Embedding batch error: {e}")
             return None
 
-        return embedding
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Embedding API error: {e}")
-        return None
\ No newline at end of file
+    embedding = provider.embed(text)
+    if embedding is not None:
+        embedding_cache.put(provider.model, text, embedding, persist=provider.persist_cache)
+    return embedding
+
+
+def generate_embeddings(texts: list, raise_errors: bool = False) -> list:
+    """
+    Embed several texts, returning one embedding (or None on failure) per input, in order.
+    Cached texts are served locally; the rest go to the provider in batches.
+    With raise_errors, a provider call that fails as a whole raises instead.
+    """
+    provider = get_provider()
+    results = [embedding_cache.get(provider.model, text, persist=provider.persist_cache) for text in texts]
+    misses = [i for i, embedding in enumerate(results) if embedding is None]
+    for i, embedding in zip(misses, _embed_uncached([texts[i] for i in misses], raise_errors)):
+        results[i] = embedding
+    return results
+
+
+def _embed_uncached(texts: list, raise_errors: bool = False) -> list:
+    """Embed texts in provider batches (deduplicated, chunked) and populate the cache."""
+    provider = get_provider()
+    batch_size = min(EMBEDDING_BATCH_SIZE, provider.max_batch)
+    unique = list(dict.fromkeys(texts))
+    embedded = {}
+    for start in range(0, len(unique), batch_size):
+        chunk = unique[start:start + batch_size]
+        for text, embedding in zip(chunk, provider.embed_batch(chunk, raise_errors=raise_errors)):
+            if embedding is not None:
+                embedding_cache.put(provider.model, text, embedding, persist=provider.persist_cache)
+                embedded[text] = embedding
+    return [embedded.get(text) for text in texts]
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent single-text requests into provider batch calls.
+
+    Each submit() returns a Future. A daemon thread waits up to max_wait_ms
+    after the first queued text for more to arrive (or until max_batch is
+    reached), embeds them together and resolves every caller's future.
+    """
+
+    def __init__(self, max_wait_ms: float = EMBEDDING_BATCH_WAIT_MS, max_batch: int = None):
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch or min(EMBEDDING_BATCH_SIZE, get_provider().max_batch)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches_sent = 0
+        self.texts_sent = 0
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((text, future))
+        return future
+
+    def _ensure_worker(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                    self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            live = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not live:
+                continue
+            try:
+                embeddings = _embed_uncached([text for text, _ in live])
+            except Exception as e:
+                for _, future in live:
+                    future.set_exception(e)
+                continue
+            self.batches_sent += 1
+            self.texts_sent += len(live)
+            for (_, future), embedding in zip(live, embeddings):
+                future.set_result(embedding)
+
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def get_batcher() -> EmbeddingBatcher:
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = EmbeddingBatcher()
+    return _batcher
@@ -0,0 +1,164 @@
+# utils/embedding_cache.py
+"""
+Two-tier cache for embeddings keyed by (model, hash of normalized text).
+
+The memory tier is a process-wide LRU bounded by bytes; the persistent tier
+is the embedding_cache table (created by utils/schema.py), shared across
+processes and restarts. Both tiers fail soft: a cache error never blocks
+embedding generation. After a database error the persistent tier is skipped
+for EMBEDDING_CACHE_DB_RETRY_SECONDS, and each lookup waits at most
+EMBEDDING_CACHE_DB_TIMEOUT for a connection, so an unreachable database costs
+one short wait per retry window rather than a pool timeout per miss.
+
+Callers pass persist=False for vectors that are cheaper to recompute than to
+fetch (the local provider's); those stay in the memory tier only.
+"""
+import hashlib
+import logging
+import os
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from dotenv import load_dotenv
+from utils.call_policy import CallRejected, CircuitBreaker
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+EMBEDDING_CACHE_PERSIST = os.getenv("EMBEDDING_CACHE_PERSIST", "true").lower() == "true"
+EMBEDDING_CACHE_DB_TIMEOUT = float(os.getenv("EMBEDDING_CACHE_DB_TIMEOUT", "1"))  # seconds to wait for a connection
+EMBEDDING_CACHE_DB_RETRY_SECONDS = float(os.getenv("EMBEDDING_CACHE_DB_RETRY_SECONDS", "30"))
+
+# Rough per-entry overhead of the OrderedDict slot, key tuple and array header
+_ENTRY_OVERHEAD_BYTES = 200
+
+
+def normalize_text(text: str) -> str:
+    """Unicode-normalize and collapse whitespace so trivial variants share an entry."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES, persist: bool = EMBEDDING_CACHE_PERSIST):
+        self.max_bytes = max_bytes
+        self.persist = persist
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._db_circuit = CircuitBreaker(threshold=1, cooldown=EMBEDDING_CACHE_DB_RETRY_SECONDS)
+        self._stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "evictions": 0, "db_errors": 0,
+                       "db_skipped": 0}
+
+    @staticmethod
+    def _entry_size(vector: array) -> int:
+        return vector.itemsize * len(vector) + _ENTRY_OVERHEAD_BYTES
+
+    def _remember(self, key, vector: array):
+        """Insert into the memory tier and evict least-recently-used entries. Caller holds the lock."""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = vector
+        self._bytes += self._entry_size(vector)
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._entry_size(evicted)
+            self._stats["evictions"] += 1
+
+    def get(self, model: str, text: str, persist: bool = True):
+        key = (model, text_hash(text))
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return vector.tolist()
+
+        vector = self._load(key) if self.persist and persist else None
+        with self._lock:
+            if vector is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["db_hits"] += 1
+            self._remember(key, vector)
+        return vector.tolist()
+
+    def put(self, model: str, text: str, embedding: list, persist: bool = True):
+        key = (model, text_hash(text))
+        # float32 matches what pgvector stores and is 1/8 the size of a list of floats
+        vector = array("f", embedding)
+        with self._lock:
+            self._remember(key, vector)
+        if self.persist and persist:
+            self._store(key, embedding)
+
+    def _db_available(self) -> bool:
+        try:
+            self._db_circuit.before_call()
+            return True
+        except CallRejected:
+            with self._lock:
+                self._stats["db_skipped"] += 1
+            return False
+
+    def _db_failed(self, action: str, error: Exception):
+        self._db_circuit.record_failure()
+        with self._lock:
+            self._stats["db_errors"] += 1
+        logger.warning("Embedding cache %s failed: %s", action, error)
+
+    def _load(self, key):
+        if not self._db_available():
+            return None
+        # Imported here: utils.db imports utils.embedding, which imports this module.
+        from utils.db import connection
+        try:
+            with connection(timeout=EMBEDDING_CACHE_DB_TIMEOUT) as conn:
+                row = conn.execute(
+                    "SELECT embedding FROM embedding_cache WHERE model = %s AND text_hash = %s",
+                    key
+                ).fetchone()
+        except Exception as e:
+            self._db_failed("lookup", e)
+            return None
+        self._db_circuit.record_success()
+        return array("f", row[0]) if row else None
+
+    def _store(self, key, embedding: list):
+        if not self._db_available():
+            return
+        from utils.db import connection
+        try:
+            with connection(timeout=EMBEDDING_CACHE_DB_TIMEOUT) as conn:
+                conn.execute(
+                    "INSERT INTO embedding_cache (model, text_hash, embedding) VALUES (%s, %s, %s) "
+                    "ON CONFLICT (model, text_hash) DO NOTHING",
+                    (key[0], key[1], embedding)
+                )
+        except Exception as e:
+            self._db_failed("write", e)
+            return
+        self._db_circuit.record_success()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["memory_hits"] + stats["db_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["db_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+cache = EmbeddingCache()
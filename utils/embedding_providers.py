@@ -0,0 +1,183 @@
+# utils/embedding_providers.py
+"""
+Embedding backends behind one interface, selected with EMBEDDING_PROVIDER:
+
+- "gemini" (default): Gemini embedContent / batchEmbedContents over the
+  shared client in utils/gemini_client.py.
+- "local": deterministic hashed n-gram features in NumPy. No network or
+  credentials, so retrieval can run in CI and latency-critical deployments.
+
+Both produce 768-dim vectors so either fits the existing vector(768) columns.
+Vectors from different providers are not comparable; the provider's model id
+is part of the embedding cache key, and switching providers on a populated
+database requires re-embedding the stored messages.
+"""
+import logging
+import os
+import re
+import zlib
+from abc import ABC, abstractmethod
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 768
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "gemini").lower()
+
+
+class EmbeddingProvider(ABC):
+    """Base class: subclasses set model / max_batch and implement embed_batch()."""
+
+    model = ""
+    dim = EMBEDDING_DIM
+    max_batch = 100
+    persist_cache = True  # keep vectors in the embedding_cache table, not just in memory
+
+    def embed(self, text: str):
+        return self.embed_batch([text])[0]
+
+    @abstractmethod
+    def embed_batch(self, texts: list, raise_errors: bool = False) -> list:
+        """
+        Return one embedding (or None on failure) per text, in order. With
+        raise_errors, a failure of the whole call (transport, quota, open
+        circuit) raises instead of coming back as all-None, so callers can
+        tell an outage from texts that can't be embedded.
+        """
+
+    def _valid(self, embedding) -> bool:
+        return bool(embedding) and isinstance(embedding, list) and len(embedding) == self.dim
+
+
+class GeminiEmbeddingProvider(EmbeddingProvider):
+    model = "models/embedding-001"
+    # batchEmbedContents accepts at most 100 requests per call
+    max_batch = 100
+
+    def embed(self, text: str):
+        # Imported lazily so the local provider works without Google auth installed
+        from utils.gemini_client import post_json, GeminiError
+        payload = {
+            "model": self.model,
+            "content": {"parts": [{"text": text}]}
+        }
+
+        try:
+            data = post_json(f"{self.model}:embedContent", payload)
+        except GeminiError as e:
+            logger.error(f"Embedding API error: {e}")
+            return None
+
+        logger.debug(f"Embedding API response: {data}")
+
+        embedding = data.get("embedding", {}).get("values")
+
+        if not self._valid(embedding):
+            logger.error("Embedding is missing or invalid format.")
+            return None
+
+        return embedding
+
+    def embed_batch(self, texts: list, raise_errors: bool = False) -> list:
+        """One batchEmbedContents call for up to max_batch texts."""
+        from utils.gemini_client import post_json, GeminiError
+        payload = {
+            "requests": [
+                {"model": self.model, "content": {"parts": [{"text": text}]}}
+                for text in texts
+            ]
+        }
+
+        try:
+            items = post_json(f"{self.model}:batchEmbedContents", payload).get("embeddings", [])
+        except GeminiError as e:
+            if raise_errors:
+                raise
+            logger.error(f"Batch embedding API error: {e}")
+            return [None] * len(texts)
+
+        if len(items) != len(texts):
+            if raise_errors:
+                raise GeminiError(f"Batch embedding returned {len(items)} results for {len(texts)} texts.")
+            logger.error(f"Batch embedding returned {len(items)} results for {len(texts)} texts.")
+            return [None] * len(texts)
+
+        embeddings = []
+        for item in items:
+            embedding = item.get("values")
+            if not self._valid(embedding):
+                logger.error("Embedding is missing or invalid format.")
+                embedding = None
+            embeddings.append(embedding)
+        return embeddings
+
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    """
+    Signed feature hashing of word unigrams/bigrams and character n-grams.
+
+    Each feature is hashed (crc32, stable across processes) to one of the 768
+    dimensions with a +/-1 sign, which is a sparse random projection of the
+    n-gram count vector. Counts are log-scaled and the result L2-normalized,
+    so cosine distance behaves like a TF n-gram overlap score.
+    """
+
+    model = "local/hashed-ngram-v1"
+    max_batch = 1024
+    persist_cache = False  # recomputing is cheaper than a database round trip
+    char_ngrams = (3, 4, 5)
+    _token_re = re.compile(r"\w+", re.UNICODE)
+
+    def _features(self, text: str) -> list:
+        words = self._token_re.findall(text.lower())
+        features = [f"w:{w}" for w in words]
+        features += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+        for word in words:
+            padded = f"<{word}>"
+            for n in self.char_ngrams:
+                features += [f"c:{padded[i:i + n]}" for i in range(len(padded) - n + 1)]
+        return features
+
+    def _embed_one(self, text: str):
+        features = self._features(text)
+        if not features:
+            return None
+        hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint64, count=len(features))
+        index, counts = np.unique(hashes, return_counts=True)
+        buckets = (index % self.dim).astype(np.intp)
+        signs = np.where((index >> 31) & 1, -1.0, 1.0)
+        vector = np.zeros(self.dim, dtype=np.float64)
+        np.add.at(vector, buckets, signs * (1.0 + np.log(counts)))
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        return (vector / norm).astype(np.float32).tolist()
+
+    def embed_batch(self, texts: list, raise_errors: bool = False) -> list:
+        return [self._embed_one(text) for text in texts]
+
+
+_PROVIDERS = {
+    "gemini": GeminiEmbeddingProvider,
+    "local": LocalEmbeddingProvider,
+}
+
+_provider = None
+
+
+def get_provider() -> EmbeddingProvider:
+    """Return the configured provider (EMBEDDING_PROVIDER), created once per process."""
+    global _provider
+    if _provider is None:
+        if EMBEDDING_PROVIDER not in _PROVIDERS:
+            raise ValueError(f"Unknown EMBEDDING_PROVIDER {EMBEDDING_PROVIDER!r}; expected one of {sorted(_PROVIDERS)}")
+        _provider = _PROVIDERS[EMBEDDING_PROVIDER]()
+    return _provider
+
+
+def set_provider(provider: EmbeddingProvider):
+    """Swap the process-wide provider, e.g. to LocalEmbeddingProvider() in tests."""
+    global _provider
+    _provider = provider
@@ -0,0 +1,233 @@
+# utils/embedding_queue.py
+"""
+Write-behind embedding for user_messages.
+
+store_user_data inserts messages with embedding = NULL and calls notify();
+a background worker claims pending rows in batches by leasing them for
+EMBEDDING_QUEUE_LEASE_SECONDS (FOR UPDATE SKIP LOCKED, committed at once, so
+several processes can run workers and no transaction stays open during the
+Gemini call), embeds them with generate_embeddings and writes the vectors
+back. A worker that dies mid-batch leaves its lease to expire and the rows
+are claimed again. Rows that keep failing are retried up to
+EMBEDDING_QUEUE_MAX_ATTEMPTS times; a batch that fails as a whole (Gemini
+unreachable, quota, open circuit) releases its leases without spending an
+attempt and the worker backs off. Retrieval already ignores NULL
+embeddings, so a message becomes searchable as soon as its batch lands.
+
+    python -m utils.embedding_queue --backfill      # embed every pending row now
+    python -m utils.embedding_queue --requeue-dead  # retry rows that exhausted their attempts
+    python -m utils.embedding_queue --stats         # queue depth and lag
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from utils.db import connection, VECTOR_STORAGE, COMPACT_COLUMNS
+from utils.embedding import generate_embeddings
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+EMBEDDING_WRITE_BEHIND = os.getenv("EMBEDDING_WRITE_BEHIND", "true").lower() == "true"
+EMBEDDING_QUEUE_BATCH_SIZE = int(os.getenv("EMBEDDING_QUEUE_BATCH_SIZE", "50"))
+EMBEDDING_QUEUE_POLL_SECONDS = float(os.getenv("EMBEDDING_QUEUE_POLL_SECONDS", "5"))
+EMBEDDING_QUEUE_MAX_ATTEMPTS = int(os.getenv("EMBEDDING_QUEUE_MAX_ATTEMPTS", "5"))
+EMBEDDING_QUEUE_MAX_BACKOFF = float(os.getenv("EMBEDDING_QUEUE_MAX_BACKOFF", "60"))
+# Must outlast one generate_embeddings call, retries included
+EMBEDDING_QUEUE_LEASE_SECONDS = float(os.getenv("EMBEDDING_QUEUE_LEASE_SECONDS", "300"))
+
+if VECTOR_STORAGE == "full":
+    _UPDATE_SQL = """
+        UPDATE user_messages SET embedding = %(embedding)s, embedding_claimed_until = NULL
+        WHERE id = %(id)s
+    """
+else:
+    _column, _expression = COMPACT_COLUMNS[VECTOR_STORAGE]
+    _UPDATE_SQL = f"""
+        UPDATE user_messages
+        SET embedding = %(embedding)s, {_column} = {_expression.format(v="%(embedding)s")},
+            embedding_claimed_until = NULL
+        WHERE id = %(id)s
+    """
+
+
+def process_batch(batch_size: int = EMBEDDING_QUEUE_BATCH_SIZE) -> tuple:
+    """
+    Lease up to batch_size pending rows, embed them and write them back.
+    Returns (embedded, failed) counts; (0, 0) means nothing pending.
+    """
+    with connection() as conn:
+        rows = conn.execute("""
+            UPDATE user_messages
+            SET embedding_claimed_until = now() + make_interval(secs => %s)
+            WHERE id IN (
+                SELECT id FROM user_messages
+                WHERE embedding IS NULL AND embedding_attempts < %s
+                  AND (embedding_claimed_until IS NULL OR embedding_claimed_until < now())
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, message_text
+        """, (EMBEDDING_QUEUE_LEASE_SECONDS, EMBEDDING_QUEUE_MAX_ATTEMPTS, batch_size)).fetchall()
+    if not rows:
+        return 0, 0
+
+    try:
+        # An outage raises here; only rows that come back without a vector spend an attempt
+        embeddings = generate_embeddings([text for _, text in rows], raise_errors=True)
+    except BaseException:
+        # Not the rows' fault: hand them back without spending an attempt
+        with connection() as conn:
+            conn.execute("UPDATE user_messages SET embedding_claimed_until = NULL WHERE id = ANY(%s)",
+                         ([row_id for row_id, _ in rows],))
+        raise
+    done = [{"id": row_id, "embedding": emb} for (row_id, _), emb in zip(rows, embeddings) if emb is not None]
+    failed = [row_id for (row_id, _), emb in zip(rows, embeddings) if emb is None]
+    with connection() as conn:
+        with conn.transaction(), conn.cursor() as cur:
+            if done:
+                cur.executemany(_UPDATE_SQL, done)
+            if failed:
+                cur.execute("""
+                    UPDATE user_messages
+                    SET embedding_attempts = embedding_attempts + 1, embedding_claimed_until = NULL
+                    WHERE id = ANY(%s)
+                """, (failed,))
+    return len(done), len(failed)
+
+
+def requeue_dead() -> int:
+    """Reset the attempt count of rows that exhausted their retries, so the worker picks them up again."""
+    with connection() as conn:
+        cur = conn.execute("""
+            UPDATE user_messages SET embedding_attempts = 0, embedding_claimed_until = NULL
+            WHERE embedding IS NULL AND embedding_attempts >= %s
+        """, (EMBEDDING_QUEUE_MAX_ATTEMPTS,))
+        return cur.rowcount
+
+
+def queue_stats() -> dict:
+    """Pending rows, rows that exhausted their retries, and age of the oldest pending row."""
+    with connection() as conn:
+        row = conn.execute("""
+            SELECT count(*) FILTER (WHERE embedding_attempts < %(max)s),
+                   count(*) FILTER (WHERE embedding_attempts >= %(max)s),
+                   extract(epoch FROM now() - min(created_at) FILTER (WHERE embedding_attempts < %(max)s))
+            FROM user_messages
+            WHERE embedding IS NULL
+        """, {"max": EMBEDDING_QUEUE_MAX_ATTEMPTS}).fetchone()
+    return {"queue_depth": row[0], "dead": row[1], "lag_seconds": float(row[2] or 0.0)}
+
+
+class EmbeddingWorker:
+    """Daemon thread draining the pending-embedding queue."""
+
+    def __init__(self, batch_size: int = EMBEDDING_QUEUE_BATCH_SIZE, poll_seconds: float = EMBEDDING_QUEUE_POLL_SECONDS):
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.embedded = 0
+        self.failed = 0
+        self.last_batch_ms = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="embedding-worker", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def notify(self):
+        self._wake.set()
+
+    def _run(self):
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                start = time.perf_counter()
+                embedded, failed = process_batch(self.batch_size)
+                self.last_batch_ms = (time.perf_counter() - start) * 1000
+                self.embedded += embedded
+                self.failed += failed
+            except Exception as e:
+                logger.error("Embedding worker batch failed: %s", e)
+                embedded, failed = 0, 1
+
+            if embedded:
+                backoff = 1.0
+                continue  # more may be pending
+            if failed:
+                # Upstream is failing; back off before retrying
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, EMBEDDING_QUEUE_MAX_BACKOFF)
+                continue
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+    def stats(self) -> dict:
+        stats = {"embedded": self.embedded, "failed": self.failed, "last_batch_ms": self.last_batch_ms,
+                 "running": self._thread is not None and self._thread.is_alive()}
+        try:
+            stats.update(queue_stats())
+        except Exception as e:
+            logger.warning("Could not read embedding queue stats: %s", e)
+        return stats
+
+
+worker = EmbeddingWorker()
+
+
+def notify():
+    """Wake (and lazily start) the worker after inserting a message without an embedding."""
+    worker.start()
+    worker.notify()
+
+
+def backfill(batch_size: int = 100) -> int:
+    """Synchronously embed every pending row, e.g. historical messages stored with NULL embeddings."""
+    total = 0
+    while True:
+        embedded, failed = process_batch(batch_size)
+        total += embedded
+        if embedded == 0 and failed == 0:
+            break
+        print(f"🔢 Embedded {total} messages ({failed} failed in last batch)...")
+        if embedded == 0:
+            # Every row in the batch failed; its attempts were counted, so this terminates
+            time.sleep(1)
+    print(f"✅ Backfill complete: {total} messages embedded.")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write-behind embedding queue for user_messages.")
+    parser.add_argument("--backfill", action="store_true", help="embed all pending rows and exit")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--requeue-dead", action="store_true",
+                        help="retry rows that exhausted EMBEDDING_QUEUE_MAX_ATTEMPTS")
+    parser.add_argument("--stats", action="store_true", help="print queue depth and lag")
+    args = parser.parse_args()
+
+    if args.requeue_dead:
+        print(f"♻️ Requeued {requeue_dead()} dead rows.")
+    if args.backfill:
+        backfill(args.batch_size)
+    if args.stats or not (args.backfill or args.requeue_dead):
+        stats = queue_stats()
+        print(f"Queue depth: {stats['queue_depth']}  dead: {stats['dead']}  lag: {stats['lag_seconds']:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
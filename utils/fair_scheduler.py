@@ -0,0 +1,184 @@
+# utils/fair_scheduler.py
+"""
+Fair admission of LLM work across users, for the websocket server's event loop.
+
+FairScheduler hands out at most `capacity` concurrent slots:
+
+- Each user has a TokenBucket (rate_per_minute, burst). A request past the
+  user's quota waits for its token first, or is refused with ServerBusy
+  ("rate_limited") if that wait would exceed max_wait.
+- When every slot is taken, requests queue in a weighted fair queue
+  (start-time fair queuing): each gets a virtual finish tag of
+  max(virtual time, user's last tag) + cost / weight, and freed slots go to
+  the smallest tag. A user with a burst of queued requests only advances
+  their own tags, so other users' requests keep going ahead of the backlog.
+- A request still queued after max_wait (counting its quota wait), or one
+  arriving when max_queued are already waiting, fails fast with ServerBusy
+  ("busy") so the server can answer at once instead of queueing unboundedly.
+
+State lives in the scheduler object, so limits hold per process only. The
+websocket server with WS_WORKERS > 1 runs one scheduler per worker, and a user
+whose connections land on several workers gets each worker's quota and slots.
+
+stats() reports queue depth (overall and the deepest user), wait-time
+percentiles and admission/rejection counters.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from utils.call_policy import CallRejected, LatencyTracker, TokenBucket
+
+_PRUNE_EVERY = 1000
+
+
+class ServerBusy(Exception):
+    """The request was not admitted; reason is "busy" (queue full or wait too long) or "rate_limited"."""
+
+    def __init__(self, reason: str = "busy"):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _Waiter:
+    __slots__ = ("user", "future", "active")
+
+    def __init__(self, user, future):
+        self.user = user
+        self.future = future
+        self.active = True
+
+
+class FairScheduler:
+    def __init__(self, capacity: int, max_queued: int, max_wait: float, rate_per_minute: float,
+                 burst: float, weights: dict = None, default_weight: float = 1.0):
+        self.capacity = capacity
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.weights = dict(weights or {})
+        self.default_weight = default_weight
+        self.in_flight = 0
+        self.waiting = 0
+        self._heap = []  # (finish tag, seq, waiter)
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._last_tag = {}
+        self._buckets = {}
+        self._queued = Counter()
+        self._acquisitions = 0
+        self.wait_times = LatencyTracker(window=1000)
+        self._stats = {"admitted": 0, "queued": 0, "rate_limited": 0, "queue_full": 0, "timed_out": 0}
+
+    def _bucket(self, user) -> TokenBucket:
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            bucket = self._buckets[user] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _prune(self):
+        """Forget users with a full bucket and nothing queued; they'd start from the same state anyway."""
+        for user in [u for u, b in self._buckets.items() if b.is_full() and not self._queued[u]]:
+            del self._buckets[user]
+        for user in [u for u, tag in self._last_tag.items() if tag <= self._virtual_time and not self._queued[u]]:
+            del self._last_tag[user]
+        self._queued = +self._queued  # drop zero counts
+
+    def _dispatch(self):
+        while self.in_flight < self.capacity and self._heap:
+            tag, _, waiter = heapq.heappop(self._heap)
+            if not waiter.active:
+                continue
+            waiter.active = False
+            self.waiting -= 1
+            self._queued[waiter.user] -= 1
+            if waiter.future.done():
+                # Cancelled (timed out or its task was cancelled) before its _acquire could withdraw it
+                continue
+            self._virtual_time = max(self._virtual_time, tag)
+            waiter.future.set_result(None)
+            self.in_flight += 1
+
+    def _release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    async def _acquire(self, user, cost: float):
+        start = time.monotonic()
+        self._acquisitions += 1
+        if self._acquisitions % _PRUNE_EVERY == 0:
+            self._prune()
+        try:
+            delay = self._bucket(user).reserve(self.max_wait)
+        except CallRejected:
+            self._stats["rate_limited"] += 1
+            raise ServerBusy("rate_limited") from None
+        if delay:
+            await asyncio.sleep(delay)
+
+        if self.in_flight < self.capacity and not self.waiting:
+            self.in_flight += 1
+            self._stats["admitted"] += 1
+            self.wait_times.record(time.monotonic() - start)
+            return
+        if self.waiting >= self.max_queued:
+            self._stats["queue_full"] += 1
+            raise ServerBusy("busy")
+
+        weight = self.weights.get(user, self.default_weight)
+        tag = max(self._virtual_time, self._last_tag.get(user, 0.0)) + cost / weight
+        self._last_tag[user] = tag
+        waiter = _Waiter(user, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, (tag, next(self._seq), waiter))
+        self.waiting += 1
+        self._queued[user] += 1
+        self._stats["queued"] += 1
+        try:
+            await asyncio.wait_for(waiter.future, max(0.0, self.max_wait - (time.monotonic() - start)))
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted in the same tick we gave up: hand the slot on
+                self._release()
+            elif waiter.active:
+                waiter.active = False
+                self.waiting -= 1
+                self._queued[user] -= 1
+            if isinstance(e, asyncio.TimeoutError):
+                self._stats["timed_out"] += 1
+                raise ServerBusy("busy") from None
+            raise
+        self._stats["admitted"] += 1
+        self.wait_times.record(time.monotonic() - start)
+
+    @asynccontextmanager
+    async def slot(self, user, cost: float = 1.0):
+        """Hold one of the scheduler's slots for the body of the block; raises ServerBusy if not admitted."""
+        await self._acquire(user, cost)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["in_flight"] = self.in_flight
+        stats["waiting"] = self.waiting
+        stats["users_waiting"] = sum(1 for n in self._queued.values() if n > 0)
+        stats["max_user_depth"] = max(self._queued.values(), default=0)
+        for name, p in (("wait_p50_ms", 0.5), ("wait_p95_ms", 0.95), ("wait_p99_ms", 0.99)):
+            value = self.wait_times.percentile(p)
+            stats[name] = round(value * 1000, 1) if value is not None else None
+        return stats
+
+
+def parse_weights(spec: str) -> dict:
+    """"alice=2,batch-bot=0.25" -> {"alice": 2.0, "batch-bot": 0.25}."""
+    weights = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        user, _, weight = item.rpartition("=")
+        if user:
+            weights[user] = float(weight)
+    return weights
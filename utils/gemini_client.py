@@ -0,0 +1,297 @@
+# utils/gemini_client.py
+"""
+Shared keep-alive HTTP clients for all Gemini traffic.
+
+One httpx.Client per process (and one httpx.AsyncClient per event loop) keeps
+TLS connections to generativelanguage.googleapis.com open across calls,
+using HTTP/2 when the h2 package is installed. Bodies are encoded and
+decoded with orjson, and every caller parses responses through parse_text()
+(or chunk_text() for streamed responses). Every request goes through a
+CallPolicy (utils/call_policy.py): rate limit, retries, circuit breaker and,
+for embeddings, optional hedging. Static prompt prefixes are passed as
+system_instruction, ahead of the per-turn message.
+"""
+import os
+import threading
+import weakref
+import asyncio
+from typing import AsyncIterator, Iterator
+import httpx
+import orjson
+from dotenv import load_dotenv
+from utils.auth import token_provider
+from utils.call_policy import CallPolicy, CallRejected
+
+load_dotenv()
+
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+
+GEMINI_MAX_CONNECTIONS = int(os.getenv("GEMINI_MAX_CONNECTIONS", "20"))
+GEMINI_MAX_KEEPALIVE = int(os.getenv("GEMINI_MAX_KEEPALIVE", "10"))
+GEMINI_KEEPALIVE_EXPIRY = float(os.getenv("GEMINI_KEEPALIVE_EXPIRY", "120"))
+GEMINI_CONNECT_TIMEOUT = float(os.getenv("GEMINI_CONNECT_TIMEOUT", "5"))
+GEMINI_READ_TIMEOUT = float(os.getenv("GEMINI_READ_TIMEOUT", "60"))
+
+try:
+    import h2  # noqa: F401  (enables httpx HTTP/2 support)
+    GEMINI_HTTP2 = os.getenv("GEMINI_HTTP2", "true").lower() == "true"
+except ImportError:
+    GEMINI_HTTP2 = False
+
+
+class GeminiError(Exception):
+    """A Gemini call failed; status_code is None for transport or parsing errors."""
+
+    def __init__(self, message: str, status_code: int = None, body: str = ""):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+class GeminiAuthError(GeminiError):
+    """No usable OAuth credentials."""
+
+
+class GeminiUnavailableError(GeminiError):
+    """The call policy failed fast: circuit open or the rate-limit wait would be too long."""
+
+
+# Client-side limits matched to the project's quota (requests per minute)
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))
+GEMINI_EMBED_RPM = float(os.getenv("GEMINI_EMBED_RPM", "1500"))
+# Requests that may go out back to back before the per-minute rate applies (default: RPM / 10)
+GEMINI_BURST = float(os.getenv("GEMINI_BURST", "0")) or None
+GEMINI_EMBED_BURST = float(os.getenv("GEMINI_EMBED_BURST", "0")) or None
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_RATE_LIMIT_MAX_WAIT = float(os.getenv("GEMINI_RATE_LIMIT_MAX_WAIT", "30"))
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_COOLDOWN = float(os.getenv("GEMINI_BREAKER_COOLDOWN", "30"))
+# Embedding calls are idempotent, so a slow one can be hedged after the p95 latency
+GEMINI_HEDGE_EMBEDDINGS = os.getenv("GEMINI_HEDGE_EMBEDDINGS", "false").lower() == "true"
+
+generate_policy = CallPolicy(
+    "gemini", GEMINI_RPM, burst=GEMINI_BURST, max_retries=GEMINI_MAX_RETRIES, max_wait=GEMINI_RATE_LIMIT_MAX_WAIT,
+    breaker_threshold=GEMINI_BREAKER_THRESHOLD, breaker_cooldown=GEMINI_BREAKER_COOLDOWN,
+)
+embed_policy = CallPolicy(
+    "gemini-embed", GEMINI_EMBED_RPM, burst=GEMINI_EMBED_BURST, max_retries=GEMINI_MAX_RETRIES, max_wait=GEMINI_RATE_LIMIT_MAX_WAIT,
+    breaker_threshold=GEMINI_BREAKER_THRESHOLD, breaker_cooldown=GEMINI_BREAKER_COOLDOWN,
+    hedge=GEMINI_HEDGE_EMBEDDINGS,
+)
+
+
+def policy_stats() -> dict:
+    return {"generate": generate_policy.stats(), "embed": embed_policy.stats()}
+
+
+_client = None
+_client_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def _client_options() -> dict:
+    return {
+        "http2": GEMINI_HTTP2,
+        "limits": httpx.Limits(
+            max_connections=GEMINI_MAX_CONNECTIONS,
+            max_keepalive_connections=GEMINI_MAX_KEEPALIVE,
+            keepalive_expiry=GEMINI_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(GEMINI_READ_TIMEOUT, connect=GEMINI_CONNECT_TIMEOUT),
+        "base_url": GEMINI_API_BASE,
+    }
+
+
+def get_client() -> httpx.Client:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(**_client_options())
+    return _client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """AsyncClients are bound to the loop that created them, so keep one per loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(**_client_options())
+        _async_clients[loop] = client
+    return client
+
+
+def _headers() -> dict:
+    access_token = token_provider.get_token()
+    if not access_token:
+        raise GeminiAuthError("Authentication failed.")
+    return {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+
+
+async def _aheaders() -> dict:
+    # Never blocks the loop on a cached token; a refresh runs in a worker thread
+    access_token = await token_provider.aget_token()
+    if not access_token:
+        raise GeminiAuthError("Authentication failed.")
+    return {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+
+
+def _decode(response: httpx.Response) -> dict:
+    if response.status_code == 401:
+        # Token revoked or expired early: mark it rejected so the next call refreshes it
+        token_provider.invalidate()
+    if response.status_code >= 400:
+        raise GeminiError(f"{response.status_code} - {response.text}", response.status_code, response.text)
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError as e:
+        raise GeminiError(f"Invalid JSON from Gemini: {e}") from e
+
+
+def _policy_for(path: str) -> CallPolicy:
+    return embed_policy if path.endswith((":embedContent", ":batchEmbedContents")) else generate_policy
+
+
+def _send(method: str, path: str, payload: dict, params: dict = None) -> httpx.Response:
+    """Send one request under the call policy; transport errors and rejections become GeminiError."""
+    content = orjson.dumps(payload)
+    headers = _headers()
+    try:
+        return _policy_for(path).execute(
+            lambda: get_client().request(method, path, content=content, params=params, headers=headers))
+    except CallRejected as e:
+        raise GeminiUnavailableError(str(e)) from e
+    except httpx.HTTPError as e:
+        raise GeminiError(str(e)) from e
+
+
+def post_json(path: str, payload: dict) -> dict:
+    """POST payload to GEMINI_API_BASE/path on the shared client and return the decoded body."""
+    return _decode(_send("POST", path, payload))
+
+
+async def apost_json(path: str, payload: dict) -> dict:
+    content = orjson.dumps(payload)
+    headers = await _aheaders()
+    try:
+        response = await _policy_for(path).aexecute(
+            lambda: get_async_client().post(path, content=content, headers=headers))
+    except CallRejected as e:
+        raise GeminiUnavailableError(str(e)) from e
+    except httpx.HTTPError as e:
+        raise GeminiError(str(e)) from e
+    return _decode(response)
+
+
+def build_payload(prompt: str, generation_config: dict = None, system_instruction: str = None) -> dict:
+    payload = {"contents": [{"parts": [{"text": prompt}]}]}
+    if system_instruction:
+        payload["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+    if generation_config:
+        payload["generationConfig"] = generation_config
+    return payload
+
+
+def parse_text(data: dict) -> str:
+    """Extract the text of the first candidate from a generateContent response."""
+    candidates = data.get("candidates") or []
+    if not candidates:
+        reason = (data.get("promptFeedback") or {}).get("blockReason")
+        raise GeminiError(f"No candidates returned from Gemini{f' (blocked: {reason})' if reason else ''}.")
+    return chunk_text(data)
+
+
+def generate_content(prompt: str, model: str = GEMINI_MODEL, generation_config: dict = None,
+                     system_instruction: str = None) -> str:
+    return parse_text(post_json(f"models/{model}:generateContent",
+                                build_payload(prompt, generation_config, system_instruction)))
+
+
+async def agenerate_content(prompt: str, model: str = GEMINI_MODEL, generation_config: dict = None,
+                            system_instruction: str = None) -> str:
+    return parse_text(await apost_json(f"models/{model}:generateContent",
+                                       build_payload(prompt, generation_config, system_instruction)))
+
+
+def chunk_text(data: dict) -> str:
+    """Text carried by one streamed chunk; chunks without candidates (e.g. usage metadata) carry none."""
+    candidates = data.get("candidates") or []
+    if not candidates:
+        return ""
+    parts = (candidates[0].get("content") or {}).get("parts") or []
+    return "".join(part.get("text", "") for part in parts)
+
+
+def _sse_data(line: str):
+    # streamGenerateContent?alt=sse sends one JSON document per "data:" line
+    if not line.startswith("data:"):
+        return None
+    try:
+        return orjson.loads(line[5:].strip())
+    except orjson.JSONDecodeError as e:
+        raise GeminiError(f"Invalid JSON in Gemini stream: {e}") from e
+
+
+def _stream(model: str, payload: dict) -> Iterator[str]:
+    client = get_client()
+    request = client.build_request("POST", f"models/{model}:streamGenerateContent", params={"alt": "sse"},
+                                   content=orjson.dumps(payload), headers=_headers())
+    try:
+        # The policy covers opening the stream; once text flows a failure is not retried
+        response = generate_policy.execute(lambda: client.send(request, stream=True))
+    except CallRejected as e:
+        raise GeminiUnavailableError(str(e)) from e
+    except httpx.HTTPError as e:
+        raise GeminiError(str(e)) from e
+    try:
+        if response.status_code >= 400:
+            response.read()
+            _decode(response)
+        for line in response.iter_lines():
+            data = _sse_data(line)
+            if data is not None:
+                text = chunk_text(data)
+                if text:
+                    yield text
+    except httpx.HTTPError as e:
+        raise GeminiError(str(e)) from e
+    finally:
+        response.close()
+
+
+def stream_generate_content(prompt: str, model: str = GEMINI_MODEL, system_instruction: str = None) -> Iterator[str]:
+    """Yield text increments from streamGenerateContent (SSE) as they arrive."""
+    yield from _stream(model, build_payload(prompt, None, system_instruction))
+
+
+async def _astream(model: str, payload: dict) -> AsyncIterator[str]:
+    client = get_async_client()
+    request = client.build_request("POST", f"models/{model}:streamGenerateContent", params={"alt": "sse"},
+                                   content=orjson.dumps(payload), headers=await _aheaders())
+    try:
+        response = await generate_policy.aexecute(lambda: client.send(request, stream=True))
+    except CallRejected as e:
+        raise GeminiUnavailableError(str(e)) from e
+    except httpx.HTTPError as e:
+        raise GeminiError(str(e)) from e
+    try:
+        if response.status_code >= 400:
+            await response.aread()
+            _decode(response)
+        async for line in response.aiter_lines():
+            data = _sse_data(line)
+            if data is not None:
+                text = chunk_text(data)
+                if text:
+                    yield text
+    except httpx.HTTPError as e:
+        raise GeminiError(str(e)) from e
+    finally:
+        await response.aclose()
+
+
+async def astream_generate_content(prompt: str, model: str = GEMINI_MODEL,
+                                   system_instruction: str = None) -> AsyncIterator[str]:
+    async for text in _astream(model, build_payload(prompt, None, system_instruction)):
+        yield text
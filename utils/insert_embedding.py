@@ -1,24 +1,16 @@
 import numpy as np
 from dotenv import load_dotenv
 import os
-from utils.db import get_connection, release_connection
-from pgvector.psycopg import register_vector  # Updated import path
+from utils.db import connection
 from psycopg import sql  # For safer SQL composition
 from embedding import generate_embedding
 # Load environment variables
 load_dotenv()
 
 def main():
-    conn = None
     try:
-        conn = get_connection()
-        if conn is None:
-            raise Exception("Failed to get database connection")
-
-        # Register vector extension for this connection
-        register_vector(conn)
-
-        with conn:
+        # Pooled connections already have the vector types registered
+        with connection() as conn:
             with conn.cursor() as cur:
                 # Create vector extension if not exists
                 cur.execute(sql.SQL("CREATE EXTENSION IF NOT EXISTS vector"))
@@ -63,9 +55,6 @@ def main():
         print(f"❌ Error inserting embedding: {e}")
         # Consider more specific error handling here
         # from psycopg import errors
-    finally:
-        if conn:
-            release_connection(conn)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,142 @@
+# utils/intent.py
+"""
+One structured-output Gemini call per turn that returns the intent, the
+calendar fields and any profile facts worth remembering.
+
+The response is constrained with responseSchema (responseMimeType
+application/json) and validated against the same schema with jsonschema, so
+code-fenced or malformed JSON can no longer slip through. The fixed rules and
+examples are sent as the system instruction, a prefix that is identical on
+every call; only the user message changes per turn.
+"""
+import json
+import logging
+import orjson
+import jsonschema
+from utils.gemini_client import generate_content, GeminiError
+
+logger = logging.getLogger(__name__)
+
+INTENTS = ["create_event", "get_event_details", "list_all_events", "confirm_event", "general"]
+# Keys match app.should_save_info's save rules
+FACT_TYPES = ["name", "favorite_color", "hobby", "favorite_movie", "contact", "explicit_request"]
+
+ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "intent": {"type": "string", "enum": INTENTS},
+        "subject": {"type": "string"},
+        "start_time": {"type": "string"},
+        "end_time": {"type": "string"},
+        "attendees": {"type": "array", "items": {"type": "string"}},
+        "location": {"type": "string"},
+        "description": {"type": "string"},
+        "query": {"type": "string"},
+        "facts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "type": {"type": "string", "enum": FACT_TYPES},
+                    "value": {"type": "string"},
+                },
+                "required": ["type", "value"],
+            },
+        },
+    },
+    "required": ["intent", "facts"],
+}
+
+ANALYSIS_INSTRUCTIONS = """You are connected to the user's Microsoft Calendar (Outlook) via the Microsoft Graph API. Do NOT reference Google Calendar or other calendar apps.
+Analyze the user message. Identify the intent, extract the calendar details it needs, and list any personal facts worth remembering.
+Intents:
+- create_event: fill subject, start_time, end_time, attendees, location, description.
+- get_event_details: fill query with the person's name or the date.
+- list_all_events: no other fields.
+- confirm_event: the user confirms a proposed event.
+- general: anything else.
+Rules:
+- Use ISO 8601 format for times (e.g., "2025-05-12T14:19:00").
+- If end_time is not specified, assume 1-hour duration.
+- If no specific date, assume tomorrow.
+- For dates like "5/12/2025", convert to "2025-05-12".
+- Location defaults to "Kitea" if not specified.
+- Attendees are optional; treat as names (not emails).
+- Subject should include the person's name (e.g., "Meeting with The Weeknd").
+- For event details, extract name or date (e.g., "Taha", "2025-05-15").
+Facts (empty list if none):
+- name: the user's name, first time or updated.
+- favorite_color, hobby, favorite_movie: the user's own preferences.
+- contact: contact details the user shares.
+- explicit_request: other information the user explicitly asks you to remember.
+Examples:
+"""
+
+# (message, expected analysis) pairs; rendered into the prompt and reused as
+# labeled centroids by the local router in utils/intent_router.py
+EXAMPLES = [
+    ("list all events", {"intent": "list_all_events", "facts": []}),
+    ("event of meeting with Mr. Taha", {"intent": "get_event_details", "query": "Taha", "facts": []}),
+    ("create meeting with The Weeknd location Kitea start time 2:19pm 5/12/2025 finish date 3:18pm 5/13/2025",
+     {"intent": "create_event", "subject": "Meeting with The Weeknd", "start_time": "2025-05-12T14:19:00",
+      "end_time": "2025-05-13T15:18:00", "attendees": [], "location": "Kitea", "description": "", "facts": []}),
+    ("details of my meeting on 2025-05-15", {"intent": "get_event_details", "query": "2025-05-15", "facts": []}),
+    ("yes all of the information is correct", {"intent": "confirm_event", "facts": []}),
+    ("hi, I'm Sara and I love hiking",
+     {"intent": "general", "facts": [{"type": "name", "value": "Sara"}, {"type": "hobby", "value": "hiking"}]}),
+]
+ANALYSIS_INSTRUCTIONS += "\n".join(f'- "{message}" -> {json.dumps(analysis)}' for message, analysis in EXAMPLES)
+
+DEFAULT_ANALYSIS = {"intent": "general", "facts": []}
+
+
+def _to_gemini_schema(schema: dict) -> dict:
+    """Convert the JSON Schema subset above into Gemini's OpenAPI-style responseSchema."""
+    converted = {"type": schema["type"].upper()}
+    if "enum" in schema:
+        converted["enum"] = schema["enum"]
+    if "properties" in schema:
+        converted["properties"] = {name: _to_gemini_schema(sub) for name, sub in schema["properties"].items()}
+    if "items" in schema:
+        converted["items"] = _to_gemini_schema(schema["items"])
+    if "required" in schema:
+        converted["required"] = schema["required"]
+    return converted
+
+
+GENERATION_CONFIG = {
+    "responseMimeType": "application/json",
+    "responseSchema": _to_gemini_schema(ANALYSIS_SCHEMA),
+}
+
+
+def build_analysis_prompt(user_message: str) -> str:
+    # Only the message varies per turn; ANALYSIS_INSTRUCTIONS goes in the static system instruction
+    return f'User message: "{user_message}"'
+
+
+def parse_analysis(text: str) -> dict:
+    """Decode and schema-validate an analysis response; falls back to a general intent with no facts."""
+    text = text.strip()
+    if text.startswith("```"):
+        # responseMimeType should prevent fences, but tolerate them rather than drop the turn
+        text = text.strip("`").removeprefix("json").strip()
+    try:
+        data = orjson.loads(text)
+        jsonschema.validate(data, ANALYSIS_SCHEMA)
+    except (orjson.JSONDecodeError, jsonschema.ValidationError) as e:
+        logger.warning("Invalid analysis response (%s): %r", getattr(e, "message", e), text[:200])
+        return dict(DEFAULT_ANALYSIS)
+    return data
+
+
+def analyze_message(user_message: str) -> dict:
+    """Return {"intent": ..., calendar fields..., "facts": [{"type", "value"}, ...]} for one message."""
+    try:
+        response = generate_content(build_analysis_prompt(user_message), generation_config=GENERATION_CONFIG,
+                                    system_instruction=ANALYSIS_INSTRUCTIONS)
+    except GeminiError as e:
+        logger.error("Analysis call failed: %s", e)
+        return dict(DEFAULT_ANALYSIS)
+    print(f"Analysis response: {response}")
+    return parse_analysis(response)
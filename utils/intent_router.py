@@ -0,0 +1,435 @@
+# utils/intent_router.py
+"""
+Local fast path in front of analyze_message().
+
+Common calendar commands ("show my meetings tomorrow", "details of meeting
+with Taha", "yes that's correct") are classified without a Gemini round trip:
+
+1. Compiled patterns match the command phrasings the app already supports.
+2. Otherwise a nearest-centroid classifier compares the message with the
+   labeled examples from the intent prompt (plus a few paraphrases below),
+   embedded once with the local hashed n-gram provider.
+3. Date/time, name and location slots are extracted with regexes.
+
+route_intent() returns an analysis dict shaped like analyze_message()'s, or
+None when the router is not confident (score below INTENT_ROUTER_THRESHOLD,
+too close to the runner-up, a pattern hit the centroid confidently disagrees
+with, or required slots missing). Messages with a date or time the regexes
+can't resolve ("13/05/2025", "next friday", "at 3") and requests to change
+or cancel an event also fall through. General chat is only routed when the
+message carries no personal facts, since fact extraction is Gemini's job.
+confirm_event creates the pending calendar event, so it is only routed on an
+explicit, anchored confirmation (_CONFIRM_RE) with no negation and no
+question mark, never on centroid similarity.
+
+    python -m utils.intent_router data/intent_eval.jsonl   # bypass rate and accuracy
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import threading
+import numpy as np
+from dotenv import load_dotenv
+from utils.embedding_providers import LocalEmbeddingProvider
+from utils.intent import EXAMPLES
+
+load_dotenv()
+
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER_ENABLED", "true").lower() == "true"
+INTENT_ROUTER_THRESHOLD = float(os.getenv("INTENT_ROUTER_THRESHOLD", "0.3"))
+INTENT_ROUTER_MIN_MARGIN = float(os.getenv("INTENT_ROUTER_MIN_MARGIN", "0.08"))
+DEFAULT_LOCATION = "Kitea"
+
+# Paraphrases added to the prompt examples to give every centroid some spread
+ROUTER_EXAMPLES = [
+    ("show me all my events", "list_all_events"),
+    ("what is on my calendar", "list_all_events"),
+    ("list my meetings", "list_all_events"),
+    ("what meetings do I have", "list_all_events"),
+    ("show my meetings tomorrow", "get_event_details"),
+    ("when is my meeting with John", "get_event_details"),
+    ("details of the meeting with Sara", "get_event_details"),
+    ("do I have anything scheduled on friday", "get_event_details"),
+    ("schedule a meeting with Anna tomorrow at 3pm", "create_event"),
+    ("book a call with Taha at 10am on 2025-06-01", "create_event"),
+    ("add an event lunch with Mike at noon", "create_event"),
+    ("yes create it", "confirm_event"),
+    ("that's correct", "confirm_event"),
+    ("looks good, go ahead", "confirm_event"),
+    ("how are you today", "general"),
+    ("what can you do", "general"),
+    ("tell me a joke", "general"),
+    ("thanks", "general"),
+    ("hello", "general"),
+    ("hi there", "general"),
+    ("good morning", "general"),
+    ("what is the capital of France", "general"),
+]
+
+_HONORIFIC = r"(?:mr|mrs|ms|miss|dr|prof)\.?\s+"
+_STOP = r"(?=\s+(?:on|at|from|to|for|tomorrow|today|location|start|end|finish|starting|ending|about)\b|\s+\d|[?.!,]|$)"
+
+_LIST_RE = re.compile(
+    r"^(?:please\s+)?(?:list|show|display|give)\s+(?:me\s+)?(?:all\s+)?(?:of\s+)?(?:my\s+)?(?:calendar\s+)?"
+    r"(?:events|meetings|appointments|calendar)\b"
+    r"|^what(?:'s| is)\s+on\s+my\s+calendar\b"
+    r"|^(?:what|which)\s+(?:events|meetings)\s+do\s+i\s+have\b",
+    re.IGNORECASE)
+_DETAILS_RE = re.compile(
+    r"\b(?:event|details|info(?:rmation)?)\s+(?:of|for|about)\b"
+    r"|\bwhen\s+is\s+(?:my|the)\s+(?:meeting|event|call)\b"
+    r"|\b(?:meeting|event)s?\s+(?:with|on)\b",
+    re.IGNORECASE)
+_CREATE_RE = re.compile(
+    r"\b(?:create|schedule|book|add|set\s+up|arrange|make)\s+(?:(?:a|an|new|another)\s+)*"
+    r"(?:meeting|event|call|appointment)\b",
+    re.IGNORECASE)
+# Changes to existing events have no local handler; Gemini decides what they mean
+_MODIFY_RE = re.compile(
+    r"\b(?:cancel|delete|remove|move|reschedule|postpone|push\s+back|change|update|edit|rename)\b",
+    re.IGNORECASE)
+# Anything that could turn a confirmation into a refusal or a question
+_NEGATION_RE = re.compile(r"\b(?:no|not|nope|nah|never|don'?t|do\s+not|wrong|incorrect|cancel|stop|wait)\b|n't\b|\?",
+                          re.IGNORECASE)
+_CONFIRM_RE = re.compile(
+    r"^(?:yes|yep|yeah|sure|ok(?:ay)?|correct|confirm(?:ed)?|looks good|that'?s (?:right|correct)|go ahead)\b"
+    r"(?:[\s,.!]+(?:go\s+ahead|create\s+it|do\s+it|that'?s\s+(?:right|correct)|(?:all\s+of\s+)?(?:the\s+)?(?:information|details|it|that|everything)?\s*"
+    r"(?:is|are|looks?)?\s*(?:correct|right|good|fine)?))*[\s.!]*$",
+    re.IGNORECASE)
+# Anything that may carry a fact to save, or a question Gemini should answer
+_FACT_CUE_RE = re.compile(
+    r"\b(?:my\s+name|i\s*'?\s*a?m\s+\w+|call\s+me|i\s+(?:love|like|enjoy|prefer|hate)|my\s+(?:favou?rite|hobby|email|phone|number)"
+    r"|remember|willing\s+to\s+share)\b",
+    re.IGNORECASE)
+_CALENDAR_CUE_RE = re.compile(r"\b(?:calendar|event|meeting|appointment|schedule|book)\w*\b", re.IGNORECASE)
+
+_NAME_RE = re.compile(rf"\bwith\s+(?:{_HONORIFIC})?([A-Za-z][\w'-]*(?:\s+(?!(?:on|at|from|to|for|tomorrow|today|location|start|end|finish)\b)[A-Za-z][\w'-]*){{0,2}}){_STOP}", re.IGNORECASE)
+_LOCATION_RE = re.compile(rf"\b(?:location|at\s+the|in)\s+([A-Z][\w'-]*(?:\s+[A-Z][\w'-]*)*){_STOP}")
+_ISO_DATE_RE = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+_US_DATE_RE = re.compile(r"\b(\d{1,2})/(\d{1,2})/(\d{4})\b")
+_RELATIVE_DATE_RE = re.compile(r"\b(today|tomorrow)\b", re.IGNORECASE)
+_TIME_RE = re.compile(r"\b(\d{1,2})(?::(\d{2}))?\s*(am|pm)\b|\b(\d{1,2}):(\d{2})\b|\b(noon|midnight)\b", re.IGNORECASE)
+# Date and time mentions in any form; one that doesn't start where a parsed mention does is unresolved
+_DURATION_RE = re.compile(r"\bfor\s+(\d+(?:\.\d+)?|an?|one|two|three)\s*(minutes?|mins?|hours?|hrs?|h)\b",
+                          re.IGNORECASE)
+_DURATION_WORDS = {"a": 1, "an": 1, "one": 1, "two": 2, "three": 3}
+_DURATION_CUE_RE = re.compile(r"\b(?:minutes?|mins?|hours?|hrs?|half)\b", re.IGNORECASE)
+_DATE_CUE_RE = re.compile(
+    r"\b\d{1,4}[/.-]\d{1,2}(?:[/.-]\d{2,4})?\b"
+    r"|\b(?:mon|tues|wednes|thurs|fri|satur|sun)day\b|\bweekend\b|\btonight\b"
+    r"|\b(?:next|this|last)\s+(?:week|month|year|morning|afternoon|evening)\b|\bday\s+after\b"
+    r"|\b(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?\s+\d{1,2}(?:st|nd|rd|th)?\b"
+    r"|\b\d{1,2}(?:st|nd|rd|th)?\s+(?:of\s+)?(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\b"
+    r"|\bin\s+(?:\d+|a|an|two|three)\s+(?:days?|weeks?|months?)\b",
+    re.IGNORECASE)
+_TIME_CUE_RE = re.compile(r"\b\d{1,2}\s*o'?clock\b|\bat\s+\d{1,2}\b(?!\s*(?::\d|am\b|pm\b|[ap]\.m\.))",
+                          re.IGNORECASE)
+
+
+def _parse_dates(text: str, today: datetime.date) -> list:
+    """(position, date) for every date mention, in order."""
+    dates = []
+    for m in _ISO_DATE_RE.finditer(text):
+        dates.append((m.start(), (int(m.group(1)), int(m.group(2)), int(m.group(3)))))
+    for m in _US_DATE_RE.finditer(text):
+        dates.append((m.start(), (int(m.group(3)), int(m.group(1)), int(m.group(2)))))
+    for m in _RELATIVE_DATE_RE.finditer(text):
+        offset = 0 if m.group(1).lower() == "today" else 1
+        day = today + datetime.timedelta(days=offset)
+        dates.append((m.start(), (day.year, day.month, day.day)))
+    parsed = []
+    for pos, ymd in sorted(dates):
+        try:
+            parsed.append((pos, datetime.date(*ymd)))
+        except ValueError:
+            continue
+    return parsed
+
+
+def _parse_times(text: str) -> list:
+    """(position, time) for every clock-time mention, in order."""
+    times = []
+    for m in _TIME_RE.finditer(text):
+        if m.group(6):
+            hour, minute = (12, 0) if m.group(6).lower() == "noon" else (0, 0)
+        elif m.group(3):
+            hour, minute = int(m.group(1)) % 12, int(m.group(2) or 0)
+            if m.group(3).lower() == "pm":
+                hour += 12
+        else:
+            hour, minute = int(m.group(4)), int(m.group(5))
+        if hour < 24 and minute < 60:
+            times.append((m.start(), datetime.time(hour, minute)))
+    return times
+
+
+def extract_slots(text: str, today: datetime.date = None) -> dict:
+    """
+    Regex slot extraction: name (after "with", honorifics dropped), location,
+    dates (ISO, m/d/yyyy, today/tomorrow) and datetimes. Each time is paired
+    with the nearest date mention; times without any date fall on tomorrow,
+    matching the intent prompt's rules. A single "for N minutes/hours" becomes
+    duration_minutes. "unresolved" is set when some date, time or duration
+    mention couldn't be parsed, so the slots can't be trusted.
+    """
+    today = today or datetime.date.today()
+    slots = {}
+    name = _NAME_RE.search(text)
+    if name:
+        slots["name"] = name.group(1).strip()
+    location = _LOCATION_RE.search(text)
+    if location:
+        slots["location"] = location.group(1).strip()
+
+    dates = _parse_dates(text, today)
+    if dates:
+        slots["dates"] = [d.isoformat() for _, d in dates]
+    parsed_at = {pos for pos, _ in dates}
+    if any(m.start() not in parsed_at for m in _DATE_CUE_RE.finditer(text)) or _TIME_CUE_RE.search(text):
+        slots["unresolved"] = True
+    durations = list(_DURATION_RE.finditer(text))
+    if len(durations) == 1:
+        amount, unit = durations[0].group(1).lower(), durations[0].group(2).lower()
+        amount = _DURATION_WORDS[amount] if amount in _DURATION_WORDS else float(amount)
+        slots["duration_minutes"] = amount * (1 if unit.startswith("m") else 60)
+    consumed = [m.span() for m in durations] if len(durations) == 1 else []
+    if any(not any(start <= m.start() < end for start, end in consumed) for m in _DURATION_CUE_RE.finditer(text)):
+        # "for an hour and a half", "45 minutes long", two durations: let Gemini work out the end
+        slots["unresolved"] = True
+    datetimes = []
+    for pos, t in _parse_times(text):
+        if dates:
+            day = min(dates, key=lambda item: abs(item[0] - pos))[1]
+        else:
+            day = today + datetime.timedelta(days=1)
+        datetimes.append(datetime.datetime.combine(day, t))
+    if datetimes:
+        slots["datetimes"] = [dt.isoformat() for dt in datetimes]
+    return slots
+
+
+class CentroidClassifier:
+    """Nearest-centroid intent classifier over L2-normalized local embeddings."""
+
+    def __init__(self, examples: list, provider=None):
+        self.provider = provider or LocalEmbeddingProvider()
+        by_intent = {}
+        for text, intent in examples:
+            by_intent.setdefault(intent, []).append(text)
+        self.intents = sorted(by_intent)
+        centroids = []
+        for intent in self.intents:
+            vectors = np.array([v for v in self.provider.embed_batch(by_intent[intent]) if v is not None])
+            centroid = vectors.mean(axis=0)
+            centroids.append(centroid / np.linalg.norm(centroid))
+        self.centroids = np.vstack(centroids)
+
+    def scores(self, text: str) -> dict:
+        """Cosine similarity of text to every intent's centroid."""
+        vector = self.provider.embed(text)
+        if vector is None:
+            return {}
+        return dict(zip(self.intents, (float(score) for score in self.centroids @ np.asarray(vector))))
+
+    def classify(self, text: str) -> tuple:
+        """Return (intent, cosine similarity, margin over the runner-up)."""
+        scores = self.scores(text)
+        if not scores:
+            return "general", 0.0, 0.0
+        (intent, best), (_, second) = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:2]
+        return intent, best, best - second
+
+
+_classifier = None
+_classifier_lock = threading.Lock()
+_stats = {"routed": 0, "fallthrough": 0}
+
+
+def get_classifier() -> CentroidClassifier:
+    global _classifier
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                examples = [(text, analysis["intent"]) for text, analysis in EXAMPLES] + ROUTER_EXAMPLES
+                _classifier = CentroidClassifier(examples)
+    return _classifier
+
+
+def _build(intent: str, slots: dict, text: str):
+    """Turn an intent plus slots into an analysis dict, or None if required slots are missing."""
+    if intent == "list_all_events":
+        if slots.get("name") and slots.get("dates"):
+            return None  # two filters; get_event_details takes one query
+        if slots.get("name"):
+            # "show all events with Ali" keeps its attendee filter
+            return {"intent": "get_event_details", "query": slots["name"], "facts": []}
+        if slots.get("dates"):
+            # "show my meetings tomorrow" is a date lookup, not the full list
+            return {"intent": "get_event_details", "query": slots["dates"][0], "facts": []}
+        return {"intent": "list_all_events", "facts": []}
+    if intent == "get_event_details":
+        query = slots.get("name") or (slots.get("dates") or [None])[0]
+        if not query:
+            return None
+        return {"intent": "get_event_details", "query": query, "facts": []}
+    if intent == "create_event":
+        datetimes = slots.get("datetimes") or []
+        name = slots.get("name")
+        if not datetimes or not name:
+            return None
+        start = datetime.datetime.fromisoformat(datetimes[0])
+        if len(datetimes) > 1 and "duration_minutes" in slots:
+            return None  # an end time and a duration: let Gemini reconcile them
+        if len(datetimes) > 1:
+            end = datetime.datetime.fromisoformat(datetimes[1])
+        else:
+            end = start + datetime.timedelta(minutes=slots.get("duration_minutes", 60))
+        if end <= start:
+            return None
+        return {
+            "intent": "create_event",
+            "subject": f"Meeting with {name}",
+            "start_time": start.isoformat(),
+            "end_time": end.isoformat(),
+            "attendees": [],
+            "location": slots.get("location", DEFAULT_LOCATION),
+            "description": "",
+            "facts": [],
+        }
+    if intent == "confirm_event":
+        if not _CONFIRM_RE.search(text) or _NEGATION_RE.search(text):
+            return None
+        return {"intent": "confirm_event", "facts": []}
+    if intent == "general":
+        if _FACT_CUE_RE.search(text) or _CALENDAR_CUE_RE.search(text):
+            return None
+        return {"intent": "general", "facts": []}
+    return None
+
+
+def classify(text: str, threshold: float = None, today: datetime.date = None):
+    """
+    Route one message locally. Returns (analysis or None, details), where
+    details records the source ("pattern" / "centroid", or why it fell
+    through), intent and centroid score.
+    """
+    threshold = INTENT_ROUTER_THRESHOLD if threshold is None else threshold
+    stripped = text.strip()
+    slots = extract_slots(stripped, today)
+
+    if _FACT_CUE_RE.search(stripped):
+        # Facts need Gemini's extraction even inside a calendar command
+        return None, {"source": "fact_cue", "intent": None, "score": 0.0}
+    if _MODIFY_RE.search(stripped):
+        return None, {"source": "modify", "intent": None, "score": 0.0}
+
+    scores = get_classifier().scores(stripped)
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True) or [("general", 0.0)]
+    intent, score = ranked[0]
+    margin = score - ranked[1][1] if len(ranked) > 1 else 0.0
+    confident = score >= threshold and margin >= INTENT_ROUTER_MIN_MARGIN
+    details = {"source": "centroid", "intent": intent, "score": score, "margin": margin}
+    for name, pattern in (("confirm_event", _CONFIRM_RE), ("create_event", _CREATE_RE),
+                          ("list_all_events", _LIST_RE), ("get_event_details", _DETAILS_RE)):
+        if pattern.search(stripped):
+            if confident and intent != name and {intent, name} != {"list_all_events", "get_event_details"}:
+                # The phrasing matched one intent but the message reads like another
+                return None, dict(details, source="disagree", pattern=name)
+            details = dict(details, source="pattern", intent=name, score=scores.get(name, 0.0))
+            intent, confident = name, True
+            break
+    if not confident:
+        return None, details
+    if intent == "confirm_event" and details["source"] != "pattern":
+        # Confirming creates the pending event; a similarity guess must never do that
+        return None, dict(details, source="unconfirmed")
+    if slots.get("unresolved") and intent in ("create_event", "get_event_details", "list_all_events"):
+        # A date or time we couldn't parse would otherwise silently become "tomorrow" or be dropped
+        return None, dict(details, source="unresolved_date")
+    return _build(intent, slots, stripped), details
+
+
+def route_intent(text: str):
+    """Return a confident local analysis for text, or None to fall through to analyze_message()."""
+    if not INTENT_ROUTER_ENABLED:
+        return None
+    analysis, details = classify(text)
+    with _classifier_lock:
+        _stats["routed" if analysis else "fallthrough"] += 1
+    if analysis:
+        print(f"⚡ Routed locally ({details['source']}, {details['score']:.2f}): {analysis['intent']}")
+    return analysis
+
+
+def router_stats() -> dict:
+    with _classifier_lock:
+        stats = dict(_stats)
+    total = stats["routed"] + stats["fallthrough"]
+    stats["bypass_rate"] = stats["routed"] / total if total else 0.0
+    return stats
+
+
+def evaluate(path: str, threshold: float = None) -> dict:
+    """
+    Score the router on a JSONL file of {"text", "intent"[, "query"][, "start_time"][, "end_time"][, "route"]}
+    rows, disjoint from the examples the centroids are built from. Bypass rate
+    is the share routed locally; accuracy is over routed rows only (intent must
+    match, and query / start_time / end_time too when the row specifies them). Rows with
+    "route": false must fall through to Gemini; routing one counts as an error.
+    """
+    rows = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rows.append(json.loads(line))
+    today = datetime.date(2025, 5, 11)  # fixed so relative dates in the set are reproducible
+    routed = correct = 0
+    errors = []
+    per_intent = {}
+    for row in rows:
+        analysis, details = classify(row["text"], threshold, today)
+        counts = per_intent.setdefault(row["intent"], {"total": 0, "routed": 0, "correct": 0})
+        counts["total"] += 1
+        if analysis is None:
+            continue
+        routed += 1
+        counts["routed"] += 1
+        ok = (row.get("route", True)
+              and analysis["intent"] == row["intent"]
+              and all(str(analysis.get(key, "")).lower() == row[key].lower()
+                      for key in ("query", "start_time", "end_time") if key in row))
+        if ok:
+            correct += 1
+            counts["correct"] += 1
+        else:
+            errors.append((row["text"], row["intent"], analysis["intent"],
+                           analysis.get("query") or analysis.get("start_time"), details["source"]))
+    return {
+        "total": len(rows),
+        "routed": routed,
+        "bypass_rate": routed / len(rows) if rows else 0.0,
+        "accuracy": correct / routed if routed else 0.0,
+        "per_intent": per_intent,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the local intent router on a labeled set.")
+    parser.add_argument("path", nargs="?", default=os.path.join("data", "intent_eval.jsonl"))
+    parser.add_argument("--threshold", type=float, default=None)
+    args = parser.parse_args()
+
+    report = evaluate(args.path, args.threshold)
+    print(f"Messages: {report['total']}  routed locally: {report['routed']}  "
+          f"bypass rate: {report['bypass_rate']:.1%}  accuracy: {report['accuracy']:.1%}")
+    for intent, counts in sorted(report["per_intent"].items()):
+        print(f"  {intent:18} {counts['routed']:3}/{counts['total']:<3} routed  {counts['correct']:3} correct")
+    for text, expected, got, query, source in report["errors"]:
+        print(f"  ✗ {text!r}: expected {expected}, got {got} ({query!r}, via {source})")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,45 @@
 # utils/memory_manager.py
-from utils.db import retrieve_similar_data
 from utils.embedding import generate_embedding
-from utils.db import retrieve_similar_data, retrieve_user_data
+from utils.db import retrieve_similar_data
+from utils.profile import get_profile
 
 def get_relevant_memories(user_id: str, query: str, top_n: int = 3):
     query_embedding = generate_embedding(query)
     if query_embedding:
-        relevant_data = retrieve_similar_data(user_id, query, top_k=top_n)
+        relevant_data = retrieve_similar_data(user_id, query, top_k=top_n, query_embedding=query_embedding)
         return relevant_data
     else:
         return []
 
-def format_memory_context(user_id: str, memories: list, last_user_message: str) -> str:
+def format_memory_context(user_id: str, memories: list, last_user_message: str, used_keys: set = None) -> str:
     """
     Formats a list of memories into a context string for the LLM prompt,
     including specific user information conditionally.
+    If used_keys is given, every profile key the context depends on is added to
+    it, whether or not it had a value: setting a key that was empty changes the
+    prompt just as much as changing one that was shown.
     """
+    used_keys = set() if used_keys is None else used_keys
     context_parts = []
-    user_name = retrieve_user_data(user_id, "name")
-    favorite_color = retrieve_user_data(user_id, "favorite_color")
-    hobby = retrieve_user_data(user_id, "hobby")
+    profile = get_profile(user_id)  # one query, cached per user
+    user_name = profile.name
+    favorite_color = profile.favorite_color
+    hobby = profile.hobby
 
+    used_keys.add("name")
     if user_name:
         context_parts.append(f"The user's name is {user_name}.")
 
-    if favorite_color:
-        # Only include favorite color if the user's question is related to colors
-        if any(keyword in last_user_message.lower() for keyword in ["color", "favourite", "like"]):
+    # Only include favorite color if the user's question is related to colors
+    if any(keyword in last_user_message.lower() for keyword in ["color", "favourite", "like"]):
+        used_keys.add("favorite_color")
+        if favorite_color:
             context_parts.append(f"The user's favorite color is {favorite_color}.")
 
-    if hobby:
-        # Only include hobby if the user's question is related to hobbies or activities
-        if any(keyword in last_user_message.lower() for keyword in ["hobby", "play", "do", "activity"]):
+    # Only include hobby if the user's question is related to hobbies or activities
+    if any(keyword in last_user_message.lower() for keyword in ["hobby", "play", "do", "activity"]):
+        used_keys.add("hobby")
+        if hobby:
             context_parts.append(f"The user's favorite hobby is {hobby}.")
 
     if memories:
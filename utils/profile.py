@@ -0,0 +1,104 @@
+# utils/profile.py
+"""
+User profile (all user_data keys for a user) loaded in one query and cached.
+
+format_memory_context used to issue one SELECT per key; get_profile() reads
+every key at once and keeps the result for PROFILE_CACHE_TTL seconds.
+Writers call invalidate_profile() after upserting a key so the next read in
+this process sees it; other processes pick it up when their TTL expires.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from utils.db import connection
+
+load_dotenv()
+
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "300"))
+PROFILE_CACHE_MAX_USERS = int(os.getenv("PROFILE_CACHE_MAX_USERS", "10000"))
+
+
+class UserProfile:
+    """Read-only view of a user's user_data rows."""
+
+    __slots__ = ("user_id", "data", "loaded_at")
+
+    def __init__(self, user_id: str, data: dict, loaded_at: float = None):
+        self.user_id = user_id
+        self.data = data
+        self.loaded_at = loaded_at if loaded_at is not None else time.monotonic()
+
+    def get(self, key: str, default=None):
+        return self.data.get(key, default)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.data
+
+    @property
+    def name(self):
+        return self.data.get("name")
+
+    @property
+    def favorite_color(self):
+        return self.data.get("favorite_color")
+
+    @property
+    def hobby(self):
+        return self.data.get("hobby")
+
+    def __repr__(self):
+        return f"UserProfile({self.user_id!r}, {len(self.data)} keys)"
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+
+def load_profile(user_id: str) -> UserProfile:
+    """Fetch every user_data key for user_id in a single round trip (no caching)."""
+    try:
+        with connection() as conn:
+            rows = conn.execute(
+                "SELECT data_key, data_value FROM user_data WHERE user_id = %s",
+                (user_id,)
+            ).fetchall()
+    except Exception as e:
+        print(f"Error loading user profile: {e}")
+        # Not cached, so the next call retries the database
+        return UserProfile(user_id, {})
+    profile = UserProfile(user_id, dict(rows))
+    with _cache_lock:
+        _cache[user_id] = profile
+        _cache.move_to_end(user_id)
+        while len(_cache) > PROFILE_CACHE_MAX_USERS:
+            _cache.popitem(last=False)
+    return profile
+
+
+def get_profile(user_id: str) -> UserProfile:
+    """Return the cached profile for user_id, loading it if missing or older than the TTL."""
+    with _cache_lock:
+        profile = _cache.get(user_id)
+        if profile is not None and time.monotonic() - profile.loaded_at < PROFILE_CACHE_TTL:
+            _cache.move_to_end(user_id)
+            _stats["hits"] += 1
+            return profile
+        _stats["misses"] += 1
+    return load_profile(user_id)
+
+
+def invalidate_profile(user_id: str):
+    """Drop the cached profile after one of the user's keys was written."""
+    with _cache_lock:
+        if _cache.pop(user_id, None) is not None:
+            _stats["invalidations"] += 1
+
+
+def profile_cache_stats() -> dict:
+    with _cache_lock:
+        stats = dict(_stats)
+        stats["users"] = len(_cache)
+    return stats
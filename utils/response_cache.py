@@ -0,0 +1,162 @@
+# utils/response_cache.py
+"""
+Per-user semantic cache of assistant answers, keyed by the query embedding.
+
+A general question whose embedding is within RESPONSE_CACHE_THRESHOLD cosine
+similarity of one the same user asked less than RESPONSE_CACHE_TTL seconds
+ago gets the stored answer back, skipping retrieval and generation. Each
+entry records which profile keys (name, hobby, ...) its prompt contained;
+invalidate() drops the entries that depended on a key that was just written.
+Callers decide what is cacheable: calendar intents, turns that shared new
+facts and questions failing is_cacheable_query() (time-sensitive ones, or
+follow-ups that only make sense with the preceding conversation) should
+never reach store().
+"""
+import itertools
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_MAX_PER_USER = int(os.getenv("RESPONSE_CACHE_MAX_PER_USER", "200"))
+
+# Answers to these depend on the clock or on live data, not just on the question
+_TIME_SENSITIVE_RE = re.compile(
+    r"\b(?:today|tonight|tomorrow|yesterday|now|currently|current|latest|recent|this\s+(?:week|month|year)|next\s+\w+"
+    r"|time|date|weather|news|calendar|events?|meetings?|schedule\w*)\b",
+    re.IGNORECASE)
+# Follow-ups ("why?", "what about her?") depend on the conversation, not just the question
+_FOLLOW_UP_RE = re.compile(
+    r"^\s*(?:and|but|so|why|what about|how about|also)\b|\b(?:it|that|this|those|these|them|he|she|him|her|they)\b",
+    re.IGNORECASE)
+
+
+def is_time_sensitive(text: str) -> bool:
+    return bool(_TIME_SENSITIVE_RE.search(text))
+
+
+def is_cacheable_query(text: str) -> bool:
+    """Self-contained, time-insensitive questions only."""
+    return not _TIME_SENSITIVE_RE.search(text) and not _FOLLOW_UP_RE.search(text)
+
+
+class _Entry:
+    __slots__ = ("user_id", "query", "vector", "answer", "depends_on", "created_at")
+
+    def __init__(self, user_id, query, vector, answer, depends_on):
+        self.user_id = user_id
+        self.query = query
+        self.vector = vector
+        self.answer = answer
+        self.depends_on = frozenset(depends_on)
+        self.created_at = time.monotonic()
+
+
+class ResponseCache:
+    def __init__(self, threshold: float = RESPONSE_CACHE_THRESHOLD, ttl: float = RESPONSE_CACHE_TTL,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, max_per_user: int = RESPONSE_CACHE_MAX_PER_USER):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_per_user = max_per_user
+        # entry id -> entry in LRU order across all users, plus a per-user index for lookups
+        self._entries = OrderedDict()
+        self._by_user = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _drop(self, entry_id):
+        """Remove one entry from both indexes. Caller holds the lock."""
+        entry = self._entries.pop(entry_id)
+        user_entries = self._by_user[entry.user_id]
+        del user_entries[entry_id]
+        if not user_entries:
+            del self._by_user[entry.user_id]
+
+    def lookup(self, user_id: str, embedding):
+        """Return the cached answer closest to embedding for user_id, or None."""
+        if not embedding:
+            return None
+        vector = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            user_entries = self._by_user.get(user_id, {})
+            for entry_id in [i for i, e in user_entries.items() if now - e.created_at >= self.ttl]:
+                self._drop(entry_id)
+                self._stats["expirations"] += 1
+            user_entries = self._by_user.get(user_id)
+            if not user_entries:
+                self._stats["misses"] += 1
+                return None
+            ids = list(user_entries)
+            scores = np.vstack([user_entries[i].vector for i in ids]) @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self._stats["misses"] += 1
+                return None
+            # Refresh recency in both orders so per-user eviction is LRU too
+            self._entries.move_to_end(ids[best])
+            user_entries.move_to_end(ids[best])
+            self._stats["hits"] += 1
+            return user_entries[ids[best]].answer
+
+    def store(self, user_id: str, query: str, embedding, answer: str, depends_on=()):
+        """Cache answer for query; depends_on lists the profile keys its prompt used."""
+        if not embedding or not answer:
+            return
+        entry = _Entry(user_id, query, self._normalize(embedding), answer, depends_on)
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = entry
+            user_entries = self._by_user.setdefault(user_id, OrderedDict())
+            user_entries[entry_id] = entry
+            self._stats["stores"] += 1
+            while len(user_entries) > self.max_per_user:
+                self._drop(next(iter(user_entries)))
+                self._stats["evictions"] += 1
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def invalidate(self, user_id: str, keys=None):
+        """Drop user_id's entries that depended on any of keys (all of them if keys is None)."""
+        keys = None if keys is None else set(keys)
+        with self._lock:
+            user_entries = self._by_user.get(user_id, {})
+            stale = [i for i, e in user_entries.items() if keys is None or e.depends_on & keys]
+            for entry_id in stale:
+                self._drop(entry_id)
+            self._stats["invalidations"] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["users"] = len(self._by_user)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+response_cache = ResponseCache()
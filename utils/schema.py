@@ -0,0 +1,430 @@
+# utils/schema.py
+"""
+Schema and ANN index management for the user_messages embeddings.
+
+    python -m utils.schema init                 # tables, btree + default ANN index
+    python -m utils.schema hnsw --m 16          # build the HNSW index
+    python -m utils.schema ivfflat --lists 1000 # optional IVFFlat index
+    python -m utils.schema partial <user_id>    # dedicated index for a heavy user
+    python -m utils.schema status               # list indexes and their sizes
+    python -m utils.schema quantize             # add + backfill + index the VECTOR_STORAGE column
+    python -m utils.schema quantize --mode both --drop-full-index
+    python -m utils.schema quant-report         # recall vs size of the compact forms
+
+Every index uses vector_cosine_ops so it serves the `<=>` queries in utils/db.py.
+"""
+import argparse
+import hashlib
+import os
+from dotenv import load_dotenv
+from psycopg import sql
+from utils.db import apply_search_settings, connection, search_user_messages, VECTOR_STORAGE, COMPACT_COLUMNS
+
+load_dotenv()
+
+EMBEDDING_DIM = 768
+
+# Build parameters (query-time knobs live in utils/db.py)
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+IVFFLAT_LISTS = int(os.getenv("IVFFLAT_LISTS", "100"))  # ~rows/1000 up to 1M rows, sqrt(rows) above
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "hnsw")  # hnsw | ivfflat
+INDEX_MAINTENANCE_WORK_MEM = os.getenv("INDEX_MAINTENANCE_WORK_MEM", "")  # e.g. "2GB" to keep HNSW builds in memory
+
+HNSW_INDEX = "user_messages_embedding_hnsw_idx"
+IVFFLAT_INDEX = "user_messages_embedding_ivfflat_idx"
+USER_ID_INDEX = "user_messages_user_id_idx"
+PARTIAL_INDEX_PREFIX = "user_messages_embedding_user_"
+HALFVEC_INDEX = "user_messages_embedding_half_hnsw_idx"
+BINARY_INDEX = "user_messages_embedding_bin_hnsw_idx"
+
+
+def ensure_schema():
+    """Create the extension, tables and supporting indexes if they are missing."""
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            cur.execute(sql.SQL("""
+                CREATE TABLE IF NOT EXISTS user_messages (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    session_id TEXT,
+                    message_text TEXT NOT NULL,
+                    embedding vector({dim}),
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """).format(dim=sql.Literal(EMBEDDING_DIM)))
+            # Older deployments created user_messages without these columns
+            cur.execute("ALTER TABLE user_messages ADD COLUMN IF NOT EXISTS id BIGSERIAL")
+            cur.execute("ALTER TABLE user_messages ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now()")
+            # Write-behind embedding queue (utils/embedding_queue.py): pending rows have a NULL embedding
+            cur.execute("ALTER TABLE user_messages ADD COLUMN IF NOT EXISTS embedding_attempts INT NOT NULL DEFAULT 0")
+            cur.execute("ALTER TABLE user_messages ADD COLUMN IF NOT EXISTS embedding_claimed_until TIMESTAMPTZ")
+            cur.execute("CREATE INDEX IF NOT EXISTS user_messages_pending_embedding_idx ON user_messages (id) WHERE embedding IS NULL")
+            cur.execute(sql.SQL("""
+                CREATE TABLE IF NOT EXISTS user_data (
+                    user_id TEXT NOT NULL,
+                    data_key TEXT NOT NULL,
+                    data_value TEXT,
+                    embedding vector({dim}),
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (user_id, data_key)
+                )
+            """).format(dim=sql.Literal(EMBEDDING_DIM)))
+            # Persistent tier of utils/embedding_cache.py
+            cur.execute(sql.SQL("""
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    embedding vector({dim}) NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (model, text_hash)
+                )
+            """).format(dim=sql.Literal(EMBEDDING_DIM)))
+            # Shared websocket session state (utils/session_store.py)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS ws_sessions (
+                    session_id TEXT PRIMARY KEY,
+                    state JSONB NOT NULL,
+                    worker_id TEXT,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS ws_sessions_updated_at_idx ON ws_sessions (updated_at)")
+            # Local calendar mirror (utils/calendar_mirror.py)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS calendar_events (
+                    account_id TEXT NOT NULL,
+                    event_id TEXT NOT NULL,
+                    subject TEXT,
+                    start_utc TIMESTAMPTZ,
+                    end_utc TIMESTAMPTZ,
+                    data JSONB NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (account_id, event_id)
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS calendar_events_start_idx ON calendar_events (account_id, start_utc)")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS calendar_sync_state (
+                    account_id TEXT PRIMARY KEY,
+                    delta_link TEXT,
+                    window_start TIMESTAMPTZ NOT NULL,
+                    window_end TIMESTAMPTZ NOT NULL,
+                    synced_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            # Lets the planner answer small per-user histories with an exact scan
+            cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON user_messages (user_id)").format(
+                sql.Identifier(USER_ID_INDEX)))
+    if VECTOR_STORAGE != "full":
+        # Candidate search runs on the compact column only; no full-vector ANN index
+        add_quantized_columns()
+        create_quantized_indexes()
+    elif VECTOR_INDEX_TYPE == "ivfflat":
+        create_ivfflat_index()
+    else:
+        create_hnsw_index()
+    print("✅ Schema ready.")
+
+
+def _concurrently(concurrently: bool):
+    return sql.SQL("CONCURRENTLY") if concurrently else sql.SQL("")
+
+
+def _build_index(statement):
+    with connection() as conn:
+        with conn.cursor() as cur:
+            if INDEX_MAINTENANCE_WORK_MEM:
+                cur.execute("SELECT set_config('maintenance_work_mem', %s, false)", (INDEX_MAINTENANCE_WORK_MEM,))
+            try:
+                cur.execute(statement)
+            finally:
+                if INDEX_MAINTENANCE_WORK_MEM:
+                    cur.execute("RESET maintenance_work_mem")
+
+
+def create_hnsw_index(m: int = None, ef_construction: int = None, concurrently: bool = False):
+    """Create the HNSW index on user_messages.embedding (no-op if it exists)."""
+    m = m or HNSW_M
+    ef_construction = ef_construction or HNSW_EF_CONSTRUCTION
+    _build_index(sql.SQL("""
+        CREATE INDEX {concurrently} IF NOT EXISTS {name} ON user_messages
+        USING hnsw (embedding vector_cosine_ops) WITH (m = {m}, ef_construction = {ef})
+    """).format(concurrently=_concurrently(concurrently), name=sql.Identifier(HNSW_INDEX),
+                m=sql.Literal(m), ef=sql.Literal(ef_construction)))
+    print(f"✅ HNSW index ready (m={m}, ef_construction={ef_construction}).")
+
+
+def create_ivfflat_index(lists: int = None, concurrently: bool = False):
+    """Create the IVFFlat index. Build it after the table has data: lists are k-means centroids."""
+    lists = lists or IVFFLAT_LISTS
+    _build_index(sql.SQL("""
+        CREATE INDEX {concurrently} IF NOT EXISTS {name} ON user_messages
+        USING ivfflat (embedding vector_cosine_ops) WITH (lists = {lists})
+    """).format(concurrently=_concurrently(concurrently), name=sql.Identifier(IVFFLAT_INDEX),
+                lists=sql.Literal(lists)))
+    print(f"✅ IVFFlat index ready (lists={lists}).")
+
+
+def _partial_index_name(user_id: str) -> str:
+    # Index names are capped at 63 bytes and user ids are arbitrary text
+    return PARTIAL_INDEX_PREFIX + hashlib.md5(str(user_id).encode()).hexdigest()[:16]
+
+
+def create_user_partial_index(user_id: str, concurrently: bool = True):
+    """
+    Build an HNSW index covering only one user's rows.
+
+    For users with very large histories a filtered scan of the global index
+    wastes most of its candidates on other users; a partial index keeps
+    top-k for that user as cheap as an unfiltered search.
+    """
+    _build_index(sql.SQL("""
+        CREATE INDEX {concurrently} IF NOT EXISTS {name} ON user_messages
+        USING hnsw (embedding vector_cosine_ops) WITH (m = {m}, ef_construction = {ef})
+        WHERE user_id = {user_id}
+    """).format(concurrently=_concurrently(concurrently), name=sql.Identifier(_partial_index_name(user_id)),
+                m=sql.Literal(HNSW_M), ef=sql.Literal(HNSW_EF_CONSTRUCTION),
+                user_id=sql.Literal(str(user_id))))
+    print(f"✅ Partial HNSW index ready for user {user_id}.")
+
+
+def drop_user_partial_index(user_id: str):
+    with connection() as conn:
+        conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(
+            sql.Identifier(_partial_index_name(user_id))))
+    print(f"🗑️ Dropped partial index for user {user_id}.")
+
+
+def reindex(concurrently: bool = True):
+    """Rebuild every embedding index, e.g. after a bulk load or heavy deletes."""
+    for name in [row["name"] for row in index_status() if "embedding" in row["name"]]:
+        with connection() as conn:
+            conn.execute(sql.SQL("REINDEX INDEX {concurrently} {name}").format(
+                concurrently=_concurrently(concurrently), name=sql.Identifier(name)))
+        print(f"🔁 Reindexed {name}.")
+
+
+_COMPACT_TYPES = {"halfvec": "halfvec", "binary": "bit"}
+_COMPACT_INDEXES = {"halfvec": (HALFVEC_INDEX, "halfvec_cosine_ops"), "binary": (BINARY_INDEX, "bit_hamming_ops")}
+
+
+def _modes(modes):
+    """Compact modes to act on: the given ones, else the configured VECTOR_STORAGE."""
+    modes = tuple(modes or (VECTOR_STORAGE,))
+    unknown = [mode for mode in modes if mode not in COMPACT_COLUMNS]
+    if unknown:
+        raise ValueError(f"Not a compact storage mode: {', '.join(unknown)}")
+    return modes
+
+
+def add_quantized_columns(modes=None):
+    """Add the halfvec (2x smaller) and/or binary (32x smaller) copy of the embedding. Needs pgvector >= 0.7."""
+    with connection() as conn:
+        with conn.cursor() as cur:
+            for mode in _modes(modes):
+                cur.execute(sql.SQL("ALTER TABLE user_messages ADD COLUMN IF NOT EXISTS {column} {type}({dim})").format(
+                    column=sql.Identifier(COMPACT_COLUMNS[mode][0]), type=sql.SQL(_COMPACT_TYPES[mode]),
+                    dim=sql.Literal(EMBEDDING_DIM)))
+
+
+def backfill_quantized(batch_size: int = 1000, modes=None) -> int:
+    """
+    Fill the compact column(s) for rows written before quantized storage was
+    enabled. Runs in small batches so it can proceed alongside live traffic.
+    """
+    modes = _modes(modes)
+    assignments = sql.SQL(", ").join(
+        sql.SQL("{} = {}").format(sql.Identifier(COMPACT_COLUMNS[mode][0]),
+                                  sql.SQL(COMPACT_COLUMNS[mode][1].format(v="embedding")))
+        for mode in modes)
+    missing = sql.SQL(" OR ").join(sql.SQL("{} IS NULL").format(sql.Identifier(COMPACT_COLUMNS[mode][0]))
+                                   for mode in modes)
+    total = 0
+    while True:
+        with connection() as conn:
+            cur = conn.execute(sql.SQL("""
+                UPDATE user_messages
+                SET {assignments}
+                WHERE id IN (
+                    SELECT id FROM user_messages
+                    WHERE embedding IS NOT NULL AND ({missing})
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            """).format(assignments=assignments, missing=missing), (batch_size,))
+            updated = cur.rowcount
+        total += updated
+        if updated == 0:
+            break
+        print(f"🔢 Quantized {total} rows so far...")
+    print(f"✅ Quantized {total} rows.")
+    return total
+
+
+def create_quantized_indexes(concurrently: bool = False, modes=None):
+    for mode in _modes(modes):
+        name, opclass = _COMPACT_INDEXES[mode]
+        _build_index(sql.SQL("""
+            CREATE INDEX {concurrently} IF NOT EXISTS {name} ON user_messages
+            USING hnsw ({column} {opclass}) WITH (m = {m}, ef_construction = {ef})
+        """).format(concurrently=_concurrently(concurrently), name=sql.Identifier(name),
+                    column=sql.Identifier(COMPACT_COLUMNS[mode][0]), opclass=sql.SQL(opclass),
+                    m=sql.Literal(HNSW_M), ef=sql.Literal(HNSW_EF_CONSTRUCTION)))
+    print("✅ Quantized indexes ready.")
+
+
+def drop_full_vector_indexes():
+    """Drop the full-precision ANN indexes once candidate search has moved to a compact column."""
+    for name in (HNSW_INDEX, IVFFLAT_INDEX):
+        with connection() as conn:
+            conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name)))
+    print("🗑️ Dropped full-vector ANN indexes.")
+
+
+def migrate_quantized(batch_size: int = 1000, modes=None, drop_full_index: bool = False):
+    """
+    Add the compact column(s), backfill existing rows, then index them concurrently.
+    With drop_full_index, also drop the full-vector ANN index that compact search no longer uses.
+    """
+    add_quantized_columns(modes)
+    backfill_quantized(batch_size, modes)
+    create_quantized_indexes(concurrently=True, modes=modes)
+    if drop_full_index:
+        drop_full_vector_indexes()
+
+
+def quantization_report(sample: int = 100, top_k: int = 10) -> dict:
+    """
+    Measure recall@top_k of each storage mode against an exact scan, using
+    randomly sampled stored messages as queries, plus per-row and index sizes.
+    Only compact modes whose column exists are measured; index_bytes is None
+    for a mode whose ANN index doesn't exist.
+    """
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_name = 'user_messages' AND column_name = ANY(%s)
+            """, ([column for column, _ in COMPACT_COLUMNS.values()],))
+            present = {row[0] for row in cur.fetchall()}
+            modes = ("full",) + tuple(mode for mode, (column, _) in COMPACT_COLUMNS.items() if column in present)
+            recall = {mode: [] for mode in modes}
+            populated = sql.SQL("").join(sql.SQL(" AND {} IS NOT NULL").format(sql.Identifier(COMPACT_COLUMNS[mode][0]))
+                                         for mode in modes[1:])
+            cur.execute(sql.SQL("""
+                SELECT user_id, embedding FROM user_messages
+                WHERE embedding IS NOT NULL{populated}
+                ORDER BY random() LIMIT %s
+            """).format(populated=populated), (sample,))
+            queries = cur.fetchall()
+            for user_id, embedding in queries:
+                query = embedding.tolist()
+                with conn.transaction():
+                    # Ground truth: exact scan with the ANN indexes disabled
+                    cur.execute("SELECT set_config('enable_indexscan', 'off', true)")
+                    exact = {row[0] for row in search_user_messages(cur, user_id, query, top_k, storage="full")}
+                if not exact:
+                    continue
+                for mode in modes:
+                    with conn.transaction():
+                        apply_search_settings(cur)
+                        found = {row[0] for row in search_user_messages(cur, user_id, query, top_k, storage=mode)}
+                    recall[mode].append(len(found & exact) / len(exact))
+
+            columns = {"full": "embedding", **{mode: COMPACT_COLUMNS[mode][0] for mode in modes[1:]}}
+            cur.execute(sql.SQL("SELECT {} FROM user_messages WHERE embedding IS NOT NULL{}").format(
+                sql.SQL(", ").join(sql.SQL("avg(pg_column_size({}))").format(sql.Identifier(columns[mode]))
+                                   for mode in modes), populated))
+            column_bytes = dict(zip(modes, cur.fetchone()))
+            index_bytes = {}
+            full_index = IVFFLAT_INDEX if VECTOR_INDEX_TYPE == "ivfflat" else HNSW_INDEX
+            for mode, name in (("full", full_index), ("halfvec", HALFVEC_INDEX), ("binary", BINARY_INDEX)):
+                if mode in modes:
+                    # NULL when the index doesn't exist (compact-only schema, dropped full index)
+                    cur.execute("SELECT pg_relation_size(to_regclass(%s))", (name,))
+                    index_bytes[mode] = cur.fetchone()[0]
+
+    return {
+        mode: {
+            "recall": sum(recall[mode]) / len(recall[mode]) if recall[mode] else None,
+            "avg_column_bytes": float(column_bytes[mode] or 0),
+            "index_bytes": index_bytes[mode],
+        }
+        for mode in modes
+    }
+
+
+def index_status():
+    """Return name, size and definition of every index on user_messages."""
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT i.indexname, pg_size_pretty(pg_relation_size(c.oid)), i.indexdef
+                FROM pg_indexes i
+                JOIN pg_class c ON c.relname = i.indexname
+                WHERE i.tablename = 'user_messages'
+                ORDER BY pg_relation_size(c.oid) DESC
+            """)
+            return [{"name": name, "size": size, "definition": definition}
+                    for name, size, definition in cur.fetchall()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage user_messages embedding indexes.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("init", help="create tables and default indexes")
+    hnsw = sub.add_parser("hnsw", help="create the HNSW index")
+    hnsw.add_argument("--m", type=int)
+    hnsw.add_argument("--ef-construction", type=int)
+    hnsw.add_argument("--concurrently", action="store_true")
+    ivf = sub.add_parser("ivfflat", help="create the IVFFlat index")
+    ivf.add_argument("--lists", type=int)
+    ivf.add_argument("--concurrently", action="store_true")
+    partial = sub.add_parser("partial", help="create a per-user partial HNSW index")
+    partial.add_argument("user_id")
+    drop = sub.add_parser("drop-partial", help="drop a per-user partial index")
+    drop.add_argument("user_id")
+    sub.add_parser("reindex", help="rebuild embedding indexes concurrently")
+    sub.add_parser("status", help="list indexes on user_messages")
+    quantize = sub.add_parser("quantize", help="add, backfill and index halfvec/binary embeddings")
+    quantize.add_argument("--batch-size", type=int, default=1000)
+    quantize.add_argument("--mode", choices=("halfvec", "binary", "both"), default=None,
+                          help="compact column(s) to build (default: VECTOR_STORAGE)")
+    quantize.add_argument("--drop-full-index", action="store_true",
+                          help="drop the full-vector ANN index once the compact index is built")
+    report = sub.add_parser("quant-report", help="recall vs size of the quantized storage modes")
+    report.add_argument("--sample", type=int, default=100)
+    report.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "init":
+        ensure_schema()
+    elif args.command == "hnsw":
+        create_hnsw_index(args.m, args.ef_construction, args.concurrently)
+    elif args.command == "ivfflat":
+        create_ivfflat_index(args.lists, args.concurrently)
+    elif args.command == "partial":
+        create_user_partial_index(args.user_id)
+    elif args.command == "drop-partial":
+        drop_user_partial_index(args.user_id)
+    elif args.command == "reindex":
+        reindex()
+    elif args.command == "status":
+        for row in index_status():
+            print(f"{row['name']:<50} {row['size']:>10}  {row['definition']}")
+    elif args.command == "quantize":
+        modes = ("halfvec", "binary") if args.mode == "both" else (args.mode,) if args.mode else None
+        migrate_quantized(args.batch_size, modes, drop_full_index=args.drop_full_index)
+    elif args.command == "quant-report":
+        report = quantization_report(args.sample, args.top_k)
+        print(f"{'mode':<8} {'recall@' + str(args.top_k):>10} {'bytes/row':>10} {'index MB':>10}")
+        for mode, row in report.items():
+            recall = f"{row['recall']:.3f}" if row["recall"] is not None else "n/a"
+            index_mb = f"{row['index_bytes'] / 1e6:.1f}" if row["index_bytes"] is not None else "absent"
+            print(f"{mode:<8} {recall:>10} {row['avg_column_bytes']:>10.0f} {index_mb:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# utils/session_store.py
+"""
+Postgres-backed websocket session state, shared by every server worker.
+
+PostgresSessionStore plugs into the SessionTable hook (utils/sessions.py):
+sessions are loaded from and saved to the ws_sessions table (see
+utils/schema.py), and every save sends a NOTIFY on WS_SESSION_CHANNEL with
+"<worker id> <session id>". SessionListener holds one dedicated connection
+per worker LISTENing on that channel and calls on_change(session_id) for
+saves made by other workers, so their resident copies are dropped or
+reloaded instead of going stale.
+
+Rows untouched for WS_SESSION_RETENTION_DAYS are removed by prune().
+"""
+import logging
+import os
+import threading
+import psycopg
+from psycopg import sql
+from psycopg.types.json import Jsonb
+from dotenv import load_dotenv
+from utils.db import connection, DB_URL
+from utils.sessions import SessionStore
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+WS_SESSION_CHANNEL = os.getenv("WS_SESSION_CHANNEL", "ws_sessions")
+WS_SESSION_RETENTION_DAYS = float(os.getenv("WS_SESSION_RETENTION_DAYS", "7"))
+WS_SESSION_LISTEN_RETRY = float(os.getenv("WS_SESSION_LISTEN_RETRY", "5"))
+
+
+class PostgresSessionStore(SessionStore):
+    def __init__(self, worker_id: str, channel: str = WS_SESSION_CHANNEL):
+        self.worker_id = worker_id
+        self.channel = channel
+
+    def load(self, session_id: str):
+        with connection() as conn:
+            row = conn.execute("SELECT state FROM ws_sessions WHERE session_id = %s", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def save(self, session_id: str, state: dict):
+        with connection() as conn:
+            with conn.transaction():
+                conn.execute("""
+                    INSERT INTO ws_sessions (session_id, state, worker_id, updated_at)
+                    VALUES (%s, %s, %s, now())
+                    ON CONFLICT (session_id) DO UPDATE
+                    SET state = EXCLUDED.state, worker_id = EXCLUDED.worker_id, updated_at = now()
+                """, (session_id, Jsonb(state), self.worker_id))
+                # Delivered on commit, so listeners never read the old row
+                conn.execute("SELECT pg_notify(%s, %s)", (self.channel, f"{self.worker_id} {session_id}"))
+
+    def prune(self, retention_days: float = WS_SESSION_RETENTION_DAYS) -> int:
+        with connection() as conn:
+            cur = conn.execute("DELETE FROM ws_sessions WHERE updated_at < now() - make_interval(secs => %s)",
+                               (retention_days * 86400,))
+            return cur.rowcount
+
+
+class SessionListener:
+    """LISTENs for other workers' session saves on a dedicated connection (a pooled one can't hold LISTEN)."""
+
+    def __init__(self, worker_id: str, on_change, channel: str = WS_SESSION_CHANNEL):
+        self.worker_id = worker_id
+        self.on_change = on_change
+        self.channel = channel
+        self._stop = threading.Event()
+        self._thread = None
+        self.received = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="session-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with psycopg.connect(DB_URL, autocommit=True) as conn:
+                    conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                    while not self._stop.is_set():
+                        # Returns after the timeout so stop() is noticed
+                        for notify in conn.notifies(timeout=1.0):
+                            self._handle(notify.payload)
+            except psycopg.Error as e:
+                # Saves made while disconnected are missed; resident copies may be stale until evicted
+                logger.warning("Session listener lost its connection (%s); retrying in %.0fs", e,
+                               WS_SESSION_LISTEN_RETRY)
+                self._stop.wait(WS_SESSION_LISTEN_RETRY)
+
+    def _handle(self, payload: str):
+        worker_id, _, session_id = payload.partition(" ")
+        if worker_id == self.worker_id or not session_id:
+            return
+        self.received += 1
+        try:
+            self.on_change(session_id)
+        except Exception as e:
+            logger.warning("Session change handler failed for %s: %s", session_id, e)
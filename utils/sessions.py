@@ -0,0 +1,247 @@
+# utils/sessions.py
+"""
+Per-client conversation sessions for the websocket server.
+
+Each connection is bound to a Session holding its own ConversationBuffer
+(token-budgeted, at most WS_SESSION_MAX_TURNS turns), so clients never see
+each other's history and per-session memory stays flat. Sessions live in a
+SessionTable split into shards, each with its own lock. evict_idle() sweeps
+the shards and drops sessions with no open connection that have been idle
+longer than WS_SESSION_IDLE_TTL. The table also never holds more than
+WS_MAX_SESSIONS sessions.
+
+A client that reconnects with the same session id resumes its context: from
+the table if the session is still resident, otherwise from the optional
+SessionStore hook (set_session_store), which is asked to load a session on
+first use and to save it when its last connection closes or it is evicted.
+Connections without a session id get an ephemeral session that is dropped
+as soon as they disconnect.
+
+A session id is a bearer handle, not authorization: whoever presents it
+resumes that conversation, and the server checks nothing else. Ids must be
+unguessable (the app uses uuid4().hex), must never be logged or shared, and
+the server should only be reachable by the app or through a proxy that
+authenticates users.
+
+With several server processes sharing one store (utils/session_store.py),
+checkpoint() saves a session after every answered turn so a reconnect can
+land on any worker, and invalidate() is called when another worker saved a
+session, so a stale local copy is never served.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+from dotenv import load_dotenv
+from utils.conversation import ConversationBuffer
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+WS_SESSION_SHARDS = int(os.getenv("WS_SESSION_SHARDS", "16"))
+WS_SESSION_IDLE_TTL = float(os.getenv("WS_SESSION_IDLE_TTL", "1800"))
+WS_MAX_SESSIONS = int(os.getenv("WS_MAX_SESSIONS", "10000"))
+WS_SESSION_MAX_TURNS = int(os.getenv("WS_SESSION_MAX_TURNS", "40"))
+
+
+class Session:
+    __slots__ = ("session_id", "conversation", "ephemeral", "connections", "created_at", "last_seen")
+
+    def __init__(self, session_id: str, ephemeral: bool = False):
+        self.session_id = session_id
+        self.conversation = ConversationBuffer(max_turns=WS_SESSION_MAX_TURNS)
+        self.ephemeral = ephemeral
+        self.connections = 0
+        self.created_at = time.monotonic()
+        self.last_seen = self.created_at
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def to_state(self) -> dict:
+        return {"conversation": self.conversation.snapshot()}
+
+    def load_state(self, state: dict):
+        self.conversation.restore(state.get("conversation", {}))
+
+
+class SessionStore:
+    """Persistence hook: subclasses keep session state across evictions and restarts."""
+
+    def load(self, session_id: str):
+        """Return the saved state dict for session_id, or None."""
+        return None
+
+    def save(self, session_id: str, state: dict):
+        pass
+
+
+class _Shard:
+    __slots__ = ("sessions", "lock")
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+
+class SessionTable:
+    def __init__(self, shards: int = WS_SESSION_SHARDS, idle_ttl: float = WS_SESSION_IDLE_TTL,
+                 max_sessions: int = WS_MAX_SESSIONS, store: SessionStore = None):
+        self._shards = [_Shard() for _ in range(shards)]
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.store = store
+        self._stats_lock = threading.Lock()
+        self._stats = {"created": 0, "resumed": 0, "restored": 0, "evicted": 0, "invalidated": 0,
+                       "refreshed": 0, "store_errors": 0}
+
+    def _shard(self, session_id: str) -> _Shard:
+        return self._shards[hash(session_id) % len(self._shards)]
+
+    def _count(self, key: str, n: int = 1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def _save(self, session: Session):
+        if self.store is None or session.ephemeral:
+            return
+        try:
+            self.store.save(session.session_id, session.to_state())
+        except Exception as e:
+            self._count("store_errors")
+            logger.warning("Could not save session %s: %s", session.session_id, e)
+
+    def acquire(self, session_id: str = None) -> Session:
+        """Bind a connection to session_id (created or restored as needed); None gives an ephemeral session."""
+        if session_id is None:
+            session = Session(f"ephemeral-{uuid.uuid4().hex}", ephemeral=True)
+            session.connections = 1
+            self._count("created")
+            return session
+
+        shard = self._shard(session_id)
+        with shard.lock:
+            session = shard.sessions.get(session_id)
+            if session is not None:
+                session.connections += 1
+                session.touch()
+                self._count("resumed")
+                return session
+
+        session = Session(session_id)
+        if self.store is not None:
+            try:
+                state = self.store.load(session_id)
+            except Exception as e:
+                state = None
+                self._count("store_errors")
+                logger.warning("Could not load session %s: %s", session_id, e)
+            if state:
+                session.load_state(state)
+                self._count("restored")
+        with shard.lock:
+            # Another connection may have created it while the store was read
+            session = shard.sessions.setdefault(session_id, session)
+            session.connections += 1
+            session.touch()
+        self._count("created")
+        if len(self) > self.max_sessions:
+            self.evict_idle(force=True)
+        return session
+
+    def release(self, session: Session):
+        """Unbind one connection; the last one out persists the session (ephemeral ones are dropped)."""
+        if session.ephemeral:
+            return
+        shard = self._shard(session.session_id)
+        with shard.lock:
+            session.connections -= 1
+            session.touch()
+            last = session.connections == 0
+        if last:
+            self._save(session)
+
+    def checkpoint(self, session: Session):
+        """Persist a session's state now, e.g. after each answered turn when workers share a store."""
+        self._save(session)
+
+    def invalidate(self, session_id: str):
+        """
+        Another process saved session_id: drop the local copy if nothing here is
+        connected to it (the next acquire() loads the new state), otherwise
+        reload it from the store in place.
+        """
+        shard = self._shard(session_id)
+        with shard.lock:
+            session = shard.sessions.get(session_id)
+            if session is None:
+                return
+            if session.connections == 0:
+                del shard.sessions[session_id]
+                self._count("invalidated")
+                return
+        if self.store is None:
+            return
+        try:
+            state = self.store.load(session_id)
+        except Exception as e:
+            self._count("store_errors")
+            logger.warning("Could not reload session %s: %s", session_id, e)
+            return
+        if state:
+            session.load_state(state)
+            self._count("refreshed")
+
+    def evict_idle(self, force: bool = False) -> int:
+        """
+        Drop sessions without connections idle longer than idle_ttl. With force
+        (table over max_sessions), drop the least recently seen idle sessions
+        until it fits, regardless of age.
+        """
+        now = time.monotonic()
+        evicted = []
+        for shard in self._shards:
+            with shard.lock:
+                for session_id, session in list(shard.sessions.items()):
+                    if session.connections == 0 and now - session.last_seen >= self.idle_ttl:
+                        evicted.append(shard.sessions.pop(session_id))
+        if force:
+            excess = len(self) - self.max_sessions
+            if excess > 0:
+                idle = []
+                for shard in self._shards:
+                    with shard.lock:
+                        idle += [(s.last_seen, s.session_id) for s in shard.sessions.values() if s.connections == 0]
+                for _, session_id in sorted(idle)[:excess]:
+                    shard = self._shard(session_id)
+                    with shard.lock:
+                        session = shard.sessions.get(session_id)
+                        if session is not None and session.connections == 0:
+                            evicted.append(shard.sessions.pop(session_id))
+        # Sessions were saved when their last connection closed; saving again
+        # covers state changed by a background summary since then.
+        for session in evicted:
+            self._save(session)
+        self._count("evicted", len(evicted))
+        return len(evicted)
+
+    def __len__(self):
+        return sum(len(shard.sessions) for shard in self._shards)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["sessions"] = len(self)
+        stats["connected"] = sum(
+            1 for shard in self._shards for s in list(shard.sessions.values()) if s.connections
+        )
+        return stats
+
+
+session_table = SessionTable()
+
+
+def set_session_store(store: SessionStore):
+    """Install a persistence hook on the process-wide session table."""
+    session_table.store = store
@@ -0,0 +1,93 @@
+# utils/stages.py
+"""
+Per-turn stage executor: run independent pipeline stages concurrently and
+record how long each one took.
+
+A turn creates a TurnStages, start()s the stages that don't depend on each
+other on a shared thread pool (e.g. memory retrieval while the intent call is
+in flight), run()s the dependent ones inline, and reads the background
+results with result(). Stages that turn out to be unnecessary are
+discard()ed: cancelled if they haven't started, otherwise their result is
+ignored. Turn latency becomes the longest dependency chain rather than the
+sum of every stage.
+
+Stage functions run on worker threads, so they must take their inputs as
+arguments (no st.session_state access inside a stage).
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+STAGE_WORKERS = int(os.getenv("STAGE_WORKERS", "8"))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="stage")
+    return _executor
+
+
+class TurnStages:
+    """Stages of one turn, with wall-clock timings in milliseconds."""
+
+    def __init__(self, executor: ThreadPoolExecutor = None):
+        self._executor = executor or get_executor()
+        self._futures = {}
+        self._started = time.perf_counter()
+        self.timings = {}
+        self.discarded = []
+
+    def _timed(self, name: str, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.timings[name] = (time.perf_counter() - start) * 1000
+
+    def start(self, name: str, fn, *args, **kwargs) -> Future:
+        """Run fn(*args, **kwargs) in the background as stage `name`."""
+        future = self._executor.submit(self._timed, name, fn, *args, **kwargs)
+        self._futures[name] = future
+        return future
+
+    def run(self, name: str, fn, *args, **kwargs):
+        """Run fn inline as stage `name` (for stages on the critical path)."""
+        return self._timed(name, fn, *args, **kwargs)
+
+    def result(self, name: str, default=None, timeout: float = None):
+        """Wait for a started stage; returns default if it was never started or failed."""
+        future = self._futures.pop(name, None)
+        if future is None:
+            return default
+        try:
+            return future.result(timeout)
+        except Exception as e:
+            logger.error("Stage %s failed: %s", name, e)
+            return default
+
+    def discard(self, *names):
+        """Drop started stages whose results are no longer needed (all pending ones if no names)."""
+        for name in names or list(self._futures):
+            future = self._futures.pop(name, None)
+            if future is not None:
+                future.cancel()
+                self.discarded.append(name)
+
+    def report(self) -> dict:
+        report = {name: round(ms, 1) for name, ms in self.timings.items()}
+        report["total"] = round((time.perf_counter() - self._started) * 1000, 1)
+        if self.discarded:
+            report["discarded"] = list(self.discarded)
+        return report
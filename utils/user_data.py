@@ -1,10 +1,10 @@
-from utils.db import get_connection , release_connection
+from utils.db import connection, VECTOR_STORAGE, COMPACT_COLUMNS
 import numpy as np
 from typing import Optional
 from utils.embedding import generate_embedding
+from utils import embedding_queue
 import logging
 logger = logging.getLogger(__name__)
-from utils.db import  get_connection,release_connection
 
 
 def store_user_data(
@@ -16,31 +16,43 @@ def store_user_data(
 ):
     """
     Store a user's message and its embedding in the database.
-    If no embedding is provided, generate one using the Gemini API.
+    If no embedding is provided, the row is inserted with a NULL embedding and
+    the background embedding worker fills it in (EMBEDDING_WRITE_BEHIND=false
+    restores generating it synchronously before the insert).
     """
-    local_conn = False
+    write_behind = embedding is None and embedding_queue.EMBEDDING_WRITE_BEHIND
     try:
-        if conn is None:
-            conn = get_connection()
-            local_conn = True
-
         # Generate embedding if not provided
-        if embedding is None:
+        if embedding is None and not write_behind:
             embedding = generate_embedding(message_text)
 
         # Insert the user message (with embedding) into user_messages table
-        sql = """
-            INSERT INTO user_messages (user_id, session_id, message_text, embedding)
-            VALUES (%s, %s, %s, %s)
-        """
-        with conn:
+        if VECTOR_STORAGE == "full":
+            sql = """
+                INSERT INTO user_messages (user_id, session_id, message_text, embedding)
+                VALUES (%(user_id)s, %(session_id)s, %(message_text)s, %(embedding)s)
+            """
+        else:
+            # The selected compact copy for candidate search; the full vector is kept for re-ranking
+            column, expression = COMPACT_COLUMNS[VECTOR_STORAGE]
+            sql = f"""
+                INSERT INTO user_messages (user_id, session_id, message_text, embedding, {column})
+                VALUES (%(user_id)s, %(session_id)s, %(message_text)s, %(embedding)s,
+                        {expression.format(v="%(embedding)s")})
+            """
+        params = {"user_id": user_id, "session_id": session_id, "message_text": message_text, "embedding": embedding}
+        if conn is None:
+            with connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, params)
+        else:
             with conn.cursor() as cur:
-                cur.execute(sql, (user_id, session_id, message_text, embedding))
+                cur.execute(sql, params)
 
     except Exception as e:
         logger.error("Error storing user message for user_id %s: %s", user_id, e)
         raise
-    finally:
-        if local_conn:
-            release_connection(conn)
+
+    if write_behind:
+        embedding_queue.notify()
 
@@ -5,51 +5,21 @@ import logging
 from typing import Optional
 import numpy as np
 from dotenv import load_dotenv
-from utils.db import get_connection, release_connection
+from utils.db import connection, retrieve_similar_data as _retrieve_similar_data
 from utils.embedding import generate_embedding
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-def retrieve_similar_data(user_id: str, query: str, top_k: int = 3):
+def retrieve_similar_data(user_id: str, query: str, top_k: int = 3, ef_search: Optional[int] = None, probes: Optional[int] = None):
     """
     Retrieves the top_k most similar messages from user_messages
     for a given user query.
-    """
-    query_embedding = generate_embedding(query)
-    print("📡 Query Embedding:", query_embedding[:5] if query_embedding else "None")
-
-    if not query_embedding:
-        print("❌ No embedding generated for query")
-        return []
 
-    conn = get_connection()
-    if not conn:
-        print("❌ Failed to get DB connection")
-        return []
-
-    results = []
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                psycopg.sql.SQL("""
-                    SELECT message_text, (embedding <-> %s::vector) AS distance
-                    FROM user_messages
-                    WHERE user_id = %s AND embedding IS NOT NULL
-                    ORDER BY distance ASC
-                    LIMIT %s;
-                """),
-                (query_embedding, user_id, top_k)
-            )
-            results = cursor.fetchall()
-            print("📊 Similar Messages Retrieved:", results)
-            return [row[0] for row in results] # Return only the message text
-    except psycopg.Error as e:
-        print(f"Database error in retrieve_similar_data: {e}")
-    finally:
-        if conn:
-            release_connection(conn)
-    return results
+    Delegates to utils.db so both entry points share the cosine (<=>)
+    operator that the ANN indexes in utils/schema.py are built for.
+    """
+    return _retrieve_similar_data(user_id, query, top_k=top_k, ef_search=ef_search, probes=probes)
 
 def insert_or_update_embedding(data_key: str, data_value: str, user_id: Optional[int] = None, conn=None):
     """
@@ -58,12 +28,7 @@ def insert_or_update_embedding(data_key: str, data_value: str, user_id: Optional
     We will focus on retrieve_similar_data for memory retrieval from user_messages.
     """
     logger.warning("insert_or_update_embedding in vector_utils is likely not used for user messages.")
-    local_conn = False
     try:
-        if conn is None:
-            conn = get_connection()
-            local_conn = True
-
         embedding = generate_embedding(data_value)
 
         sql = """
@@ -73,16 +38,17 @@ def insert_or_update_embedding(data_key: str, data_value: str, user_id: Optional
             SET data_value = EXCLUDED.data_value,
                 embedding = EXCLUDED.embedding;
         """
-        with conn:
+        if conn is None:
+            with connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(sql, (data_key, data_value, embedding, user_id))
+        else:
             with conn.cursor() as cur:
                 cur.execute(sql, (data_key, data_value, embedding, user_id))
 
     except Exception as e:
         logger.error(f"Error in insert_or_update_embedding for key %s: %s", data_key, e)
         raise
-    finally:
-        if local_conn:
-            release_connection(conn)
 
 # You might want to remove or rename search_similar_embeddings
 # and use retrieve_similar_data instead throughout your project.
\ No newline at end of file
@@ -0,0 +1,242 @@
+# utils/ws_client.py
+"""
+Persistent websocket client for the chat server, with a sync facade.
+
+All connections are driven by one background event loop thread per process,
+so Streamlit callbacks never create an event loop or redo a handshake per
+message. get_client(url) returns the process-wide WSClient for url (the URL
+carries the session id, so each browser session keeps its own connection
+and server-side conversation). A client:
+
+- connects lazily and reconnects with jittered exponential backoff, both on
+  demand and in the background after the connection drops;
+- speaks the server's JSON protocol, so several requests can share one
+  socket and a request that times out (or whose caller goes away) is
+  cancelled upstream;
+- hands chunks and replies back to the calling thread through a queue, so
+  on_token runs in the caller's thread (Streamlit can only update the page
+  from the script thread).
+
+Clients idle longer than WS_CLIENT_IDLE_TIMEOUT are closed and dropped. A
+dropped client never connects again; send() on one that a caller still holds
+goes through the url's current client instead.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+import websockets
+from dotenv import load_dotenv
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+WS_CLIENT_CONNECT_ATTEMPTS = int(os.getenv("WS_CLIENT_CONNECT_ATTEMPTS", "4"))
+WS_CLIENT_CONNECT_TIMEOUT = float(os.getenv("WS_CLIENT_CONNECT_TIMEOUT", "5"))
+WS_CLIENT_BACKOFF_BASE = float(os.getenv("WS_CLIENT_BACKOFF_BASE", "0.25"))
+WS_CLIENT_BACKOFF_MAX = float(os.getenv("WS_CLIENT_BACKOFF_MAX", "5"))
+# Must cover the server's queue wait plus its request timeout
+WS_CLIENT_TIMEOUT = float(os.getenv("WS_CLIENT_TIMEOUT", "90"))
+WS_CLIENT_IDLE_TIMEOUT = float(os.getenv("WS_CLIENT_IDLE_TIMEOUT", "600"))
+WS_CLIENT_REAP_SECONDS = 60
+
+
+class WSClient:
+    """One persistent, auto-reconnecting connection; its coroutines run on the shared loop."""
+
+    def __init__(self, url: str, loop: asyncio.AbstractEventLoop):
+        self.url = url
+        self.loop = loop
+        self._ws = None
+        self._connect_lock = None
+        self._pending = {}  # request id -> queue.Queue of (kind, text) events for the caller
+        self._closed = False
+        self._reaped = False  # set under _lock when dropped from _clients; never reconnects after
+        self.last_used = time.monotonic()
+        self._stats = {"connects": 0, "connect_failures": 0, "drops": 0, "requests": 0, "timeouts": 0}
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(WS_CLIENT_BACKOFF_MAX, WS_CLIENT_BACKOFF_BASE * 2 ** attempt))
+
+    async def _connection(self):
+        if self._ws is not None:
+            return self._ws
+        if self._reaped:
+            raise ConnectionError("client was closed for idleness")
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._ws is not None:
+                return self._ws
+            error = None
+            for attempt in range(WS_CLIENT_CONNECT_ATTEMPTS):
+                if attempt:
+                    await asyncio.sleep(self._backoff(attempt - 1))
+                try:
+                    ws = await websockets.connect(self.url, open_timeout=WS_CLIENT_CONNECT_TIMEOUT)
+                except (OSError, asyncio.TimeoutError, websockets.exceptions.WebSocketException) as e:
+                    error = e
+                    self._stats["connect_failures"] += 1
+                    continue
+                if self._reaped:
+                    # Reaped while the handshake was in flight; don't leave an untracked connection open
+                    await ws.close()
+                    raise ConnectionError("client was closed for idleness")
+                self._ws = ws
+                self._closed = False
+                self._stats["connects"] += 1
+                self.loop.create_task(self._read(ws))
+                return ws
+            # The query string carries the session id; keep it out of error text shown to users
+            raise ConnectionError(f"could not connect to {self.url.split('?', 1)[0]}: {error}")
+
+    async def _read(self, ws):
+        """Route server frames to the waiting callers until the connection ends."""
+        try:
+            async for raw in ws:
+                try:
+                    frame = json.loads(raw)
+                except ValueError:
+                    continue
+                request_id = frame.get("id")
+                events = self._pending.get(request_id)
+                if events is None:
+                    continue
+                kind = frame.get("type")
+                if kind == "chunk":
+                    events.put(("chunk", frame.get("text", "")))
+                elif kind in ("reply", "error"):
+                    del self._pending[request_id]
+                    events.put((kind, frame.get("text", "")))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            if self._ws is ws:
+                self._ws = None
+            for events in self._pending.values():
+                events.put(("error", "WebSocket error: connection lost"))
+            self._pending.clear()
+            if not self._closed:
+                self._stats["drops"] += 1
+                # Reconnect now rather than on the next message
+                self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        try:
+            await self._connection()
+        except ConnectionError as e:
+            logger.info("Background reconnect failed: %s", e)
+
+    async def _submit(self, request_id: str, message: str, events: queue.Queue, stream: bool):
+        self._stats["requests"] += 1
+        try:
+            ws = await self._connection()
+            self._pending[request_id] = events
+            await ws.send(json.dumps({"type": "request", "id": request_id, "message": message, "stream": stream}))
+        except Exception as e:
+            self._pending.pop(request_id, None)
+            events.put(("error", f"WebSocket error: {e}"))
+
+    async def _cancel(self, request_id: str):
+        if self._pending.pop(request_id, None) is not None and self._ws is not None:
+            try:
+                await self._ws.send(json.dumps({"type": "cancel", "id": request_id}))
+            except websockets.exceptions.ConnectionClosed:
+                pass
+
+    def send(self, message: str, on_token=None, timeout: float = WS_CLIENT_TIMEOUT) -> str:
+        """
+        Send message and block until the reply; returns its text (or an error text,
+        like the old per-message client). With on_token, the reply is streamed and
+        on_token(text_so_far) is called from this thread for every chunk.
+        """
+        with _lock:
+            # The reaper reads last_used under _lock too, so a client that passes this check isn't reaped mid-send
+            reaped = self._reaped
+            self.last_used = time.monotonic()
+        if reaped:
+            return get_client(self.url).send(message, on_token, timeout)
+        request_id = uuid.uuid4().hex
+        events = queue.Queue()
+        asyncio.run_coroutine_threadsafe(self._submit(request_id, message, events, on_token is not None), self.loop)
+        deadline = time.monotonic() + timeout
+        response = ""
+        try:
+            while True:
+                try:
+                    kind, text = events.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    self._stats["timeouts"] += 1
+                    asyncio.run_coroutine_threadsafe(self._cancel(request_id), self.loop)
+                    return "WebSocket error: request timed out"
+                if kind != "chunk":
+                    return text
+                response += text
+                if on_token:
+                    on_token(response)
+        except BaseException:
+            # The caller was interrupted (e.g. a Streamlit rerun): stop the upstream call too
+            asyncio.run_coroutine_threadsafe(self._cancel(request_id), self.loop)
+            raise
+        finally:
+            self.last_used = time.monotonic()
+
+    async def aclose(self):
+        self._closed = True
+        if self._ws is not None:
+            await self._ws.close()
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["connected"] = self._ws is not None
+        stats["pending"] = len(self._pending)
+        return stats
+
+
+_loop = None
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="ws-client-loop", daemon=True).start()
+            asyncio.run_coroutine_threadsafe(_reap_idle(), _loop)
+        return _loop
+
+
+async def _reap_idle():
+    while True:
+        await asyncio.sleep(WS_CLIENT_REAP_SECONDS)
+        now = time.monotonic()
+        with _lock:
+            idle = [url for url, client in _clients.items()
+                    if not client._pending and now - client.last_used >= WS_CLIENT_IDLE_TIMEOUT]
+            reaped = [_clients.pop(url) for url in idle]
+            for client in reaped:
+                client._reaped = True
+        for client in reaped:
+            await client.aclose()
+
+
+def get_client(url: str) -> WSClient:
+    """The process-wide persistent client for url, created on first use."""
+    loop = _get_loop()
+    with _lock:
+        client = _clients.get(url)
+        if client is None:
+            client = _clients[url] = WSClient(url, loop)
+        return client
+
+
+def client_stats() -> dict:
+    with _lock:
+        return {url: client.stats() for url, client in _clients.items()}
@@ -1,136 +1,518 @@
 import asyncio
 import nest_asyncio
 import websockets
-import requests
 from dotenv import load_dotenv
 import os
-import google.auth
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
+import sys
 import json
-from google.oauth2.credentials import Credentials  
+import uuid
+import time
+import signal
+import socket
+import multiprocessing
+from contextlib import suppress
+from urllib.parse import urlsplit, parse_qs, urlencode
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+from utils.auth import token_provider
+from utils.sessions import session_table, set_session_store
+from utils.fair_scheduler import FairScheduler, ServerBusy, parse_weights
+from utils.gemini_client import agenerate_content, astream_generate_content, GeminiError, GeminiAuthError, GeminiUnavailableError
 
 nest_asyncio.apply()
 
 load_dotenv()
 
-CLIENT_SECRET_FILE = os.getenv('CLIENT_SECRET_FILE')  
-SCOPES = ['https://www.googleapis.com/auth/generative-language.retriever']
+# Legacy plain-text clients get each reply as a single frame, as before: they do one
+# recv() per message. WS_STREAMING=true streams legacy replies as incremental text
+# frames followed by the marker frame, for clients that read up to the marker.
+# JSON protocol clients opt in per request with "stream": true instead.
+WS_STREAMING = os.getenv("WS_STREAMING", "false").lower() == "true"
+END_OF_MESSAGE = os.getenv("WS_END_MARKER", "[[END]]")
 
-conversation_history = []
+WS_SESSION_SWEEP_SECONDS = float(os.getenv("WS_SESSION_SWEEP_SECONDS", "60"))
+
+# Multi-worker mode: WS_WORKERS processes serve WS_PORT, via SO_REUSEPORT on Linux
+# or a shared inherited socket elsewhere. Workers share sessions through Postgres
+# (WS_SESSION_STORE=postgres, the default with more than one worker) so a
+# reconnect can land on any of them. On SIGTERM/SIGINT a worker stops accepting,
+# lets in-flight requests finish for up to WS_DRAIN_TIMEOUT seconds, then closes
+# the remaining connections with 1001 (going away) so clients reconnect elsewhere.
+# The scheduler limits below are enforced per worker, not across the pool: a
+# client whose connections spread over N workers can get up to N times
+# WS_USER_RATE_PER_MINUTE, and up to N * WS_MAX_INFLIGHT Gemini calls run at once.
+# Size them per worker (e.g. divide by WS_WORKERS) if that matters.
+WS_HOST = os.getenv("WS_HOST", "localhost")
+WS_PORT = int(os.getenv("WS_PORT", "8765"))
+WS_WORKERS = int(os.getenv("WS_WORKERS", "1"))
+WS_REUSE_PORT = os.getenv("WS_REUSE_PORT", str(sys.platform.startswith("linux"))).lower() == "true"
+WS_SESSION_STORE = os.getenv("WS_SESSION_STORE", "postgres" if WS_WORKERS > 1 else "memory")
+WS_SESSION_PRUNE_SECONDS = float(os.getenv("WS_SESSION_PRUNE_SECONDS", "3600"))
+WS_DRAIN_TIMEOUT = float(os.getenv("WS_DRAIN_TIMEOUT", "30"))
+
+# JSON protocol. Text frames that parse as a JSON object with a "type" are protocol
+# frames; anything else is a legacy plain-text message answered as before.
+#   client -> server  {"type": "request", "id": "r1", "message": "...", "stream": true}
+#                     {"type": "cancel", "id": "r1"}
+#                     {"type": "ping", "id": "p1"}
+#                     {"type": "stats"}                                (scheduler and session metrics)
+#   server -> client  {"type": "chunk", "id": "r1", "text": "..."}     (streamed requests only)
+#                     {"type": "reply", "id": "r1", "text": "..."}     (final, complete text)
+#                     {"type": "error", "id": "r1", "error": "busy", "text": "..."}
+#                     {"type": "cancelled", "id": "r1", "found": true}
+#                     {"type": "pong", "id": "p1"}
+#                     {"type": "stats", "scheduler": {...}, "sessions": {...}}
+# An "id", when given, must be a string or an integer; other frames get a bad_request error.
+# Requests on one connection run concurrently, up to WS_MAX_REQUESTS_PER_CONNECTION.
+WS_MAX_REQUESTS_PER_CONNECTION = int(os.getenv("WS_MAX_REQUESTS_PER_CONNECTION", "8"))
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "20"))
+WS_PING_TIMEOUT = float(os.getenv("WS_PING_TIMEOUT", "20"))
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", str(1024 * 1024)))
+WS_COMPRESSION = os.getenv("WS_COMPRESSION", "true").lower() == "true"
+WS_DEFLATE_WINDOW_BITS = int(os.getenv("WS_DEFLATE_WINDOW_BITS", "12"))
+
+# At most WS_MAX_INFLIGHT Gemini calls run at once. Beyond that, requests wait in
+# a weighted fair queue across users (see utils/fair_scheduler.py), each user is
+# held to WS_USER_RATE_PER_MINUTE (bursts of WS_USER_BURST), and anything that
+# would wait longer than WS_QUEUE_TIMEOUT, or finds WS_MAX_QUEUED already
+# waiting, gets a busy reply at once. Users are keyed by client address, which the
+# client can't choose. Only connections from WS_TRUSTED_CLIENTS (by default
+# loopback, i.e. the Streamlit app serving many browser sessions from one address)
+# may name the user with ?user= on the connection URL, else by their session id.
+# WS_USER_WEIGHTS gives some users (or addresses) a larger share, e.g.
+# "ops=4,batch-bot=0.25". All of these apply per worker process (see WS_WORKERS).
+WS_MAX_INFLIGHT = int(os.getenv("WS_MAX_INFLIGHT", "64"))
+WS_MAX_QUEUED = int(os.getenv("WS_MAX_QUEUED", "256"))
+WS_QUEUE_TIMEOUT = float(os.getenv("WS_QUEUE_TIMEOUT", "10"))
+WS_REQUEST_TIMEOUT = float(os.getenv("WS_REQUEST_TIMEOUT", "60"))
+WS_USER_RATE_PER_MINUTE = float(os.getenv("WS_USER_RATE_PER_MINUTE", "30"))
+WS_USER_BURST = float(os.getenv("WS_USER_BURST", "5"))
+WS_USER_WEIGHTS = os.getenv("WS_USER_WEIGHTS", "")
+WS_TRUSTED_CLIENTS = {a.strip() for a in os.getenv("WS_TRUSTED_CLIENTS", "127.0.0.1,::1").split(",") if a.strip()}
+BUSY_MESSAGE = "⚠️ The server is busy. Please try again in a moment."
+RATE_LIMITED_MESSAGE = "⚠️ You're sending messages too quickly. Please wait a moment."
+TIMEOUT_MESSAGE = "⚠️ The request timed out. Please try again."
+
+scheduler = FairScheduler(WS_MAX_INFLIGHT, WS_MAX_QUEUED, WS_QUEUE_TIMEOUT, WS_USER_RATE_PER_MINUTE,
+                          WS_USER_BURST, weights=parse_weights(WS_USER_WEIGHTS))
+
+def _busy_text(e: ServerBusy) -> str:
+    return RATE_LIMITED_MESSAGE if e.reason == "rate_limited" else BUSY_MESSAGE
 
 def authenticate_with_google():
-    credentials = None
-    token_file = 'token.json'
+    # Shared in-memory credentials: token.json is only read once and refreshed
+    # proactively, instead of being re-read on every message.
+    return token_provider.get_credentials()
 
-    if os.path.exists(token_file):
-        try:
-            with open(token_file, 'r') as token:
-                credentials_data = json.load(token)
-                credentials = Credentials.from_authorized_user_info(credentials_data)
-        except Exception as e:
-            print(f"Error loading credentials from token file: {e}")
-
-    if not credentials or not credentials.valid:
-        if credentials and credentials.expired and credentials.refresh_token:
-            try:
-                credentials.refresh(Request())
-            except Exception as e:
-                print(f"Error refreshing credentials: {e}")
-                credentials = None  
-        if not credentials:
-            try:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    CLIENT_SECRET_FILE,
-                    scopes=SCOPES
-                )
-                credentials = flow.run_local_server(port=2222)
-            except Exception as e:
-                print(f"OAuth2 authentication failed: {e}")
-                return None
+def _error_text(e: GeminiError) -> str:
+    if isinstance(e, GeminiAuthError):
+        return "Authentication failed."
+    if isinstance(e, GeminiUnavailableError):
+        return "The assistant is temporarily unavailable. Please try again in a moment."
+    if e.status_code is not None:
+        return f"Error: {e}"
+    return f"Error calling Gemini API: {e}"
+
+async def get_gemini_response(user_message):
+    try:
+        return await agenerate_content(user_message) or "No response text found."
+    except GeminiError as e:
+        return _error_text(e)
 
+async def stream_gemini_response(user_message, send_chunk):
+    """Pass Gemini's streamed chunks to send_chunk as they arrive; return the assembled text."""
+    response_text = ""
+    try:
+        async for chunk in astream_generate_content(user_message):
+            response_text += chunk
+            await send_chunk(chunk)
+    except GeminiError as e:
+        error = _error_text(e)
+        await send_chunk(error)
+        response_text += error
+    return response_text
+
+async def send_reply(websocket, text):
+    """Send a complete reply in one frame (followed by the end marker when streaming)."""
+    await websocket.send(text)
+    if WS_STREAMING:
+        await websocket.send(END_OF_MESSAGE)
+
+async def answer(websocket, user, context, send_chunk=None):
+    """
+    Generate one reply in one of user's scheduler slots, streamed through
+    send_chunk when one is given. The Gemini call is cancelled if the socket
+    closes first (returns None), if it exceeds WS_REQUEST_TIMEOUT (raises
+    asyncio.TimeoutError) or if the caller is cancelled; ServerBusy means it
+    never got a slot.
+    """
+    async with scheduler.slot(user):
+        if send_chunk is not None:
+            request = asyncio.create_task(stream_gemini_response(context, send_chunk))
+        else:
+            request = asyncio.create_task(get_gemini_response(context))
+        closed = asyncio.create_task(websocket.wait_closed())
         try:
-            with open(token_file, 'w') as token:
-                token.write(credentials.to_json())
-        except Exception as e:
-            print(f"Error saving credentials to token file: {e}")
+            done, _ = await asyncio.wait({request, closed}, timeout=WS_REQUEST_TIMEOUT,
+                                         return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            closed.cancel()
+            if not request.done():
+                request.cancel()
+                with suppress(asyncio.CancelledError):
+                    await request
+        if request in done:
+            return request.result()
+        if closed in done:
+            return None
+        raise asyncio.TimeoutError()
 
-    return credentials
+def parse_frame(raw):
+    """A JSON protocol frame as a dict, or None for a legacy plain-text message."""
+    if isinstance(raw, bytes):
+        raw = raw.decode("utf-8", errors="replace")
+    if not raw.lstrip().startswith("{"):
+        return None
+    try:
+        frame = json.loads(raw)
+    except ValueError:
+        return None
+    return frame if isinstance(frame, dict) and isinstance(frame.get("type"), str) else None
 
-def get_gemini_response(user_message):
-    credentials = authenticate_with_google()
-    if not credentials:
-        return "Authentication failed."
+async def send_frame(websocket, frame: dict):
+    await websocket.send(json.dumps(frame, ensure_ascii=False))
+
+def _query_param(websocket, name):
+    request = getattr(websocket, "request", None)
+    path = request.path if request is not None else getattr(websocket, "path", "")
+    values = parse_qs(urlsplit(path or "").query).get(name)
+    return values[0] if values else None
+
+def _session_id(websocket):
+    """
+    Session to resume, from ?session=<id> on the connection URL; None for an ephemeral session.
+    Not authorization: any client presenting the id gets that conversation (see utils/sessions.py).
+    """
+    return _query_param(websocket, "session")
 
-    access_token = credentials.token
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+def _user_key(websocket, session):
+    """Who a request is scheduled and rate-limited as: the client address, unless it is a trusted client."""
+    address = websocket.remote_address
+    host = address[0] if address else None
+    if host is not None and host not in WS_TRUSTED_CLIENTS:
+        # ?user= and ?session= are chosen by the client; keying on them would let one
+        # client spread its requests over any number of fair-queue slots and rate buckets
+        return host
+    user = _query_param(websocket, "user")
+    if user:
+        return user
+    if not session.ephemeral:
+        return session.session_id
+    return host or session.session_id
 
-    payload = {
-        "contents": [
-            {
-                "parts": [
-                    {"text": user_message}
-                ]
-            }
-        ]
-    }
+async def _evict_idle_sessions():
+    while True:
+        await asyncio.sleep(WS_SESSION_SWEEP_SECONDS)
+        evicted = await asyncio.to_thread(session_table.evict_idle)
+        if evicted:
+            print(f"Evicted {evicted} idle sessions; {session_table.stats()}")
 
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
+async def checkpoint(session):
+    """With a shared session store, save after every answered turn so any worker can resume the session."""
+    if session_table.store is not None and not session.ephemeral:
+        await asyncio.to_thread(session_table.checkpoint, session)
 
+async def serve_request(websocket, session, user, request_id, message, stream):
+    """Answer one JSON protocol request; runs as its own task so a connection can have several."""
+    conversation = session.conversation
+    send_chunk = None
+    if stream:
+        async def send_chunk(text):
+            await send_frame(websocket, {"type": "chunk", "id": request_id, "text": text})
+
+    context = "\n".join(filter(None, [conversation.render(), f"User: {message}"]))
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code == 200:
-            candidates = response.json().get("candidates", [])
-            if candidates:
-                return candidates[0]["content"]["parts"][0].get("text", "No response text found.")
-            else:
-                return "No candidates returned from Gemini."
+        gemini_response = await answer(websocket, user, context, send_chunk)
+    except ServerBusy as e:
+        await send_frame(websocket, {"type": "error", "id": request_id, "error": e.reason, "text": _busy_text(e)})
+        return
+    except asyncio.TimeoutError:
+        await send_frame(websocket, {"type": "error", "id": request_id, "error": "timeout", "text": TIMEOUT_MESSAGE})
+        return
+    if gemini_response is None:
+        return
+
+    cleaned_response = gemini_response.replace("Bot:", "").strip()
+    # Concurrent requests on one session each see the history as of their start
+    conversation.add("User", message)
+    conversation.add("Bot", cleaned_response)
+    await send_frame(websocket, {"type": "reply", "id": request_id, "text": cleaned_response})
+    await checkpoint(session)
+
+def _request_done(websocket, inflight, request_id, task):
+    inflight.pop(request_id, None)
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None and not isinstance(error, websockets.exceptions.ConnectionClosed):
+        print(f"Error in request {request_id}: {error}")
+        asyncio.ensure_future(_send_quietly(websocket, {
+            "type": "error", "id": request_id, "error": "internal", "text": "Internal server error."}))
+
+async def _send_quietly(websocket, frame: dict):
+    with suppress(websockets.exceptions.ConnectionClosed):
+        await send_frame(websocket, frame)
+
+async def handle_frame(websocket, session, user, inflight, frame):
+    """Dispatch one JSON protocol frame: request, cancel, ping or stats."""
+    kind = frame["type"]
+    request_id = frame.get("id")
+    if request_id is not None and (isinstance(request_id, bool) or not isinstance(request_id, (str, int))):
+        # Ids are echoed back and used as dict keys; lists or objects would be neither safe nor matchable
+        await send_frame(websocket, {"type": "error", "id": None, "error": "bad_request",
+                                     "text": "'id' must be a string or an integer."})
+    elif kind == "ping":
+        await send_frame(websocket, {"type": "pong", "id": request_id})
+    elif kind == "stats":
+        await send_frame(websocket, {"type": "stats", "id": request_id, "scheduler": scheduler.stats(),
+                                     "sessions": session_table.stats()})
+    elif kind == "cancel":
+        task = inflight.get(request_id)
+        if task is not None:
+            task.cancel()
+        await send_frame(websocket, {"type": "cancelled", "id": request_id, "found": task is not None})
+    elif kind == "request":
+        message = frame.get("message")
+        if request_id is None:
+            request_id = uuid.uuid4().hex
+        if not isinstance(message, str) or not message.strip():
+            await send_frame(websocket, {"type": "error", "id": request_id, "error": "bad_request",
+                                         "text": "A request needs a non-empty 'message'."})
+        elif request_id in inflight:
+            await send_frame(websocket, {"type": "error", "id": request_id, "error": "duplicate_id",
+                                         "text": "A request with this id is already in flight."})
+        elif len(inflight) >= WS_MAX_REQUESTS_PER_CONNECTION:
+            await send_frame(websocket, {"type": "error", "id": request_id, "error": "too_many_requests",
+                                         "text": BUSY_MESSAGE})
         else:
-            return f"Error: {response.status_code} - {response.text}"
-    except requests.exceptions.RequestException as e:
-        return f"Error calling Gemini API: {e}"
+            stream = frame.get("stream", False)
+            task = asyncio.create_task(serve_request(websocket, session, user, request_id, message, bool(stream)))
+            inflight[request_id] = task
+            task.add_done_callback(lambda t, rid=request_id: _request_done(websocket, inflight, rid, t))
+    else:
+        await send_frame(websocket, {"type": "error", "id": request_id, "error": "unknown_type",
+                                     "text": f"Unknown frame type: {kind}"})
 
-async def handle_client(websocket):
-    print(f"New connection from {websocket.remote_address}")
-    
+async def handle_legacy_message(websocket, session, user, message):
+    """A plain-text frame: one request at a time, answered with bare text frames."""
+    conversation = session.conversation
+    context = "\n".join(filter(None, [conversation.render(), f"User: {message}"]))
     try:
-        while True:
-            message = await websocket.recv()
-            print(f"Received message: {message}")
+        gemini_response = await answer(websocket, user, context, websocket.send if WS_STREAMING else None)
+    except ServerBusy as e:
+        # Backpressure: tell the client to retry instead of queueing without bound
+        await send_reply(websocket, _busy_text(e))
+        return True
+    except asyncio.TimeoutError:
+        await send_reply(websocket, TIMEOUT_MESSAGE)
+        return True
+    if gemini_response is None:
+        print(f"Client went away mid-request; cancelled: {websocket.remote_address}")
+        return False
 
-            conversation_history.append(f"User: {message}")
+    # Post-processing runs on the assembled reply
+    cleaned_response = gemini_response.replace("Bot:", "").strip()
 
-            # Limit the context to the last 10 messages
-            context = "\n".join(conversation_history[-10:])
+    conversation.add("User", message)
+    conversation.add("Bot", cleaned_response)
 
-            gemini_response = await asyncio.to_thread(get_gemini_response, context)
+    if WS_STREAMING:
+        await websocket.send(END_OF_MESSAGE)
+    else:
+        await websocket.send(cleaned_response)
+    await checkpoint(session)
+    return True
 
-            cleaned_response = gemini_response.replace("Bot:", "").strip()
-
-            conversation_history.append(f"Bot: {cleaned_response}")
+async def handle_client(websocket):
+    print(f"New connection from {websocket.remote_address}")
+    # Loading a session may hit the persistence hook, so keep it off the event loop
+    session = await asyncio.to_thread(session_table.acquire, _session_id(websocket))
+    user = _user_key(websocket, session)
+    inflight = {}
 
-            await websocket.send(cleaned_response)
+    try:
+        while True:
+            raw = await websocket.recv()
+            session.touch()
+            frame = parse_frame(raw)
+            if frame is not None:
+                await handle_frame(websocket, session, user, inflight, frame)
+                continue
+            print(f"Received message: {raw}")
+            if not await handle_legacy_message(websocket, session, user, raw):
+                break
     except websockets.exceptions.ConnectionClosedError:
         print(f"Connection closed by client: {websocket.remote_address}")
+    except websockets.exceptions.ConnectionClosedOK:
+        pass
     except Exception as e:
         print(f"Error: {e}")
     finally:
+        for task in list(inflight.values()):
+            task.cancel()
+        if inflight:
+            await asyncio.gather(*inflight.values(), return_exceptions=True)
+        await asyncio.to_thread(session_table.release, session)
         await websocket.close()
 
-async def start_server():
-    server = await websockets.serve(handle_client, "localhost", 8765)
-    print("WebSocket server started on ws://localhost:8765")
+def _compression():
+    if not WS_COMPRESSION:
+        return {"compression": None}
+    # Smaller windows than the zlib defaults keep per-connection memory low; chat
+    # text and long replies still compress well.
+    return {"extensions": [ServerPerMessageDeflateFactory(
+        server_max_window_bits=WS_DEFLATE_WINDOW_BITS, client_max_window_bits=WS_DEFLATE_WINDOW_BITS,
+        compress_settings={"memLevel": 5})]}
+
+def _worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def install_session_store():
+    """Share session state through Postgres (per process); returns the listener to stop on shutdown."""
+    if WS_SESSION_STORE != "postgres":
+        return None
+    from utils.session_store import PostgresSessionStore, SessionListener
+    worker_id = _worker_id()
+    set_session_store(PostgresSessionStore(worker_id))
+    listener = SessionListener(worker_id, session_table.invalidate)
+    listener.start()
+    return listener
+
+async def _prune_sessions():
+    while True:
+        await asyncio.sleep(WS_SESSION_PRUNE_SECONDS)
+        try:
+            pruned = await asyncio.to_thread(session_table.store.prune)
+        except Exception as e:
+            print(f"Session prune failed: {e}")
+            continue
+        if pruned:
+            print(f"Pruned {pruned} stored sessions")
+
+async def drain(server):
+    """Stop accepting, let in-flight requests finish (up to WS_DRAIN_TIMEOUT), then close every connection."""
+    server.close(close_connections=False)
+    deadline = time.monotonic() + WS_DRAIN_TIMEOUT
+    while (scheduler.in_flight or scheduler.waiting) and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    connections = list(server.connections)
+    print(f"Draining: closing {len(connections)} connections ({scheduler.stats()})")
+    await asyncio.gather(*(conn.close(1001, "server shutting down") for conn in connections),
+                         return_exceptions=True)
+    # Handlers release their sessions (saving them) before this returns
     await server.wait_closed()
-async def send_message_to_ws(message):
+
+async def start_server(sock=None):
+    listener = install_session_store()
+    options = dict(ping_interval=WS_PING_INTERVAL, ping_timeout=WS_PING_TIMEOUT,
+                   max_size=WS_MAX_FRAME_BYTES, **_compression())
+    if sock is not None:
+        server = await websockets.serve(handle_client, sock=sock, **options)
+    else:
+        server = await websockets.serve(handle_client, WS_HOST, WS_PORT, reuse_port=WS_WORKERS > 1, **options)
+    print(f"WebSocket server started on ws://{WS_HOST}:{WS_PORT} (pid {os.getpid()})")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass  # Windows: Ctrl+C still ends the process, without draining
+    tasks = [asyncio.create_task(_evict_idle_sessions())]
+    if session_table.store is not None and hasattr(session_table.store, "prune"):
+        tasks.append(asyncio.create_task(_prune_sessions()))
+    try:
+        await stop.wait()
+        await drain(server)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if listener is not None:
+            listener.stop()
+
+def _run_worker(sock=None):
+    asyncio.run(start_server(sock))
+
+def run_workers(workers: int = WS_WORKERS):
+    """
+    Supervise `workers` server processes on one port, restarting any that die.
+    SIGTERM/SIGINT is forwarded so every worker drains before the supervisor exits.
+    """
+    sock = None
+    if WS_REUSE_PORT and hasattr(socket, "SO_REUSEPORT"):
+        # Each worker binds its own listening socket; the kernel balances accepts
+        context = multiprocessing.get_context("spawn")
+    elif "fork" in multiprocessing.get_all_start_methods():
+        sock = socket.create_server((WS_HOST, WS_PORT))
+        context = multiprocessing.get_context("fork")
+    else:
+        print("No SO_REUSEPORT or fork on this platform; running a single worker.")
+        _run_worker()
+        return
+
+    def spawn():
+        process = context.Process(target=_run_worker, args=(sock,), daemon=False)
+        process.start()
+        return process
+
+    processes = [spawn() for _ in range(workers)]
+    stopping = []
+
+    def shutdown(signum, frame):
+        if not stopping:
+            stopping.append(time.monotonic())
+            for process in processes:
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    print(f"Supervising {workers} workers on ws://{WS_HOST}:{WS_PORT}")
+    while any(process.is_alive() for process in processes) or not stopping:
+        for i, process in enumerate(processes):
+            process.join(timeout=0.5)
+            if process.is_alive():
+                if stopping and time.monotonic() - stopping[0] > WS_DRAIN_TIMEOUT + 10:
+                    process.kill()
+            elif not stopping:
+                print(f"Worker {process.pid} exited with {process.exitcode}; restarting")
+                time.sleep(1)  # don't spin if workers die on startup
+                processes[i] = spawn()
+    if sock is not None:
+        sock.close()
+
+async def receive_reply(ws):
+    """Read one reply: frames up to the end marker when streaming, else a single frame."""
+    if not WS_STREAMING:
+        return await ws.recv()
+    chunks = []
+    while True:
+        frame = await ws.recv()
+        if frame == END_OF_MESSAGE:
+            return "".join(chunks).replace("Bot:", "").strip()
+        chunks.append(frame)
+
+async def send_message_to_ws(message, session_id=None):
+    url = f'ws://{WS_HOST}:{WS_PORT}' + (f"?{urlencode({'session': session_id})}" if session_id else "")
     try:
-        async with websockets.connect('ws://localhost:8765') as ws:
+        async with websockets.connect(url) as ws:
             await ws.send(message)
-            return await ws.recv()
+            return await receive_reply(ws)
     except Exception:
         return None
 
 if __name__ == "__main__":
-    asyncio.run(start_server())
+    if WS_WORKERS > 1:
+        run_workers()
+    else:
+        _run_worker()